@@ -0,0 +1,216 @@
+################################################
+#
+# TEG profiler edge aggregation
+#
+# University of Virginia
+#
+################################################
+#
+# Streaming window summaries of the acquired channels. Windows are tumbling and aligned on the
+# epoch (a 60 s window runs from one full minute to the next, a 900 s window from one quarter hour
+# to the next), each emits per channel:
+#
+#   count   samples with a value (failed reads, NaN, are left out)
+#   min     minimum
+#   max     maximum
+#   mean    mean
+#   std     standard deviation (population, as the oversampling statistics of TEG_sweep.py)
+#
+# append() is called after every commit like StreamWriter.append(). The state of all windows is a
+# (windows x channels) array of running count, mean, sum of squared deviations (Welford), minimum
+# and maximum, updated with a few numpy operations per sample whatever the length of the windows,
+# so no samples are kept. A window is emitted when the first sample of the next one arrives; flush()
+# emits the windows in progress, marked partial.
+#
+# Per channel publish policies of the cloud scripts (CHANNEL_POLICY):
+#
+#   'raw'        every sample is published, as before
+#   'aggregate'  only the window summaries are published, the samples stay in the local files
+#   'both'       samples and window summaries
+#
+#   python3 TEG_aggregate.py [samples]    cost per sample, accuracy and messages per day
+
+import sys
+
+import numpy as np
+
+
+WINDOWS = (10, 60, 900) # seconds
+POLICIES = ('raw', 'aggregate', 'both')
+
+
+def channel_policies(channels, policy=None, default='raw'):
+    # (channels published as samples, channels aggregated), in the order of channels
+    policy = dict(policy or {})
+    unknown = set(policy) - set(channels)
+    if unknown:
+        raise ValueError("publish policy of unknown channels: "+', '.join(sorted(unknown)))
+    for name, value in list(policy.items()) + [('default', default)]:
+        if value not in POLICIES:
+            raise ValueError("unknown publish policy of "+name+": "+str(value))
+    raw = [name for name in channels if policy.get(name, default) in ('raw', 'both')]
+    aggregated = [name for name in channels if policy.get(name, default) in ('aggregate', 'both')]
+    return raw, aggregated
+
+
+def select_channels(batch, channels):
+    # new batch with the timestamps of batch and the given channels
+    from TEG_buffer import SampleBatch
+
+    count = batch.count
+    batch.finalize()
+    selected = SampleBatch(count, channels)
+    selected.timestamp[:] = batch.timestamp[:count]
+    selected.values[:] = batch.values[[batch.channels.index(name) for name in channels], :count]
+    selected.count = selected.converted = count
+    selected.sequence = batch.sequence
+    return selected
+
+
+class WindowAggregator:
+
+    def __init__(self, channels, windows=WINDOWS, aggregated=None):
+        # channels: sample buffer channel names, aggregated: the ones summarized (all by default)
+        self.channels = list(aggregated if aggregated is not None else channels)
+        self._indexes = [list(channels).index(name) for name in self.channels]
+        self.windows = sorted(windows)
+        self._lengths = [int(round(window*1000000)) for window in self.windows] # microseconds
+        shape = (len(self.windows), len(self.channels))
+        self._count = np.zeros(shape, dtype=np.int64)
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+        self._start = [None]*len(self.windows) # start of the window in progress, us since the epoch
+        self._first = [True]*len(self.windows) # window in progress began with the aggregator, not at its start
+        self.samples = 0
+        self.emitted = 0
+
+    def append(self, batch):
+        # adds the last committed row of batch, returns the windows it closed (oldest and shortest first)
+        batch.finalize()
+        row = batch.count - 1
+        return self.add(int(batch.timestamp[row]), batch.values[self._indexes, row])
+
+    def add(self, timestamp, values):
+        # one sample, timestamp in us since the epoch, values of the aggregated channels
+        closed = []
+        for i, length in enumerate(self._lengths):
+            start = timestamp - timestamp % length
+            if start != self._start[i]:
+                if self._start[i] is not None:
+                    closed.append(self._close(i))
+                    self._first[i] = False
+                self._start[i] = start
+        valid = ~np.isnan(values)
+        x = np.where(valid, values, 0.0)
+        self._count += valid
+        delta = np.where(valid, x - self._mean, 0.0)
+        self._mean += delta/np.maximum(self._count, 1)
+        self._m2 += delta*(x - self._mean)
+        np.fmin(self._min, values, out=self._min) # fmin/fmax skip NaN
+        np.fmax(self._max, values, out=self._max)
+        self.samples += 1
+        return closed
+
+    def flush(self):
+        # windows in progress, marked partial, the aggregator starts over
+        closed = [self._close(i, partial=True) for i in range(len(self.windows)) if self._start[i] is not None]
+        self._start = [None]*len(self.windows)
+        self._first = [True]*len(self.windows)
+        return closed
+
+    def _close(self, i, partial=False):
+        count = self._count[i].copy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            summary = {
+                'window': self.windows[i],
+                'start': self._start[i],
+                'partial': partial or self._first[i], # also the first window after a start, it began mid-window
+                'channels': self.channels,
+                'count': count,
+                'min': np.where(count > 0, self._min[i], np.nan),
+                'max': np.where(count > 0, self._max[i], np.nan),
+                'mean': np.where(count > 0, self._mean[i], np.nan),
+                'std': np.where(count > 0, np.sqrt(self._m2[i]/count), np.nan),
+            }
+        self._count[i] = 0
+        self._mean[i] = 0.0
+        self._m2[i] = 0.0
+        self._min[i] = np.inf
+        self._max[i] = -np.inf
+        self.emitted += 1
+        return summary
+
+    def summary(self):
+        return "%d samples aggregated, %d window summaries emitted (%s s windows)" % (self.samples, self.emitted, ', '.join('%g' % window for window in self.windows))
+
+
+###########
+# Cost per sample, accuracy and messages per day (python3 TEG_aggregate.py [samples])
+#
+# The cost per sample is compared with a rolling recomputation over the samples of the window in
+# progress, which grows with the window length, and the summaries with numpy over each window.
+
+def naive_add(kept, timestamp, values, lengths):
+    # reference: keeps the samples of each window and recomputes its statistics on every sample
+    for i, length in enumerate(lengths):
+        start = timestamp - timestamp % length
+        if kept[i] and kept[i][0][0] != start:
+            kept[i] = []
+        kept[i].append((start, values))
+        window = np.array([v for s, v in kept[i]])
+        np.nanmin(window, axis=0), np.nanmax(window, axis=0), np.nanmean(window, axis=0), np.nanstd(window, axis=0)
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    from TEG_telemetry import encode_messages, message_topic, mqtt_packet_size, summary_message, summary_topic, synthetic_batch
+
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 7200
+    warnings.simplefilter('ignore', RuntimeWarning) # numpy references over channels without values
+    period = 0.5
+    batch = synthetic_batch(samples, period)
+    values = batch.values[:, :samples].T.copy()
+    timestamps = batch.timestamp[:samples]
+
+    for windows in ((10,), (900,), WINDOWS):
+        aggregator = WindowAggregator(batch.channels, windows)
+        start = time.perf_counter()
+        for row in range(samples):
+            aggregator.add(int(timestamps[row]), values[row])
+        streaming = (time.perf_counter() - start)/samples
+        kept = [[] for window in windows]
+        lengths = [window*1000000 for window in windows]
+        rows = min(samples, 1800)
+        start = time.perf_counter()
+        for row in range(rows):
+            naive_add(kept, int(timestamps[row]), values[row], lengths)
+        naive = (time.perf_counter() - start)/rows
+        print("windows %-12s %6.1f us per sample streaming, %8.1f us recomputing the window (first %d samples)" %
+              (','.join('%d' % window for window in windows), streaming*1e6, naive*1e6, rows))
+
+    aggregator = WindowAggregator(batch.channels, WINDOWS)
+    summaries = []
+    for row in range(samples):
+        summaries += aggregator.add(int(timestamps[row]), values[row])
+    summaries += aggregator.flush()
+    error = 0.0
+    for summary in summaries:
+        rows = (timestamps >= summary['start']) & (timestamps < summary['start'] + summary['window']*1000000)
+        reference = values[rows]
+        with np.errstate(invalid='ignore'):
+            for name, expected in (('min', np.nanmin(reference, axis=0)), ('max', np.nanmax(reference, axis=0)),
+                                   ('mean', np.nanmean(reference, axis=0)), ('std', np.nanstd(reference, axis=0))):
+                error = max(error, float(np.nanmax(np.abs(summary[name] - expected))))
+    print("%d summaries, largest difference with numpy over the window %.1e" % (len(summaries), error))
+
+    APP_ID = 'teg_profiler_00'
+    day = 86400.0/(samples*period) # scales the counts of the synthetic batch to one day
+    print("messages and bytes on the wire per day at %.1f Hz, %d channels:" % (1/period, len(batch.channels)))
+    payloads = [p.encode() for p in encode_messages(APP_ID, batch, 'batch', 60)]
+    print("  %-22s %7d messages %11d bytes" % ('raw, batch mode', len(payloads)*day, sum(mqtt_packet_size(message_topic(APP_ID, 'batch'), p) for p in payloads)*day))
+    for window in WINDOWS:
+        payloads = [(summary_topic(APP_ID, summary['window']), summary_message(APP_ID, summary).encode()) for summary in summaries if summary['window'] == window]
+        print("  %-22s %7d messages %11d bytes" % ('%d s summaries' % window, len(payloads)*day, sum(mqtt_packet_size(topic, p) for topic, p in payloads)*day))
@@ -0,0 +1,212 @@
+################################################
+#
+# TEG profiler on-device I-V analytics
+#
+# University of Virginia
+#
+################################################
+#
+# Fits the linear TEG model V = Voc - R_int*I to every sample of a batch at once. The current of
+# each load state is I = V/R_load, with the load resistance known from the column name
+# (voltage_chan_<load>[_<load>...], loads in parallel) or, for the adaptive states of a sweep plan,
+# from its load_mpp_<i> column; the open circuit state has I = 0. The least squares fit over the
+# load states of a row has a closed form, so the whole batch is fitted with a few numpy reductions:
+#
+#   voc           open circuit voltage of the fit (V)
+#   r_internal    internal resistance of the TEG, minus the slope of the fit (ohm)
+#   p_max         maximum power of the TEG, Voc^2/(4*R_int), at a load of R_int (W)
+#   p_best        best power measured on the load states of the sweep, V^2/R_load (W)
+#   mpp_ratio     p_best/p_max, share of the maximum power the best load state extracts
+#   seebeck       Voc/(T_hot - T_amb), Seebeck coefficient of the module (V/K)
+#   power_factor  p_max/(T_hot - T_amb)^2, maximum power per squared temperature difference (W/K^2)
+#   fit_rms       RMS residual of the fit (V)
+#
+# Rows with fewer than two valid load states, or R_int <= 0, get NaN. The temperature proxies are
+# NaN below MIN_DELTA_T.
+#
+#   python3 TEG_analytics.py [batch_size]    fit time and accuracy, and message size raw vs derived
+
+import math
+import sys
+
+import numpy as np
+
+from TEG_buffer import SampleBatch
+from TEG_sweep import column_mask, load_resistance
+
+
+FEATURES = ('voc', 'r_internal', 'p_max', 'p_best', 'mpp_ratio', 'seebeck', 'power_factor', 'fit_rms')
+MIN_DELTA_T = 1.0 # kelvin, smaller temperature differences give no meaningful Seebeck coefficient or power factor
+
+
+class IVModel:
+
+    def __init__(self, channels):
+        # channels: sample buffer channel names (header[1:] of the scripts)
+        self.channels = list(channels)
+        self.fixed = [] # (voltage channel, load resistance in ohms, inf for open circuit)
+        self.variable = [] # (voltage channel, load resistance channel) of the adaptive states
+        for index, name in enumerate(self.channels):
+            mask = column_mask(name)
+            if mask is not None:
+                self.fixed.append((index, load_resistance(mask) or math.inf))
+            elif name.startswith('voltage_mpp_') and name[len('voltage_mpp_'):].isdigit():
+                self.variable.append((index, self.channels.index('load_mpp_'+name[len('voltage_mpp_'):])))
+        if len(self.fixed) + len(self.variable) < 2:
+            raise ValueError("the I-V fit needs at least two load state voltage columns")
+        self._voltages = [index for index, resistance in self.fixed] + [index for index, load in self.variable]
+        self._fixed_resistances = np.array([resistance for index, resistance in self.fixed])[:, None]
+        self._loads = [load for index, load in self.variable]
+        self._temperatures = None
+        if 'temperature_amb' in self.channels and 'temperature_hot' in self.channels:
+            self._temperatures = (self.channels.index('temperature_amb'), self.channels.index('temperature_hot'))
+
+    def fit(self, batch):
+        # dict of FEATURES, float64 arrays of batch.count values
+        count = batch.count
+        batch.finalize()
+        voltage = batch.values[self._voltages, :count] # states x rows
+        resistance = np.concatenate([np.broadcast_to(self._fixed_resistances, (len(self.fixed), count)), batch.values[self._loads, :count]])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            current = voltage/resistance # 0 for open circuit
+            valid = np.isfinite(voltage) & np.isfinite(current)
+            x = np.where(valid, current, 0.0)
+            y = np.where(valid, voltage, 0.0)
+            n = valid.sum(axis=0)
+            sx = x.sum(axis=0)
+            sy = y.sum(axis=0)
+            sxx = (x*x).sum(axis=0)
+            sxy = (x*y).sum(axis=0)
+            denominator = n*sxx - sx*sx
+            slope = np.where((n >= 2) & (denominator > 0), (n*sxy - sx*sy)/denominator, np.nan)
+            voc = (sy - slope*sx)/n
+            r_internal = -slope
+            r_internal[r_internal <= 0] = np.nan
+            residual = np.where(valid, y - (voc + slope*x), 0.0)
+            fit_rms = np.sqrt((residual*residual).sum(axis=0)/n)
+            p_max = voc*voc/(4*r_internal)
+            power = np.where(valid & (current > 0), voltage*current, np.nan)
+            p_best = np.full(count, np.nan)
+            loaded = np.isfinite(power).any(axis=0)
+            p_best[loaded] = np.nanmax(power[:, loaded], axis=0)
+            features = {
+                'voc': voc,
+                'r_internal': r_internal,
+                'p_max': p_max,
+                'p_best': p_best,
+                'mpp_ratio': p_best/p_max,
+                'fit_rms': fit_rms,
+            }
+            if self._temperatures is not None:
+                delta_t = batch.values[self._temperatures[1], :count] - batch.values[self._temperatures[0], :count]
+                delta_t = np.where(np.abs(delta_t) >= MIN_DELTA_T, delta_t, np.nan)
+                features['seebeck'] = voc/delta_t
+                features['power_factor'] = p_max/(delta_t*delta_t)
+            else:
+                features['seebeck'] = features['power_factor'] = np.full(count, np.nan)
+        return features
+
+    def feature_batch(self, batch, features=FEATURES, include_raw=False):
+        # new batch with the timestamps of batch and the given features, after the raw channels if include_raw
+        fitted = self.fit(batch)
+        count = batch.count
+        channels = (self.channels if include_raw else []) + list(features)
+        derived = SampleBatch(count, channels)
+        derived.timestamp[:] = batch.timestamp[:count]
+        if include_raw:
+            derived.values[:len(self.channels)] = batch.values[:, :count]
+        for i, name in enumerate(features):
+            derived.values[len(channels) - len(features) + i] = fitted[name]
+        derived.count = derived.converted = count
+        derived.sequence = batch.sequence
+        return derived
+
+
+def published_channels(channels, features=FEATURES, mode='raw'):
+    # channels of the published batches: 'raw' as acquired, 'derived' features only, 'both'
+    if mode == 'raw':
+        return list(channels)
+    if mode == 'derived':
+        return list(features)
+    if mode == 'both':
+        return list(channels) + list(features)
+    raise ValueError("unknown published features mode: "+str(mode))
+
+
+###########
+# Fit time, accuracy and message size (python3 TEG_analytics.py [batch_size])
+#
+# The synthetic batch follows V = Voc*R/(R + R_int) with ADS1015 quantization and noise for the
+# default load states, with Voc and R_int drifting over the batch.
+
+def synthetic_iv_batch(batch_size=1800, statistics=False, seed=0):
+    from datetime import datetime
+    from TEG_buffer import to_epoch_us
+    from TEG_sweep import default_plan
+
+    columns = default_plan().columns(statistics) + ['temperature_age']
+    batch = SampleBatch(batch_size, columns)
+    batch.reset(0)
+    rng = np.random.default_rng(seed)
+    batch.timestamp[:] = to_epoch_us(datetime.utcnow()) + np.arange(batch_size, dtype=np.int64)*500000
+    delta_t = 20 + 5*np.sin(np.linspace(0, 2*np.pi, batch_size))
+    voc = 0.02*delta_t
+    r_internal = 1.5 + 0.2*np.cos(np.linspace(0, 2*np.pi, batch_size))
+    for index, name in enumerate(columns):
+        mask = column_mask(name)
+        if mask is not None:
+            resistance = load_resistance(mask)
+            voltage = voc if resistance is None else voc*resistance/(resistance + r_internal)
+            batch.values[index] = np.round((voltage + rng.normal(0, 0.0003, batch_size))/0.00025)*0.00025
+        elif name.endswith('_std'):
+            batch.values[index] = np.abs(rng.normal(0.0003, 0.0001, batch_size))
+        elif name.endswith('_min') or name.endswith('_max'):
+            batch.values[index] = batch.values[columns.index(name.rsplit('_', 1)[0])]
+    batch.values[columns.index('temperature_amb')] = 25.0
+    batch.values[columns.index('temperature_hot')] = 25.0 + delta_t
+    batch.values[columns.index('temperature_age')] = rng.uniform(0, 5, batch_size)
+    batch.count = batch.converted = batch_size
+    return batch, voc, r_internal
+
+
+def per_row_fit(model, batch):
+    # reference: numpy polyfit row by row
+    voltages = [index for index, resistance in model.fixed]
+    resistances = np.array([resistance for index, resistance in model.fixed])
+    results = []
+    for row in range(batch.count):
+        voltage = batch.values[voltages, row]
+        slope, intercept = np.polyfit(voltage/resistances, voltage, 1)
+        results.append((intercept, -slope))
+    return results
+
+
+if __name__ == '__main__':
+    import time
+    from TEG_telemetry import encode_messages
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1800
+    batch, voc, r_internal = synthetic_iv_batch(batch_size)
+    model = IVModel(batch.channels)
+
+    start = time.perf_counter()
+    features = model.fit(batch)
+    vectorized = time.perf_counter() - start
+    start = time.perf_counter()
+    per_row_fit(model, batch)
+    per_row = time.perf_counter() - start
+    print("fit of %d samples: vectorized %.2f ms, np.polyfit per row %.1f ms (%.0fx)" % (batch_size, vectorized*1000, per_row*1000, per_row/vectorized))
+    print("error: voc %.2f mV rms, r_internal %.1f mohm rms, p_max %.2f %% rms, mpp_ratio %.3f to %.3f" % (
+        1000*np.sqrt(np.mean((features['voc'] - voc)**2)), 1000*np.sqrt(np.mean((features['r_internal'] - r_internal)**2)),
+        100*np.sqrt(np.mean((features['p_max']/(voc*voc/(4*r_internal)) - 1)**2)), np.min(features['mpp_ratio']), np.max(features['mpp_ratio'])))
+
+    published = ('voc', 'r_internal', 'p_max', 'power_factor')
+    print("message bytes per batch, raw channels vs derived %s:" % ', '.join(published))
+    for statistics in (False, True):
+        batch, voc, r_internal = synthetic_iv_batch(batch_size, statistics)
+        derived = IVModel(batch.channels).feature_batch(batch, published)
+        for mode in ('batch', 'binary'):
+            raw_bytes = sum(len(message) for message in encode_messages('bench', batch, mode))
+            derived_bytes = sum(len(message) for message in encode_messages('bench', derived, mode))
+            print("  %-6s %2d raw channels%-13s %9d  derived %9d  (%.1fx)" % (mode, len(batch.channels), ' + statistics' if statistics else '',
+                                                                           raw_bytes, derived_bytes, raw_bytes/derived_bytes))
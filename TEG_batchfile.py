@@ -0,0 +1,265 @@
+################################################
+#
+# TEG profiler batch files
+#
+# University of Virginia
+#
+################################################
+#
+# Batch files are written either as CSV (one row per sample, as before) or in a columnar binary
+# format (.teg) that stores a whole batch with one write and can be memory-mapped for reading:
+#
+#   4 bytes   magic 'TEGB'
+#   uint16    format version (1)
+#   uint32    length of the JSON header
+#   JSON      header: channels, dtype, timestamp_dtype, timestamp_unit, rows, sample_period, layout,
+#             (raw_channels, raw_dtype, raw_scales, raw_missing), padded with spaces so the data starts on a 64 byte boundary
+#   int64     [rows] timestamps, microseconds since the epoch (UTC)
+#   float64   [channels][rows] values, one column per channel, NaN for failed reads
+#   int16     [raw channels][rows] raw converter codes, only if the header has "raw_channels":
+#             value = code*raw_scales[j] for channel raw_channels[j], raw_missing for failed reads
+#
+# Files written sample by sample by the streaming writer (TEG_stream.py) use "layout": "rows" and
+# "rows": null instead: after the header come fixed-size records of
+#
+#   int64     timestamp, float64 [channels] values, uint32 CRC32 of the timestamp and values
+#
+# and the number of rows follows from the file size. BatchFile reads both layouts.
+#
+# All numbers are little endian.
+#
+#   python3 TEG_batchfile.py to-csv FILE.teg...    converts binary batch files to CSV
+#   python3 TEG_batchfile.py to-teg FILE.csv...    converts CSV batch files to binary
+#   python3 TEG_batchfile.py bench [rows]          compares file size, write and read time
+
+import csv
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+from TEG_buffer import EPOCH, MISSING_CODE, iso_timestamps
+
+
+MAGIC = b'TEGB'
+VERSION = 1
+PREFIX = struct.Struct('<4sHI')
+ALIGNMENT = 64
+
+EXTENSIONS = {'csv': '.csv', 'binary': '.teg'}
+
+
+###########
+# Writing
+
+def write_batch_csv(path, header, batch):
+    with open(path, 'w') as file:
+        csvwriter = csv.writer(file, delimiter = ',')
+        csvwriter.writerow(header)
+        csvwriter.writerows(batch.rows())
+
+
+def binary_header(channels, rows, sample_period, layout='columns', raw_channels=None, raw_scales=None):
+    header = {
+        'channels': list(channels),
+        'dtype': '<f8',
+        'timestamp_dtype': '<i8',
+        'timestamp_unit': 'us',
+        'rows': rows,
+        'sample_period': sample_period,
+        'layout': layout,
+    }
+    if raw_channels:
+        header.update({
+            'raw_channels': list(raw_channels),
+            'raw_dtype': '<i2',
+            'raw_scales': [float(scale) for scale in raw_scales],
+            'raw_missing': MISSING_CODE,
+        })
+    header = json.dumps(header).encode()
+    length = PREFIX.size + len(header)
+    header += b' '*(-length % ALIGNMENT)
+    return PREFIX.pack(MAGIC, VERSION, len(header)) + header
+
+
+def write_columns(path, channels, timestamps, values, sample_period, raw=None, raw_channels=None, raw_scales=None):
+    # timestamps: int64 [rows], values: float64 [channels][rows], optional raw: int16 [raw channels][rows]
+    timestamps = np.ascontiguousarray(timestamps, dtype='<i8')
+    values = np.ascontiguousarray(values, dtype='<f8')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        buffers = [binary_header(channels, len(timestamps), sample_period, 'columns', raw_channels, raw_scales), memoryview(timestamps).cast('B'), memoryview(values).cast('B')]
+        if raw_channels:
+            buffers.append(memoryview(np.ascontiguousarray(raw, dtype='<i2')).cast('B'))
+        total = sum(len(b) for b in buffers)
+        written = os.writev(fd, buffers) # whole batch in one system call
+        if written < total: # short write, finish the rest
+            os.write(fd, b''.join(bytes(b) for b in buffers)[written:])
+    finally:
+        os.close(fd)
+
+
+def write_batch_binary(path, batch, sample_period):
+    count = batch.count
+    batch.finalize()
+    raw_channels = [batch.channels[channel] for channel in batch.raw_channels]
+    write_columns(path, batch.channels, batch.timestamp[:count], batch.values[:, :count], sample_period,
+                  batch.raw[:, :count], raw_channels, batch.raw_scales)
+
+
+def write_batch(path, header, batch, file_format='csv', sample_period=None):
+    if file_format == 'csv':
+        write_batch_csv(path, header, batch)
+    elif file_format == 'binary':
+        write_batch_binary(path, batch, sample_period)
+    else:
+        raise ValueError("unknown file format: "+str(file_format))
+
+
+###########
+# Reading
+
+def row_record_dtype(channels):
+    # one record of a "layout": "rows" file
+    return np.dtype([('timestamp', '<i8'), ('values', '<f8', (channels,)), ('crc', '<u4')])
+
+
+def read_binary_header(file):
+    # returns the JSON header and the offset of the data
+    prefix = file.read(PREFIX.size)
+    if len(prefix) < PREFIX.size:
+        raise ValueError("truncated TEG batch file header")
+    magic, version, length = PREFIX.unpack(prefix)
+    if magic != MAGIC:
+        raise ValueError("not a TEG batch file")
+    if version != VERSION:
+        raise ValueError("unsupported TEG batch file version: "+str(version))
+    header = file.read(length)
+    if len(header) < length:
+        raise ValueError("truncated TEG batch file header")
+    return json.loads(header.decode()), PREFIX.size + length
+
+
+class BatchFile:
+    # memory-mapped binary batch file: timestamps (int64, us), values (float64, channels x rows)
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.header, offset = read_binary_header(file)
+        self.channels = self.header['channels']
+        self.sample_period = self.header['sample_period']
+        if self.header.get('layout', 'columns') == 'rows':
+            dtype = row_record_dtype(len(self.channels))
+            self.rows = self.header['rows']
+            if self.rows is None:
+                self.rows = (os.path.getsize(path) - offset)//dtype.itemsize
+            records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(self.rows,))
+            self.timestamps = records['timestamp']
+            self.values = records['values'].T # strided view, channels x rows like the column layout
+        else:
+            self.rows = self.header['rows']
+            self.timestamps = np.memmap(path, dtype=self.header['timestamp_dtype'], mode='r', offset=offset, shape=(self.rows,))
+            offset += self.timestamps.nbytes
+            self.values = np.memmap(path, dtype=self.header['dtype'], mode='r', offset=offset, shape=(len(self.channels), self.rows))
+        self.raw_channels = self.header.get('raw_channels', [])
+        self.raw = None # int16 raw codes, raw_channels x rows
+        if self.raw_channels:
+            offset += self.values.nbytes
+            self.raw = np.memmap(path, dtype=self.header['raw_dtype'], mode='r', offset=offset, shape=(len(self.raw_channels), self.rows))
+
+    def column(self, name):
+        return self.values[self.channels.index(name)]
+
+    def raw_column(self, name):
+        return self.raw[self.raw_channels.index(name)]
+
+
+def read_csv_columns(path):
+    # CSV batch file as (channels, timestamps in us, float64 values [channels][rows])
+    with open(path) as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    times = np.array([row[0].rstrip('Z') for row in rows], dtype='datetime64[us]')
+    timestamps = (times - np.datetime64(EPOCH, 'us')).astype(np.int64)
+    values = np.array([[float(v) if v else np.nan for v in row[1:]] for row in rows], dtype=np.float64).T.reshape(len(header) - 1, len(rows))
+    return header[1:], timestamps, values
+
+
+###########
+# Converters
+
+def csv_to_binary(csv_path, binary_path=None, sample_period=None):
+    binary_path = binary_path or os.path.splitext(csv_path)[0]+EXTENSIONS['binary']
+    channels, timestamps, values = read_csv_columns(csv_path)
+    if sample_period is None and len(timestamps) > 1:
+        sample_period = float(np.median(np.diff(timestamps)))/1e6
+    write_columns(binary_path, channels, timestamps, values, sample_period)
+    return binary_path
+
+
+def binary_to_csv(binary_path, csv_path=None):
+    csv_path = csv_path or os.path.splitext(binary_path)[0]+EXTENSIONS['csv']
+    batch = BatchFile(binary_path)
+    with open(csv_path, 'w') as file:
+        csvwriter = csv.writer(file, delimiter = ',')
+        csvwriter.writerow(['Timestamp'] + batch.channels)
+        csvwriter.writerows(zip(iso_timestamps(np.asarray(batch.timestamps)).tolist(), *np.asarray(batch.values).tolist()))
+    return csv_path
+
+
+###########
+# File size and write/read time comparison
+
+def benchmark(rows=7200):
+    import tempfile
+    import time
+    from TEG_telemetry import synthetic_batch
+
+    batch = synthetic_batch(rows)
+    header = ['Timestamp'] + batch.channels
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for file_format in ('csv', 'binary'):
+            path = os.path.join(directory, 'batch'+EXTENSIONS[file_format])
+            start = time.perf_counter()
+            write_batch(path, header, batch, file_format, 0.5)
+            fd = os.open(path, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if file_format == 'csv':
+                channels, timestamps, values = read_csv_columns(path)
+            else:
+                data = BatchFile(path)
+                values = np.array(data.values)
+            read_time = time.perf_counter() - start
+            results[file_format] = (os.path.getsize(path), write_time, read_time)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return results
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    if command == 'to-csv':
+        for path in sys.argv[2:]:
+            print(binary_to_csv(path))
+    elif command == 'to-teg':
+        for path in sys.argv[2:]:
+            print(csv_to_binary(path))
+    elif command == 'bench':
+        rows = int(sys.argv[2]) if len(sys.argv) > 2 else 7200
+        results = benchmark(rows)
+        for file_format, (size, write_time, read_time) in results.items():
+            print("%-6s %8.1f kB, write+fsync %7.2f ms, read %7.2f ms" % (file_format, size/1024.0, write_time*1000, read_time*1000))
+        print("binary/csv: size %.2f, write time %.2f, read time %.3f" % tuple(results['binary'][i]/results['csv'][i] for i in range(3)))
+    else:
+        print("usage: python3 TEG_batchfile.py to-csv FILE.teg... | to-teg FILE.csv... | bench [rows]")
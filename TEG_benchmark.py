@@ -0,0 +1,310 @@
+################################################
+#
+# TEG profiler acquisition loop benchmark
+#
+# University of Virginia
+#
+################################################
+#
+# Runs the acquisition loop code path (PCA writes, ADS reads, MCP9600 reads, timestamping and
+# buffer store) for N iterations and reports p50/p95/p99 latency per stage, achieved sample rate
+# and period jitter. Results are saved as JSON so runs can be compared across changes:
+#
+#   python3 TEG_benchmark.py --backend sim -n 500 --period 0.1 -o before.json
+#   python3 TEG_benchmark.py --backend sim -n 500 --period 0.1 -o after.json --compare before.json
+#
+# --period 0 runs the iterations back to back to measure the maximum sampling rate. --sweep fixed
+# runs the previous sweep (continuous ADS1015 mode, fixed sleeps) instead of the settle-time sweep.
+# --temperature-period reads the thermocouples at their own period like the scripts (needs --period).
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import numpy as np
+
+from TEG_buffer import SampleBuffer
+from TEG_hardware import open_hardware
+from TEG_scheduler import MultiRateScheduler
+from TEG_sweep import iv_sweep, iv_sweep_fixed, raw_scales, read_temperatures
+
+
+HEADER = ['Timestamp', 'voltage_chan_OFF', 'voltage_chan_0', 'voltage_chan_1', 'voltage_chan_2', 'voltage_chan_3', 'temperature_amb', 'temperature_hot']
+STAGES = ['pca_write', 'adc_read', 'mcp_read', 'timestamp', 'store', 'sweep', 'temperatures', 'iteration']
+
+
+###########
+# Stage timing
+#
+# The devices and the sample buffer are wrapped in proxies that add the time spent in each call to
+# its stage, so the loop below runs the same iv_sweep()/read_temperatures() as the scripts.
+
+class StageRecorder:
+
+    def __init__(self):
+        self.clock = time.perf_counter
+        self.totals = dict((stage, 0.0) for stage in STAGES)
+        self.calls = dict((stage, 0) for stage in STAGES)
+        self.samples = dict((stage, []) for stage in STAGES)
+
+    def add(self, stage, seconds):
+        self.totals[stage] += seconds
+        self.calls[stage] += 1
+
+    def end_iteration(self):
+        for stage in STAGES:
+            self.samples[stage].append(self.totals[stage])
+            self.totals[stage] = 0.0
+
+
+class TimedPCA:
+
+    def __init__(self, pca, recorder):
+        self._pca = pca
+        self._recorder = recorder
+
+    def write(self, buf, **kwargs):
+        start = self._recorder.clock()
+        try:
+            self._pca.write(buf, **kwargs)
+        finally:
+            self._recorder.add('pca_write', self._recorder.clock() - start)
+
+
+class TimedChannel:
+
+    def __init__(self, chan, recorder):
+        self._chan = chan
+        self._recorder = recorder
+
+    @property
+    def voltage(self):
+        start = self._recorder.clock()
+        try:
+            return self._chan.voltage
+        finally:
+            self._recorder.add('adc_read', self._recorder.clock() - start)
+
+    def read(self):
+        start = self._recorder.clock()
+        try:
+            return self._chan.read()
+        finally:
+            self._recorder.add('adc_read', self._recorder.clock() - start)
+
+
+class TimedMCP:
+
+    def __init__(self, mcp, recorder):
+        self._mcp = mcp
+        self._recorder = recorder
+
+    def _timed(self, read):
+        start = self._recorder.clock()
+        try:
+            return read()
+        finally:
+            self._recorder.add('mcp_read', self._recorder.clock() - start)
+
+    def get_cold_junction_temperature(self):
+        return self._timed(self._mcp.get_cold_junction_temperature)
+
+    def get_hot_junction_temperature(self):
+        return self._timed(self._mcp.get_hot_junction_temperature)
+
+    def __getattr__(self, name):
+        if name == 'read_junctions' and hasattr(self._mcp, 'read_junctions'):
+            return lambda: self._timed(self._mcp.read_junctions)
+        raise AttributeError(name)
+
+
+class TimedBuffer:
+
+    def __init__(self, sample_buffer, recorder):
+        self._buffer = sample_buffer
+        self._recorder = recorder
+        self.current = sample_buffer.current
+
+    def put(self, channel, value):
+        start = self._recorder.clock()
+        self._buffer.put(channel, value)
+        self._recorder.add('store', self._recorder.clock() - start)
+
+    def put_raw(self, channel, code):
+        start = self._recorder.clock()
+        self._buffer.put_raw(channel, code)
+        self._recorder.add('store', self._recorder.clock() - start)
+
+    def hold(self, values, timestamp, age_channel=None):
+        start = self._recorder.clock()
+        self._buffer.hold(values, timestamp, age_channel)
+        self._recorder.add('store', self._recorder.clock() - start)
+
+    def commit(self, timestamp):
+        start = self._recorder.clock()
+        batch = self._buffer.commit(timestamp)
+        self._recorder.add('store', self._recorder.clock() - start)
+        self.current = self._buffer.current
+        return batch
+
+
+###########
+# Benchmark loop
+
+def run_benchmark(hw, iterations, period, batch_size=1800, sweep='settle', temperature_period=None):
+    recorder = StageRecorder()
+    clock = recorder.clock
+    pca = TimedPCA(hw.pca, recorder)
+    chan = TimedChannel(hw.adc if sweep == 'settle' else hw.chan, recorder)
+    mcp = TimedMCP(hw.mcp, recorder)
+    sample_buffer = TimedBuffer(SampleBuffer(batch_size, HEADER[1:] + ['temperature_age'], sinks=1, scales=raw_scales()), recorder)
+    scheduler = MultiRateScheduler(period) if period > 0 else None
+    if temperature_period is not None:
+        scheduler.add_task('temperatures', temperature_period)
+    transactions = getattr(hw.i2c, 'transactions', None)
+
+    wakeups = []
+    errors = 0
+    for i in range(iterations):
+        if scheduler is not None:
+            scheduler.wait()
+        wake = clock()
+        wakeups.append(wake)
+
+        start = clock()
+        timestamp = datetime.utcnow()
+        recorder.add('timestamp', clock() - start)
+
+        start = clock()
+        try:
+            if sweep == 'settle':
+                iv_sweep(pca, chan, sample_buffer)
+            else:
+                iv_sweep_fixed(pca, chan, sample_buffer)
+        except Exception as e:
+            errors += 1
+            logging.error("[Benchmark]: "+str(e))
+        recorder.add('sweep', clock() - start)
+
+        start = clock()
+        try:
+            if temperature_period is None:
+                read_temperatures(mcp, sample_buffer)
+            elif scheduler.is_due('temperatures'):
+                read_temperatures(mcp, sample_buffer, timestamp, len(HEADER) - 1)
+        except Exception as e:
+            errors += 1
+            logging.error("[Benchmark]: "+str(e))
+        recorder.add('temperatures', clock() - start)
+
+        batch = sample_buffer.commit(timestamp)
+        if batch is not None:
+            batch.release()
+
+        recorder.add('iteration', clock() - wake)
+        recorder.end_iteration()
+
+    results = {'stages': {}, 'errors': errors}
+    for stage in STAGES:
+        samples = np.array(recorder.samples[stage])*1000
+        results['stages'][stage] = {
+            'calls_per_iteration': recorder.calls[stage]/float(iterations),
+            'mean_ms': float(samples.mean()),
+            'p50_ms': float(np.percentile(samples, 50)),
+            'p95_ms': float(np.percentile(samples, 95)),
+            'p99_ms': float(np.percentile(samples, 99)),
+            'max_ms': float(samples.max()),
+        }
+
+    intervals = np.diff(np.array(wakeups))
+    if len(intervals):
+        results['rate_hz'] = float(len(intervals)/(wakeups[-1] - wakeups[0]))
+        target = period if period > 0 else float(intervals.mean())
+        deviation = np.abs(intervals - target)*1000
+        results['period_jitter'] = {
+            'std_ms': float(intervals.std()*1000),
+            'p95_abs_ms': float(np.percentile(deviation, 95)),
+            'p99_abs_ms': float(np.percentile(deviation, 99)),
+            'max_abs_ms': float(deviation.max()),
+        }
+    if scheduler is not None:
+        results['scheduler'] = scheduler.stats()
+    if transactions is not None:
+        results['i2c_transactions_per_iteration'] = (hw.i2c.transactions - transactions)/float(iterations)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def print_results(results, baseline=None):
+    print("%-14s %8s %8s %8s %8s %7s" % ('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'calls'))
+    for stage in STAGES:
+        r = results['stages'][stage]
+        line = "%-14s %8.3f %8.3f %8.3f %8.3f %7.1f" % (stage, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['max_ms'], r['calls_per_iteration'])
+        if baseline is not None and stage in baseline['stages']:
+            b = baseline['stages'][stage]
+            line += "   p50 %+8.3f  p99 %+8.3f" % (r['p50_ms'] - b['p50_ms'], r['p99_ms'] - b['p99_ms'])
+        print(line)
+    if 'rate_hz' in results:
+        line = "rate: %.2f Hz, period jitter: std %.3f ms, p99 %.3f ms, max %.3f ms" % (
+            results['rate_hz'], results['period_jitter']['std_ms'], results['period_jitter']['p99_abs_ms'], results['period_jitter']['max_abs_ms'])
+        if baseline is not None and 'rate_hz' in baseline:
+            line += " (baseline %.2f Hz, jitter std %.3f ms)" % (baseline['rate_hz'], baseline['period_jitter']['std_ms'])
+        print(line)
+    if 'i2c_transactions_per_iteration' in results:
+        print("I2C transactions per iteration: %.1f" % results['i2c_transactions_per_iteration'])
+    if results['errors']:
+        print("errors: "+str(results['errors']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TEG profiler acquisition loop benchmark')
+    parser.add_argument('--backend', default='sim', help="hardware backend, 'sim' or 'board'")
+    parser.add_argument('--sim-options', default='{}', help='JSON object with simulator options')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--period', type=float, default=0.5, help='sampling period in seconds, 0 to run back to back')
+    parser.add_argument('--sweep', choices=['settle', 'fixed'], default='settle', help="'settle': single-shot conversions after the settle times, 'fixed': previous sweep with fixed sleeps")
+    parser.add_argument('--temperature-period', type=float, help='seconds between thermocouple reads, default every iteration')
+    parser.add_argument('-o', '--output', help='JSON results file')
+    parser.add_argument('--compare', help='JSON results file of a previous run to compare with')
+    args = parser.parse_args()
+
+    options = json.loads(args.sim_options) if args.backend == 'sim' else {}
+    hw = open_hardware(args.backend, **options)
+    if args.temperature_period is not None and args.period <= 0:
+        parser.error('--temperature-period needs --period')
+    results = run_benchmark(hw, args.iterations, args.period, sweep=args.sweep, temperature_period=args.temperature_period)
+    results['meta'] = {
+        'backend': args.backend,
+        'sim_options': options,
+        'iterations': args.iterations,
+        'period': args.period,
+        'sweep': args.sweep,
+        'temperature_period': args.temperature_period,
+        'date': datetime.utcnow().isoformat()+'Z',
+        'git_revision': git_revision(),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    output = args.output or 'TEG_benchmark_'+args.backend+'_'+datetime.utcnow().strftime('%Y%m%d_%H_%M')+'.json'
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print("results saved to "+output)
@@ -0,0 +1,218 @@
+################################################
+#
+# TEG profiler sample buffer
+#
+# University of Virginia
+#
+################################################
+
+import collections
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+EPOCH = datetime(1970, 1, 1)
+MISSING_CODE = -32768 # raw code of a failed read
+
+
+###########
+# Timestamp helpers (timestamps are stored as int64 microseconds since the epoch, UTC)
+
+def to_epoch_us(timestamp):
+    delta = timestamp - EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+
+def from_epoch_us(epoch_us):
+    return EPOCH + timedelta(microseconds=int(epoch_us))
+
+
+def iso_timestamps(epoch_us):
+    # vectorized equivalent of timestamp.isoformat()+'Z' used by the profiler scripts
+    return np.char.add(np.datetime_as_string(epoch_us.astype('datetime64[us]'), unit='us'), 'Z')
+
+
+###########
+# Sample batch: one int64 timestamp column plus one float64 column per channel
+#
+# Channels given a scale (units per code, e.g. volts per ADS1015 code) also have an int16 column of
+# raw converter codes. The acquisition loop stores the codes with put_raw() and finalize() converts
+# them to float64 values for a range of rows at once: at rollover for the whole batch, or row by row
+# for the stream writer. The raw codes stay in the batch for lossless storage (binary batch files).
+
+class SampleBatch:
+
+    def __init__(self, size, channels, scales=None):
+        self.size = size
+        self.channels = list(channels)
+        self.timestamp = np.zeros(size, dtype=np.int64)
+        self.values = np.empty((len(self.channels), size), dtype=np.float64) # row i is the column of channel i
+        scales = scales or {}
+        self.raw_channels = sorted(scales) # channel indexes with raw codes
+        self.raw_scales = np.array([scales[channel] for channel in self.raw_channels], dtype=np.float64)
+        self.raw = np.empty((len(self.raw_channels), size), dtype=np.int16) # row j holds the codes of channel raw_channels[j]
+        self.count = 0 # rows [0, count) hold valid samples
+        self.converted = 0 # rows [0, converted) of the raw channels are converted to values
+        self.sequence = 0 # batch number, increases at every rollover
+        self._owners = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def reset(self, sequence):
+        self.values.fill(np.nan) # failed reads show up as NaN instead of values from an older batch
+        self.raw.fill(MISSING_CODE)
+        self.count = 0
+        self.converted = 0
+        self.sequence = sequence
+
+    def finalize(self, end=None):
+        # converts the raw codes of rows [converted, end) to values, end defaults to count
+        end = self.count if end is None else end
+        if end <= self.converted or not self.raw_channels:
+            return
+        codes = self.raw[:, self.converted:end]
+        values = self.values[self.raw_channels, self.converted:end]
+        self.values[self.raw_channels, self.converted:end] = np.where(codes != MISSING_CODE, codes*self.raw_scales[:, None], values)
+        self.converted = end
+
+    def column(self, name):
+        return self.values[self.channels.index(name), :self.count]
+
+    def iso_timestamps(self):
+        return iso_timestamps(self.timestamp[:self.count])
+
+    def rows(self):
+        # rows in the same layout as the old data_list: [timestamp, channel values...]
+        columns = [self.iso_timestamps().tolist()] + self.values[:, :self.count].tolist()
+        return zip(*columns)
+
+    def release(self):
+        # called by each sink when it is done with the batch, the last one returns it to the pool
+        with self._lock:
+            self._owners -= 1
+            done = self._owners <= 0
+        if done and self._pool is not None:
+            self._pool.append(self)
+
+    def nbytes(self):
+        return self.timestamp.nbytes + self.values.nbytes + self.raw.nbytes
+
+
+###########
+# Double-buffered sample buffer
+#
+# The acquisition loop fills the current batch with put() and commit(). When the batch is full
+# commit() hands the whole batch over to the sinks (file writer, cloud upload) and continues on a
+# free batch from the pool, so the sinks never see a batch that is still being written and nothing
+# is copied. A batch goes back to the pool once every sink has called release() on it. If the sinks
+# fall behind and the pool is empty a new batch is allocated instead of blocking the acquisition loop.
+
+class SampleBuffer:
+
+    def __init__(self, batch_size, channels, sinks=1, depth=2, scales=None):
+        self.batch_size = batch_size
+        self.channels = list(channels)
+        self.sinks = sinks
+        self.scales = dict(scales or {}) # channel index: units per raw code, for the channels stored with put_raw()
+        self._raw_rows = dict((channel, j) for j, channel in enumerate(sorted(self.scales)))
+        self._held = {} # channels of a slower task: (values, epoch us of the read, age channel)
+        self.allocated = 0
+        self._pool = collections.deque() # append/popleft are atomic, no lock needed between producer and sinks
+        for i in range(depth - 1):
+            self._pool.append(self._allocate())
+        self._sequence = 0
+        self.current = self._allocate()
+        self.current.reset(self._sequence)
+
+    def _allocate(self):
+        batch = SampleBatch(self.batch_size, self.channels, self.scales)
+        batch._pool = self._pool
+        self.allocated += 1
+        return batch
+
+    def put(self, channel, value):
+        batch = self.current
+        batch.values[channel, batch.count] = value
+
+    def put_raw(self, channel, code):
+        # raw converter code of a channel with a scale, converted to a value by finalize()
+        batch = self.current
+        batch.raw[self._raw_rows[channel], batch.count] = code
+
+    def hold(self, values, timestamp, age_channel=None):
+        # values ({channel: value}) read by a slower task at timestamp, carried forward on every row
+        # committed from now on until the next hold() of the same channels. age_channel gets the
+        # seconds between the read and the row timestamp.
+        self._held[tuple(sorted(values))] = (dict(values), to_epoch_us(timestamp), age_channel)
+
+    def commit(self, timestamp):
+        # closes the current row, returns the full batch at rollover and None otherwise
+        batch = self.current
+        row_us = to_epoch_us(timestamp)
+        for values, held_us, age_channel in self._held.values():
+            for channel, value in values.items():
+                batch.values[channel, batch.count] = value
+            if age_channel is not None:
+                batch.values[age_channel, batch.count] = (row_us - held_us)/1e6
+        batch.timestamp[batch.count] = row_us
+        batch.count += 1
+        if batch.count == self.batch_size:
+            return self.rollover()
+        return None
+
+    def rollover(self):
+        # hands the current (possibly partial) batch over to the sinks and starts a new one
+        full = self.current
+        full.finalize()
+        full._owners = self.sinks
+        try:
+            batch = self._pool.popleft()
+        except IndexError:
+            batch = self._allocate()
+            logging.warning("[Buffer]: sinks are behind, allocated sample batch number "+str(self.allocated))
+        self._sequence += 1
+        batch.reset(self._sequence)
+        self.current = batch
+        return full
+
+
+###########
+# Memory comparison against the list-of-lists buffer used before (python TEG_buffer.py [batch_size])
+
+def measure_memory(batch_size=7200):
+    import tracemalloc
+
+    header = ['Timestamp', 'voltage_chan_OFF', 'voltage_chan_0', 'voltage_chan_1', 'voltage_chan_2', 'voltage_chan_3', 'temperature_amb', 'temperature_hot']
+    timestamp = datetime.utcnow()
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    data_list = [[None]*8 for i in range(batch_size)]
+    for row in data_list:
+        row[0] = timestamp.isoformat()+'Z'
+        for i in range(1, 8):
+            row[i] = float(i)*0.01 + 0.001
+    list_bytes = tracemalloc.get_traced_memory()[0] - start
+    del data_list
+
+    start = tracemalloc.get_traced_memory()[0]
+    batch = SampleBatch(batch_size, header[1:])
+    batch.reset(0)
+    array_bytes = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    return list_bytes, array_bytes
+
+
+if __name__ == '__main__':
+    import sys
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 7200
+    list_bytes, array_bytes = measure_memory(batch_size)
+    print("batch size: "+str(batch_size)+" rows")
+    print("list of lists: %.1f kB (%.1f bytes/row)" % (list_bytes/1024, list_bytes/batch_size))
+    print("array batch:   %.1f kB (%.1f bytes/row)" % (array_bytes/1024, array_bytes/batch_size))
+    print("double buffer: %.1f kB" % (2*array_bytes/1024))
@@ -0,0 +1,221 @@
+################################################
+#
+# TEG profiler change-driven publishing
+#
+# University of Virginia
+#
+################################################
+#
+# Report by exception for the cloud scripts (PUBLISH_MODE = 'changes'). A channel value is published
+# only when it moved out of the deadband of the last value published for that channel:
+#
+#   |x - y| > max(absolute, relative*|y|)     x acquired value, y last published value
+#
+# or when it becomes or stops being a failed read (NaN, published as null), or when the channel was
+# silent for `heartbeat` seconds. The first sample of every batch publishes all channels, so each
+# batch is reconstructed on its own, whatever the order in which spilled batches and the outbox
+# deliver them.
+#
+# Reconstruction bounds for the consumer: hold each published value y (as published, rounded to
+# VALUE_DECIMALS) until the next value of the same channel, or until the last sample covered by the
+# message ("dt_end_us"). Then for every acquired sample in between:
+#
+#   y is a number    the acquired value is a number and within max(absolute, relative*|y|) of y
+#   y is null        the acquired value was a failed read as well
+#
+# and no value is held longer than `heartbeat` seconds plus one sampling period. The deadband of
+# every channel and the heartbeat are repeated in each message, see README.md for the format.
+#
+#   python3 TEG_deadband.py [--absolute V] [--relative R] [--heartbeat s] [FILE...]
+#       replays recorded batch files (.csv or .teg, one batch per file, e.g. a day of the local data
+#       directory), or a synthetic day without files, and compares messages and bytes with 'batch' mode
+
+import numpy as np
+
+from TEG_telemetry import VALUE_DECIMALS
+
+
+HEARTBEAT = 300.0 # seconds
+
+
+class Deadband:
+
+    def __init__(self, channels, bands=None, default=(0.0, 0.0), heartbeat=HEARTBEAT):
+        # bands: {channel name or name prefix: (absolute, relative)}, the longest matching key applies
+        self.channels = list(channels)
+        self.heartbeat = heartbeat
+        bands = bands or {}
+        self.bands = []
+        for name in self.channels:
+            keys = [key for key in bands if name.startswith(key)]
+            self.bands.append(tuple(bands[max(keys, key=len)]) if keys else tuple(default))
+        self._absolute = np.array([band[0] for band in self.bands], dtype=np.float64)
+        self._relative = np.array([band[1] for band in self.bands], dtype=np.float64)
+        self.samples = 0
+        self.values = 0 # channel values acquired
+        self.published = 0 # channel values published
+        self.events = 0 # samples with at least one value published
+
+    def mask(self, batch):
+        # (channels x rows) booleans of the values of batch to publish
+        count = batch.count
+        batch.finalize()
+        values = batch.values[[batch.channels.index(name) for name in self.channels], :count]
+        timestamps = batch.timestamp[:count]
+        heartbeat = int(self.heartbeat*1000000) if self.heartbeat else None
+        mask = np.zeros((len(self.channels), count), dtype=bool)
+        if not count:
+            return mask
+        mask[:, 0] = True
+        reference = np.round(values[:, 0], VALUE_DECIMALS) # as published
+        last = np.full(len(self.channels), timestamps[0])
+        with np.errstate(invalid='ignore'):
+            band = np.maximum(self._absolute, self._relative*np.abs(reference))
+            for row in range(1, count):
+                x = values[:, row]
+                changed = (np.abs(x - reference) > band) | (np.isnan(x) != np.isnan(reference))
+                if heartbeat is not None:
+                    changed |= timestamps[row] - last >= heartbeat
+                if changed.any():
+                    mask[:, row] = changed
+                    reference[changed] = np.round(x[changed], VALUE_DECIMALS)
+                    last[changed] = timestamps[row]
+                    band[changed] = np.maximum(self._absolute[changed], self._relative[changed]*np.abs(reference[changed]))
+        self.samples += count
+        self.values += mask.size
+        self.published += int(mask.sum())
+        self.events += int(mask.any(axis=0).sum())
+        return mask
+
+    def summary(self):
+        return "%d samples, %d of %d values published (%.1f%%) in %d samples with changes" % (
+            self.samples, self.published, self.values, 100.0*self.published/max(self.values, 1), self.events)
+
+
+###########
+# Replay of recorded batch files, or of a synthetic day (python3 TEG_deadband.py)
+#
+# The synthetic day follows the default sweep plan: steady hot side and ambient temperatures
+# overnight, heating in the morning with passing clouds, cooling in the evening, the TEG model of
+# the simulator (Voc = seebeck*dT behind 1.5 ohm) with ADS1015 and MCP9600 quantization and noise,
+# and thermocouples read every 5 s and carried forward with their age.
+
+def load_batch(path):
+    from TEG_batchfile import BatchFile, read_csv_columns
+    from TEG_buffer import SampleBatch
+
+    if path.endswith('.csv'):
+        channels, timestamps, values = read_csv_columns(path)
+    else:
+        data = BatchFile(path)
+        channels, timestamps, values = data.channels, np.asarray(data.timestamps), np.asarray(data.values)
+    batch = SampleBatch(len(timestamps), channels)
+    batch.timestamp[:] = timestamps
+    batch.values[:] = values
+    batch.count = batch.converted = len(timestamps)
+    return batch
+
+
+def synthetic_day(batch_size=1800, period=0.5, seed=0):
+    from datetime import datetime
+    from TEG_buffer import SampleBatch, to_epoch_us
+    from TEG_hardware import ADC_LSB
+    from TEG_sweep import column_mask, default_plan, load_resistance
+
+    rng = np.random.default_rng(seed)
+    columns = default_plan().columns() + ['temperature_age']
+    samples = int(86400/period)
+    start = to_epoch_us(datetime(2021, 6, 1))
+    timestamps = start + (np.arange(samples)*period*1000000).astype(np.int64)
+    hours = np.arange(samples)*period/3600.0
+    sun = np.clip(np.sin(np.pi*(hours - 6)/14), 0, None) # 6:00 to 20:00
+    clouds = np.repeat(rng.uniform(0.6, 1.0, samples//1200 + 1), 1200)[:samples] # 10 minute spells
+    ambient = 22 + 6*sun + 0.2*np.sin(2*np.pi*hours/24)
+    hot = ambient + 8 + 20*sun*clouds
+    hot = np.convolve(np.concatenate([np.full(599, hot[0]), hot]), np.ones(600)/600, mode='valid') # thermal mass, 5 minutes
+    read = (np.arange(samples)*period//5.0*5.0/period).astype(int) # index of the last thermocouple read
+    t_amb = np.round((ambient + rng.normal(0, 0.05, samples))/0.0625)*0.0625
+    t_hot = np.round((hot + rng.normal(0, 0.05, samples))/0.0625)*0.0625
+    voc = 0.02*(hot - ambient)
+    values = np.empty((len(columns), samples))
+    for index, name in enumerate(columns):
+        mask = column_mask(name)
+        if mask is not None:
+            resistance = load_resistance(mask)
+            voltage = voc if resistance is None else voc*resistance/(resistance + 1.5)
+            values[index] = np.round((voltage + rng.normal(0, 0.0003, samples))/ADC_LSB)*ADC_LSB
+    values[columns.index('temperature_amb')] = t_amb[read]
+    values[columns.index('temperature_hot')] = t_hot[read]
+    values[columns.index('temperature_age')] = np.round((np.arange(samples) - read)*period + rng.uniform(0.08, 0.1, samples), 6)
+    batches = []
+    for first in range(0, samples, batch_size):
+        batch = SampleBatch(min(batch_size, samples - first), columns)
+        batch.timestamp[:] = timestamps[first:first + batch.size]
+        batch.values[:] = values[:, first:first + batch.size]
+        batch.count = batch.converted = batch.size
+        batches.append(batch)
+    return batches
+
+
+def check_bounds(deadband, batch, mask):
+    # (largest excess of a held value over its bound, 0 if they hold; longest silence of a channel in seconds)
+    values = batch.values[[batch.channels.index(name) for name in deadband.channels], :batch.count]
+    timestamps = batch.timestamp[:batch.count]
+    excess = 0.0
+    silence = 0.0
+    for c, (absolute, relative) in enumerate(deadband.bands):
+        held = np.round(values[c, np.maximum.accumulate(np.where(mask[c], np.arange(batch.count), 0))], VALUE_DECIMALS)
+        if np.any(np.isnan(held) != np.isnan(values[c])):
+            return np.inf, silence
+        with np.errstate(invalid='ignore'):
+            error = np.abs(values[c] - held) - np.maximum(absolute, relative*np.abs(held))
+        if not np.all(np.isnan(error)):
+            excess = max(excess, float(np.nanmax(error)))
+        published = timestamps[mask[c]]
+        silence = max(silence, float(np.max(np.diff(np.append(published, timestamps[-1]))))/1e6)
+    return excess, silence
+
+
+if __name__ == '__main__':
+    import argparse
+    from TEG_telemetry import change_messages, encode_messages, message_topic, mqtt_packet_size
+
+    parser = argparse.ArgumentParser(description="messages and bytes of change-driven publishing on recorded or synthetic batches")
+    parser.add_argument('--absolute', type=float, default=0.001, help="absolute deadband of the voltages (V)")
+    parser.add_argument('--relative', type=float, default=0.0, help="relative deadband of the voltages")
+    parser.add_argument('--temperature', type=float, default=0.25, help="absolute deadband of the temperatures (C)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT, help="longest silence of a channel (s)")
+    parser.add_argument('--samples-per-message', type=int, default=60)
+    parser.add_argument('files', nargs='*', help="batch files (.csv or .teg) of the day to replay")
+    args = parser.parse_args()
+
+    batches = [load_batch(path) for path in sorted(args.files)] if args.files else synthetic_day()
+    bands = {'voltage_': (args.absolute, args.relative), 'temperature_': (args.temperature, 0.0), 'temperature_age': (5.0, 0.0)}
+    deadband = Deadband(batches[0].channels, bands, heartbeat=args.heartbeat)
+    APP_ID = 'teg_profiler_00'
+    night = lambda batch: (batch.timestamp[0]//3600000000) % 24 < 6
+    totals = dict((key, [0, 0]) for key in ('batch', 'binary', 'changes', 'night batch', 'night changes'))
+    excess = silence = 0.0
+    for batch in batches:
+        mask = deadband.mask(batch)
+        batch_excess, batch_silence = check_bounds(deadband, batch, mask)
+        excess, silence = max(excess, batch_excess), max(silence, batch_silence)
+        for mode in ('batch', 'binary', 'changes'):
+            if mode == 'changes':
+                payloads = list(change_messages(APP_ID, batch, mask, deadband.bands, deadband.heartbeat, args.samples_per_message))
+            else:
+                payloads = list(encode_messages(APP_ID, batch, mode, args.samples_per_message))
+            size = sum(mqtt_packet_size(message_topic(APP_ID, mode), p if isinstance(p, bytes) else p.encode()) for p in payloads)
+            for key in [mode] + (['night '+mode] if night(batch) and mode != 'binary' else []):
+                totals[key][0] += len(payloads)
+                totals[key][1] += size
+
+    print("%d samples in %d batches, %d channels, voltage deadband %g V + %g relative, temperatures %g C, heartbeat %g s" % (
+        deadband.samples, len(batches), len(deadband.channels), args.absolute, args.relative, args.temperature, args.heartbeat))
+    print(deadband.summary())
+    for key in ('batch', 'binary', 'changes', 'night batch', 'night changes'):
+        print("  %-14s %7d messages %11d bytes" % (key, totals[key][0], totals[key][1]))
+    print("changes vs batch: %.1fx fewer messages, %.1fx fewer bytes (0:00-6:00: %.1fx, %.1fx)" % (
+        totals['batch'][0]/float(totals['changes'][0]), totals['batch'][1]/float(totals['changes'][1]),
+        totals['night batch'][0]/float(max(totals['night changes'][0], 1)), totals['night batch'][1]/float(max(totals['night changes'][1], 1))))
+    print("held values within their deadband: %s, longest silence of a channel %.1f s" % ('yes' if excess <= 0 else 'no, exceeded by %g' % excess, silence))
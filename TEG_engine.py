@@ -0,0 +1,330 @@
+################################################
+#
+# TEG profiler acquisition engine
+#
+# University of Virginia
+#
+################################################
+#
+# asyncio engine with three stages connected by bounded queues:
+#
+#   acquisition   the blocking acquisition step of the script (scheduler wait, I2C sweep and
+#                 temperatures, commit) runs in a dedicated executor thread, one call per sample
+#   storage       one coroutine per sink with a queue of full batches; the blocking work of the
+#   network       sink (batch file write, message encoding into the outbox) runs in a small
+#                 thread pool shared by the sinks instead of a new thread per batch
+#
+# When the queue of a sink is full at rollover, the policy of the sink decides:
+#
+#   'block'        the acquisition stage waits for room (backpressure, sampling slots are skipped)
+#   'drop-oldest'  the oldest queued batch is dropped
+#   'drop-newest'  the new batch is dropped
+#   'spill'        the new batch is written to the spill directory of the sink as a binary batch
+#                  file and handed to the sink from there once its queue is empty (also after a
+#                  restart, spilled files are kept until the sink processed them)
+#
+# stop() is checked after every step (GPIO17 button). The engine then takes the partial batch
+# from flush(), hands it to the sinks and waits until every queued and spilled batch is processed.
+#
+#   python3 TEG_engine.py [--period s] [--batch n] [--sink-time s]   compares the policies with a slow sink
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from TEG_batchfile import BatchFile, write_batch_binary
+from TEG_buffer import SampleBatch
+
+
+POLICIES = ('block', 'drop-oldest', 'drop-newest', 'spill')
+SPILL_EXTENSION = '.teg'
+
+
+###########
+# Spilled batches
+
+def load_spilled(path):
+    # spilled batch file as a SampleBatch with converted values, not owned by any buffer pool
+    data = BatchFile(path)
+    batch = SampleBatch(data.rows, data.channels)
+    batch.timestamp[:] = data.timestamps
+    batch.values[:] = data.values
+    batch.count = batch.converted = data.rows
+    return batch
+
+
+class Sink:
+
+    def __init__(self, name, process, depth=2, policy='spill', spill_directory=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown sink policy: "+str(policy))
+        if policy == 'spill' and spill_directory is None:
+            raise ValueError("sink "+name+": the spill policy needs a spill directory")
+        self.name = name
+        self.process = process # blocking function of one batch, called in the sink thread pool
+        self.depth = depth
+        self.policy = policy
+        self.spill_directory = spill_directory
+        if spill_directory is not None and not os.path.exists(spill_directory):
+            os.makedirs(spill_directory)
+        self.queue = None # asyncio.Queue, created on the event loop of the engine
+        self._spills = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.unspilled = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.max_depth = 0
+
+    def spill(self, batch):
+        # whole batch in one write, renamed so a half written file is never picked up
+        self._spills += 1
+        name = '%020d_%06d' % (batch.timestamp[0], self._spills)
+        path = os.path.join(self.spill_directory, name+SPILL_EXTENSION)
+        write_batch_binary(path+'.tmp', batch, None)
+        os.replace(path+'.tmp', path)
+
+    def spilled_files(self):
+        # oldest first
+        if self.spill_directory is None:
+            return []
+        return sorted(os.path.join(self.spill_directory, name) for name in os.listdir(self.spill_directory) if name.endswith(SPILL_EXTENSION))
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'unspilled': self.unspilled,
+            'blocked': self.blocked,
+            'blocked_time': self.blocked_time,
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'max_depth': self.max_depth,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("%s (%s): %d batches processed, %d failed, %d dropped, %d spilled, %d taken back from the spill, blocked %d times for %.2f s, queue max %d/%d" %
+                (self.name, self.policy, stats['processed'], stats['failed'], stats['dropped'], stats['spilled'], stats['unspilled'],
+                 stats['blocked'], stats['blocked_time'], stats['max_depth'], self.depth))
+
+
+###########
+# Engine
+
+class AcquisitionEngine:
+
+    def __init__(self, acquire, stop, flush=None, workers=2, drain_timeout=120.0):
+        self.acquire = acquire # blocking, one sample per call, returns the full batch at rollover or None
+        self.stop = stop # True to shut down
+        self.flush = flush # blocking, returns the partial batch at shutdown or None
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.sinks = []
+        self.steps = 0
+        self.max_dispatch_time = 0.0 # longest time the acquisition stage waited for the sinks at a rollover
+
+    def add_sink(self, name, process, depth=2, policy='spill', spill_directory=None):
+        sink = Sink(name, process, depth, policy, spill_directory)
+        self.sinks.append(sink)
+        return sink
+
+    def run(self):
+        # blocking entry point of the scripts
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        acquisition = ThreadPoolExecutor(max_workers=1, thread_name_prefix='acquisition')
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sink')
+        self._spill_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spill') # spills do not wait behind a slow sink
+        for sink in self.sinks:
+            sink.queue = asyncio.Queue(maxsize=sink.depth)
+        consumers = [asyncio.create_task(self._consume(sink)) for sink in self.sinks]
+        try:
+            while True:
+                batch = await loop.run_in_executor(acquisition, self.acquire)
+                self.steps += 1
+                if batch is not None:
+                    await self._dispatch(batch)
+                if self.stop():
+                    break
+            if self.flush is not None:
+                batch = await loop.run_in_executor(acquisition, self.flush)
+                if batch is not None:
+                    await self._dispatch(batch)
+        finally:
+            for sink in self.sinks:
+                await sink.queue.put(None) # end of the stream, after the batches already queued
+            if consumers:
+                done, pending = await asyncio.wait(consumers, timeout=self.drain_timeout)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    logging.error("[Engine]: sinks not drained after "+str(self.drain_timeout)+" s")
+            acquisition.shutdown()
+            self._spill_pool.shutdown()
+            self._pool.shutdown()
+
+    async def _dispatch(self, batch):
+        # hands a full batch to every sink, each releases its share of the buffer when done
+        start = time.monotonic()
+        for sink in self.sinks:
+            await self._offer(sink, batch)
+        self.max_dispatch_time = max(self.max_dispatch_time, time.monotonic() - start)
+
+    async def _offer(self, sink, batch):
+        queue = sink.queue
+        if not queue.full():
+            queue.put_nowait(batch)
+        elif sink.policy == 'block':
+            sink.blocked += 1
+            start = time.monotonic()
+            await queue.put(batch)
+            sink.blocked_time += time.monotonic() - start
+        elif sink.policy == 'drop-oldest':
+            queue.get_nowait().release()
+            queue.put_nowait(batch)
+            sink.dropped += 1
+            logging.warning("[Engine]: "+sink.name+" queue full, oldest batch dropped")
+        elif sink.policy == 'drop-newest':
+            batch.release()
+            sink.dropped += 1
+            logging.warning("[Engine]: "+sink.name+" queue full, new batch dropped")
+        else:
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._spill_pool, sink.spill, batch)
+                sink.spilled += 1
+            except Exception as e:
+                sink.dropped += 1
+                logging.error("[Engine]: "+sink.name+" queue full and spill failed, batch dropped")
+                logging.error("[Engine]: "+str(e))
+            finally:
+                batch.release()
+        sink.max_depth = max(sink.max_depth, queue.qsize())
+
+    async def _consume(self, sink):
+        while True:
+            if sink.queue.empty():
+                spilled = sink.spilled_files()
+                if spilled:
+                    await self._unspill(sink, spilled[0])
+                    continue
+            batch = await sink.queue.get()
+            if batch is None:
+                for path in sink.spilled_files():
+                    await self._unspill(sink, path)
+                return
+            try:
+                await self._process(sink, batch)
+            finally:
+                batch.release() # hands the buffer back to the acquisition stage
+
+    async def _unspill(self, sink, path):
+        loop = asyncio.get_running_loop()
+        try:
+            batch = await loop.run_in_executor(self._pool, load_spilled, path)
+        except Exception as e:
+            logging.error("[Engine]: spilled batch "+path+" could not be read, removed")
+            logging.error("[Engine]: "+str(e))
+            os.remove(path)
+            return
+        if await self._process(sink, batch):
+            os.remove(path)
+            sink.unspilled += 1
+        else:
+            os.rename(path, path+'.failed') # kept for inspection, not retried forever
+
+    async def _process(self, sink, batch):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._pool, sink.process, batch)
+            sink.processed += 1
+            return True
+        except Exception as e:
+            sink.failed += 1
+            logging.error("[Engine]: "+sink.name+" failed on batch "+str(batch.sequence))
+            logging.error("[Engine]: "+str(e))
+            return False
+
+    def reset_stats(self):
+        self.max_dispatch_time = 0.0
+        for sink in self.sinks:
+            sink.reset_stats()
+
+    def summary(self):
+        return "; ".join(["acquisition waited max %.1f ms at rollover" % (self.max_dispatch_time*1000)] + [sink.summary() for sink in self.sinks])
+
+
+###########
+# Policies with a slow sink (python3 TEG_engine.py)
+#
+# A synthetic acquisition stage fills batches at the given period and a sink that needs
+# sink_time per batch falls behind; the table shows what each policy does with the excess.
+
+def policy_benchmark(policy, period=0.002, batch=50, batches=40, sink_time=0.25, depth=2):
+    import shutil
+    import tempfile
+    from datetime import datetime
+    from TEG_buffer import SampleBuffer
+    from TEG_scheduler import DeadlineScheduler
+
+    spill_directory = tempfile.mkdtemp()
+    sample_buffer = SampleBuffer(batch, ['v%d' % i for i in range(7)], sinks=1)
+    scheduler = DeadlineScheduler(period)
+    stored = []
+
+    def acquire():
+        scheduler.wait()
+        sample_buffer.put(0, 1.0)
+        return sample_buffer.commit(datetime.utcnow())
+
+    def process(full):
+        time.sleep(sink_time)
+        stored.append(full.count)
+
+    engine = AcquisitionEngine(acquire, lambda: engine.steps >= batch*batches)
+    sink = engine.add_sink('slow', process, depth, policy, spill_directory)
+    start = time.monotonic()
+    try:
+        engine.run()
+    finally:
+        shutil.rmtree(spill_directory)
+    stats = scheduler.stats()
+    return {
+        'time': time.monotonic() - start,
+        'stored': len(stored),
+        'dropped': sink.dropped,
+        'spilled': sink.spilled,
+        'skipped': stats['skipped'],
+        'allocated': sample_buffer.allocated,
+        'dispatch': engine.max_dispatch_time,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="sink policies of the acquisition engine with a slow sink")
+    parser.add_argument('--period', type=float, default=0.002, help="sampling period in seconds")
+    parser.add_argument('--batch', type=int, default=50, help="samples per batch")
+    parser.add_argument('--batches', type=int, default=40, help="batches acquired")
+    parser.add_argument('--sink-time', type=float, default=0.25, help="seconds the sink needs per batch")
+    parser.add_argument('--depth', type=int, default=2, help="queue depth of the sink")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR) # no warning per dropped batch
+
+    print("%d batches of %d samples every %.1f ms, sink %.0f ms per batch, queue depth %d" %
+          (args.batches, args.batch, args.period*1000, args.sink_time*1000, args.depth))
+    print("%-12s %8s %8s %8s %8s %10s %14s %10s" % ('policy', 'stored', 'dropped', 'spilled', 'skipped', 'buffers', 'max wait (ms)', 'time (s)'))
+    for policy in POLICIES:
+        result = policy_benchmark(policy, args.period, args.batch, args.batches, args.sink_time, args.depth)
+        print("%-12s %8d %8d %8d %8d %10d %14.1f %10.2f" % (policy, result['stored'], result['dropped'], result['spilled'],
+                                                            result['skipped'], result['allocated'], result['dispatch']*1000, result['time']))
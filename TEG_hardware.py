@@ -0,0 +1,837 @@
+################################################
+#
+# TEG profiler hardware abstraction layer
+#
+# University of Virginia
+#
+################################################
+#
+# open_hardware(backend) returns the devices used by the acquisition loop:
+#
+#   hw.i2c     I2C bus (busio API: writeto, readfrom_into, writeto_then_readfrom; the 'sim' and
+#              'i2cdev' buses also have transfer(), several messages in one combined transaction)
+#   hw.pca     PCA9536 GPIO controller at 0x41 driving the load switches (I2CDevice API: write)
+#   hw.ads     ADS1015 analog to digital converter at 0x48 (gain, mode, data_rate)
+#   hw.chan    ADS1015 channel 0 (voltage, value), continuous mode
+#   hw.adc     ADS1015 channel 0 through the single-shot register-level reader below (voltage, value)
+#   hw.mcp     MCP9600 thermocouple amplifier at 0x60 (get_hot/cold_junction_temperature, and
+#              read_junctions() for both in one transaction on the 'i2cdev' backend)
+#   hw.button  GPIO17 stop button (value is False while pressed)
+#
+# Backends:
+#
+#   'board'  real Adafruit/Pimoroni drivers on the Raspberry Pi
+#   'i2cdev' register-level drivers on /dev/i2c-1 through the Linux I2C_RDWR ioctl, without the
+#            Adafruit/Pimoroni I2C stack. Reads that need a register pointer write and the ADS1015
+#            ready poll + conversion read, or the two MCP9600 junction reads, are combined into one
+#            ioctl each (16 instead of 22 transactions per sweep + temperatures). No hw.ads/hw.chan.
+#   'sim'    simulated PCA9536 + ADS1015 + MCP9600 on a simulated I2C bus, with per-transaction
+#            latency, ADC noise, a TEG I-V model keyed on the PCA switch mask and fault injection.
+#            Options can be passed as keyword arguments or as a JSON object in TEG_SIM_OPTIONS;
+#            combined=true uses the combined transactions of the 'i2cdev' backend.
+#
+# hw.chan and hw.adc drive the same converter: hw.chan leaves it in continuous mode and returns the
+# most recent conversion, hw.adc starts one conversion per read and polls for its end, so its values
+# are always converted during the read. Use one or the other in a loop, not both.
+
+import ctypes
+import errno
+import fcntl
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+
+ADS1015_ADDRESS = 0x48
+PCA9536_ADDRESS = 0x41
+MCP9600_ADDRESS = 0x60
+
+LOAD_RESISTANCES = (0.1, 0.47, 1.5, 4.7) # ohms, switched by PCA9536 outputs 0 to 3
+
+ADC_GAIN = 8 # PGA gain, range of +-0.512V
+ADC_DATA_RATE = 3300 # samples per second of the single-shot reader (128, 250, 490, 920, 1600, 2400 or 3300)
+
+
+class Hardware:
+
+    def __init__(self, backend, i2c, pca, ads, chan, mcp, button, adc=None):
+        self.backend = backend
+        self.i2c = i2c
+        self.pca = pca
+        self.ads = ads
+        self.chan = chan
+        self.mcp = mcp
+        self.button = button
+        self.adc = adc
+
+
+def open_hardware(backend='board', **options):
+    if backend == 'board':
+        return open_board_hardware()
+    if backend == 'i2cdev':
+        return open_i2cdev_hardware(**options)
+    if backend == 'sim':
+        env_options = os.environ.get('TEG_SIM_OPTIONS')
+        if env_options:
+            options = dict(json.loads(env_options), **options)
+        return open_sim_hardware(**options)
+    raise ValueError("unknown hardware backend: "+str(backend))
+
+
+###########
+# Real hardware (Raspberry Pi)
+
+def open_board_hardware():
+    import board
+    import digitalio
+    import adafruit_ads1x15.ads1015 as ADS
+    from adafruit_ads1x15.analog_in import AnalogIn
+    from adafruit_bus_device.i2c_device import I2CDevice
+    import mcp9600
+
+    i2c = pca = ads = chan = adc = mcp = None
+
+    try:
+        i2c = board.I2C()
+        logging.info("[I2C]: raspberry pi board I2C interface was sucesfully initialized")
+    except Exception as e:
+        logging.error("[I2C]: raspberry pi board I2C interface initialization error")
+        logging.error("[I2C]: "+str(e))
+
+    try:
+        pca = I2CDevice(i2c, PCA9536_ADDRESS) # creates the PCA GPIO controller at address 0x41
+        pca.write(bytes([0x03,0x00]))# configure GPIO as output
+        logging.info("[I2C]: PCA GPIO controller was sucesfully initialized and configured")
+    except Exception as e:
+        logging.error("[I2C]: PCA GPIO controller initialization error")
+        logging.error("[I2C]: "+str(e))
+
+    try:
+        ads = ADS.ADS1015(i2c) # creates the ADS analog to digital converter at default address (0x48)
+        ads.gain = 8 # configures PGA gain to 8, resulting on range of +-0.512V (valid configurations: 2/3, 1, 2, 4, 8, 16)
+        ads.mode = ADS.Mode.CONTINUOUS # converts at max speed, reads most recent conversion through I2C
+        chan = AnalogIn(ads, ADS.P0) # configures ADS to read analog values from channel 0
+        adc = ADS1015Reader(i2c, pin=0, gain=ADC_GAIN, data_rate=ADC_DATA_RATE) # single-shot conversions on channel 0
+        logging.info("[I2C]: ADS analog to digital converter was sucesfully initialized and configured")
+    except Exception as e:
+        logging.error("[I2C]: ADS analog to digital converter initialization error")
+        logging.error("[I2C]: "+str(e))
+
+    try:
+        mcp = mcp9600.MCP9600(i2c_addr=MCP9600_ADDRESS) # creates the MCP thermocouple amplifier at address 0x60, default config for K-type thermocouple
+        logging.info("[I2C]: MCP thermocouple amplifier was sucesfully initialized and configured")
+    except Exception as e:
+        logging.error("[I2C]: MCP thermocouple amplifier initialization error")
+        logging.error("[I2C]: "+str(e))
+
+    # Configuring interruption button on GPIO 17 (hold for 1 SAMPLE_PERIOD to stop)
+    button = digitalio.DigitalInOut(board.D17)
+    button.direction = digitalio.Direction.INPUT
+
+    return Hardware('board', i2c, pca, ads, chan, mcp, button, adc)
+
+
+###########
+# Linux i2c-dev bus
+
+I2C_RDWR = 0x0707 # ioctl: combined transaction of several messages, repeated start between them
+I2C_M_RD = 0x0001 # message flag: read from the target
+
+
+class i2c_msg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16), ('flags', ctypes.c_uint16), ('len', ctypes.c_uint16), ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(i2c_msg)), ('nmsgs', ctypes.c_uint32)]
+
+
+class I2CDevBus:
+    # busio.I2C compatible bus on /dev/i2c-<bus>. Every call is one I2C_RDWR ioctl (one system
+    # call); transfer() sends a list of (address, flags, buffer) messages in a single ioctl, reads
+    # (flags I2C_M_RD) fill their bytearray. A NACK raises OSError EREMOTEIO like busio.
+
+    def __init__(self, bus=1):
+        self.fd = os.open('/dev/i2c-'+str(bus), os.O_RDWR)
+        self.transactions = 0 # ioctls
+        self.faults = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        os.close(self.fd)
+
+    def try_lock(self):
+        return self._lock.acquire(False)
+
+    def unlock(self):
+        self._lock.release()
+
+    def transfer(self, messages):
+        msgs = (i2c_msg*len(messages))()
+        buffers = []
+        for msg, (address, flags, buffer) in zip(msgs, messages):
+            data = (ctypes.c_uint8*len(buffer)).from_buffer_copy(bytes(buffer)) if not flags & I2C_M_RD else (ctypes.c_uint8*len(buffer))()
+            buffers.append(data)
+            msg.addr = address
+            msg.flags = flags
+            msg.len = len(buffer)
+            msg.buf = ctypes.cast(data, ctypes.POINTER(ctypes.c_uint8))
+        request = i2c_rdwr_ioctl_data(msgs, len(messages))
+        self.transactions += 1
+        try:
+            fcntl.ioctl(self.fd, I2C_RDWR, request)
+        except OSError:
+            self.faults += 1
+            raise
+        for (address, flags, buffer), data in zip(messages, buffers):
+            if flags & I2C_M_RD:
+                buffer[:] = bytes(data)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.transfer([(address, 0, bytes(buffer[start:end]))])
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        end = len(buffer) if end is None else end
+        data = bytearray(end - start)
+        self.transfer([(address, I2C_M_RD, data)])
+        buffer[start:end] = data
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        in_end = len(buffer_in) if in_end is None else in_end
+        data = bytearray(in_end - in_start)
+        self.transfer([(address, 0, bytes(buffer_out[out_start:out_end])), (address, I2C_M_RD, data)])
+        buffer_in[in_start:in_end] = data
+
+    def scan(self):
+        found = []
+        for address in range(0x08, 0x78):
+            try:
+                self.transfer([(address, I2C_M_RD, bytearray(1))])
+                found.append(address)
+            except OSError:
+                pass
+        return found
+
+
+def open_i2cdev_hardware(bus=1):
+    i2c = I2CDevBus(bus) # I2C errors are left to the caller: without the bus there is nothing to acquire
+    logging.info("[I2C]: /dev/i2c-"+str(bus)+" was sucesfully opened")
+
+    pca = None
+    try:
+        pca = I2CDevice(i2c, PCA9536_ADDRESS)
+        pca.write(bytes([0x03,0x00])) # configure GPIO as output
+        logging.info("[I2C]: PCA GPIO controller was sucesfully initialized and configured")
+    except Exception as e:
+        logging.error("[I2C]: PCA GPIO controller initialization error")
+        logging.error("[I2C]: "+str(e))
+
+    adc = ADS1015Reader(i2c, pin=0, gain=ADC_GAIN, data_rate=ADC_DATA_RATE, combined=True)
+    mcp = MCP9600Reader(i2c, MCP9600_ADDRESS, combined=True)
+
+    import board
+    import digitalio
+
+    # Configuring interruption button on GPIO 17 (hold for 1 SAMPLE_PERIOD to stop)
+    button = digitalio.DigitalInOut(board.D17)
+    button.direction = digitalio.Direction.INPUT
+
+    return Hardware('i2cdev', i2c, pca, None, None, mcp, button, adc)
+
+
+###########
+# Register-level drivers on hw.i2c
+
+class I2CDevice:
+    # adafruit_bus_device.i2c_device.I2CDevice API on any of the buses above (hw.pca of the 'sim' and 'i2cdev' backends)
+
+    def __init__(self, i2c, address):
+        self.i2c = i2c
+        self.device_address = address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, buf, *, start=0, end=None):
+        self.i2c.writeto(self.device_address, buf, start=start, end=end)
+
+    def readinto(self, buf, *, start=0, end=None):
+        self.i2c.readfrom_into(self.device_address, buf, start=start, end=end)
+
+    def write_then_readinto(self, out_buffer, in_buffer, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        self.i2c.writeto_then_readfrom(self.device_address, out_buffer, in_buffer, out_start=out_start, out_end=out_end, in_start=in_start, in_end=in_end)
+
+
+
+# ADS1015 single-shot reader. Every read writes the config register with the OS bit set, which
+# starts one conversion at the configured data rate, polls the OS bit of the config register until
+# the conversion is done and reads the conversion register:
+#
+#   start      1 transaction (3 bytes)
+#   poll       1 transaction per poll (pointer write + 2 byte read), first poll after 90% of the
+#              nominal conversion time (1/data_rate, internal oscillator within +-10%)
+#   read       1 transaction (pointer write + 2 byte read)
+#
+# With combined=True (bus with transfer()) every poll also reads the conversion register in the
+# same transaction, and the first poll that finds the conversion done has the result already.
+#
+# At 3300 SPS a conversion takes about 0.3 ms, less than a 100 kHz I2C transaction, so the first
+# poll usually finds it done.
+
+ADS1015_CONVERSION = 0x00
+ADS1015_CONFIG = 0x01
+
+ADS1015_GAINS = {2/3: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+ADS1015_FULL_SCALE = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+ADS1015_DATA_RATES = {128: 0, 250: 1, 490: 2, 920: 3, 1600: 4, 2400: 5, 3300: 6}
+ADC_LSB = ADS1015_FULL_SCALE[ADC_GAIN]/2048 # volts per code of hw.adc
+
+
+class ADS1015Reader:
+
+    def __init__(self, i2c, address=ADS1015_ADDRESS, pin=0, gain=ADC_GAIN, data_rate=ADC_DATA_RATE, max_polls=50, combined=False):
+        if gain not in ADS1015_GAINS:
+            raise ValueError("Gain must be one of: "+str(list(ADS1015_GAINS)))
+        if data_rate not in ADS1015_DATA_RATES:
+            raise ValueError("Data rate must be one of: "+str(list(ADS1015_DATA_RATES)))
+        self.i2c = i2c
+        self.address = address
+        self.pin = pin
+        self.gain = gain
+        self.data_rate = data_rate
+        self.max_polls = max_polls
+        self.combined = combined
+        self.conversion_time = 1.0/data_rate
+        self.lsb = ADS1015_FULL_SCALE[gain]/2048 # volts per code
+        # OS = 1 (start), MUX = AINpin vs GND, PGA, MODE = 1 (single-shot), DR, comparator disabled
+        config = 0x8000 | ((pin + 4) << 12) | (ADS1015_GAINS[gain] << 9) | 0x0100 | (ADS1015_DATA_RATES[data_rate] << 5) | 0x0003
+        self._start = bytes([ADS1015_CONFIG, config >> 8, config & 0xFF])
+        self._config_pointer = bytes([ADS1015_CONFIG])
+        self._conversion_pointer = bytes([ADS1015_CONVERSION])
+        self._buf = bytearray(2)
+        self._config = bytearray(2)
+        self._poll_read = [(address, 0, self._config_pointer), (address, I2C_M_RD, self._config),
+                           (address, 0, self._conversion_pointer), (address, I2C_M_RD, self._buf)]
+        self.conversions = 0
+        self.polls = 0
+
+    def start(self):
+        self.i2c.writeto(self.address, self._start)
+
+    def ready(self):
+        self.polls += 1
+        self.i2c.writeto_then_readfrom(self.address, self._config_pointer, self._buf)
+        return bool(self._buf[0] & 0x80)
+
+    def ready_and_read(self):
+        # config and conversion register in one combined transaction
+        self.polls += 1
+        self.i2c.transfer(self._poll_read)
+        return bool(self._config[0] & 0x80)
+
+    def read_raw(self):
+        # signed 12 bit code of the last conversion
+        self.i2c.writeto_then_readfrom(self.address, self._conversion_pointer, self._buf)
+        return self.code()
+
+    def code(self):
+        code = (self._buf[0] << 4) | (self._buf[1] >> 4)
+        return code - 0x1000 if code & 0x0800 else code
+
+    def read(self):
+        # starts a conversion, waits for it to finish and returns its signed 12 bit code
+        self.start()
+        time.sleep(0.9*self.conversion_time)
+        ready = self.ready_and_read if self.combined else self.ready
+        polls = 0
+        while not ready():
+            polls += 1
+            if polls >= self.max_polls:
+                raise OSError(errno.ETIMEDOUT, "ADS1015 conversion not ready after "+str(polls)+" polls")
+        self.conversions += 1
+        if self.combined:
+            return self.code()
+        return self.read_raw()
+
+    @property
+    def value(self):
+        return self.read() << 4
+
+    @property
+    def voltage(self):
+        return self.read()*self.lsb
+
+
+# MCP9600 register reader (same interface as the Pimoroni driver). With combined=True,
+# read_junctions() reads the cold and hot junction registers in one transaction.
+
+class MCP9600Reader:
+
+    def __init__(self, i2c, address=MCP9600_ADDRESS, combined=False):
+        self.i2c = i2c
+        self.address = address
+        self.combined = combined
+        self._hot = bytearray(2)
+        self._cold = bytearray(2)
+        self._junctions = [(address, 0, bytes([0x02])), (address, I2C_M_RD, self._cold),
+                           (address, 0, bytes([0x00])), (address, I2C_M_RD, self._hot)]
+
+    @staticmethod
+    def temperature(buf):
+        value = buf[0] << 8 | buf[1]
+        if value & 0x8000:
+            value -= 0x10000
+        return value*0.0625
+
+    def _read_temperature(self, register, buf):
+        self.i2c.writeto_then_readfrom(self.address, bytes([register]), buf)
+        return self.temperature(buf)
+
+    def get_hot_junction_temperature(self):
+        return self._read_temperature(0x00, self._hot)
+
+    def get_cold_junction_temperature(self):
+        return self._read_temperature(0x02, self._cold)
+
+    def read_junctions(self):
+        # (cold, hot) junction temperatures
+        if not self.combined:
+            return self.get_cold_junction_temperature(), self.get_hot_junction_temperature()
+        self.i2c.transfer(self._junctions)
+        return self.temperature(self._cold), self.temperature(self._hot)
+
+
+###########
+# Simulated hardware
+
+def open_sim_hardware(latency=0.0003, noise=0.0003, fault_rate=0.0, missing=(), seed=None,
+                      t_hot=45.0, t_amb=25.0, thermal_period=0.0, thermal_swing=0.0,
+                      seebeck=0.02, r_internal=1.5, r_switch=0.02, settle_tau=0.0005,
+                      mcp_conversion_time=0.08, duration=None, combined=False):
+    rng = random.Random(seed)
+    thermal = SimThermal(t_hot, t_amb, thermal_period, thermal_swing)
+    teg = SimTEG(thermal, seebeck, r_internal, r_switch, settle_tau)
+
+    i2c = SimI2CBus(latency, fault_rate, rng)
+    i2c.attach(PCA9536_ADDRESS, SimPCA9536(teg))
+    i2c.attach(ADS1015_ADDRESS, SimADS1015(teg, noise, rng))
+    i2c.attach(MCP9600_ADDRESS, SimMCP9600(thermal, mcp_conversion_time, rng))
+    for address in missing:
+        i2c.missing.add(address)
+
+    pca = I2CDevice(i2c, PCA9536_ADDRESS)
+    pca.write(bytes([0x03,0x00])) # configure GPIO as output
+    ads = SimADS1015Driver(i2c)
+    ads.gain = 8
+    ads.mode = SimADS1015Driver.CONTINUOUS
+    chan = SimAnalogIn(ads, 0)
+    adc = ADS1015Reader(i2c, pin=0, gain=ADC_GAIN, data_rate=ADC_DATA_RATE, combined=combined)
+    mcp = MCP9600Reader(i2c, MCP9600_ADDRESS, combined=True) if combined else SimMCP9600Driver(i2c, MCP9600_ADDRESS)
+    button = SimButton(duration)
+
+    logging.info("[I2C]: simulated I2C devices initialized")
+    return Hardware('sim', i2c, pca, ads, chan, mcp, button, adc)
+
+
+class SimThermal:
+    # hot side and ambient temperatures, optionally swinging sinusoidally with the given period (s)
+
+    def __init__(self, t_hot, t_amb, period=0.0, swing=0.0):
+        self.t_hot = t_hot
+        self.t_amb = t_amb
+        self.period = period
+        self.swing = swing
+        self.start = time.monotonic()
+
+    def hot(self, t):
+        if self.period > 0:
+            return self.t_hot + self.swing*math.sin(2*math.pi*(t - self.start)/self.period)
+        return self.t_hot
+
+    def ambient(self, t):
+        return self.t_amb
+
+
+class SimTEG:
+    # Linear TEG model: open circuit voltage Voc = seebeck*(T_hot - T_amb) behind an internal
+    # resistance, loaded by the parallel combination of the switched load resistors. After every
+    # switch the output settles exponentially towards the new operating point.
+
+    def __init__(self, thermal, seebeck, r_internal, r_switch, settle_tau):
+        self.thermal = thermal
+        self.seebeck = seebeck
+        self.r_internal = r_internal
+        self.r_switch = r_switch
+        self.settle_tau = settle_tau
+        self.mask = 0x00
+        self.switched_at = time.monotonic()
+        self.previous = self.steady_voltage(0x00, self.switched_at)
+
+    def load_resistance(self, mask):
+        conductance = sum(1.0/(r + self.r_switch) for i, r in enumerate(LOAD_RESISTANCES) if mask & (1 << i))
+        return 1.0/conductance if conductance else math.inf
+
+    def steady_voltage(self, mask, t):
+        voc = self.seebeck*(self.thermal.hot(t) - self.thermal.ambient(t))
+        r_load = self.load_resistance(mask)
+        if math.isinf(r_load):
+            return voc
+        return voc*r_load/(r_load + self.r_internal)
+
+    def switch(self, mask, t):
+        if mask != self.mask:
+            self.previous = self.voltage(t)
+            self.mask = mask
+            self.switched_at = t
+
+    def voltage(self, t):
+        target = self.steady_voltage(self.mask, t)
+        if self.settle_tau <= 0:
+            return target
+        return target + (self.previous - target)*math.exp(-(t - self.switched_at)/self.settle_tau)
+
+
+class SimI2CBus:
+    # busio.I2C compatible bus. Every transaction costs `latency` seconds and fails with
+    # EREMOTEIO (like a NACK on the Raspberry Pi) with probability `fault_rate`, when the
+    # target is in `missing` or while fail_next() faults are pending.
+
+    def __init__(self, latency=0.0003, fault_rate=0.0, rng=None):
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.rng = rng or random.Random()
+        self.devices = {}
+        self.missing = set()
+        self.transactions = 0
+        self.faults = 0
+        self._pending_faults = []
+        self._lock = threading.Lock()
+
+    def attach(self, address, device):
+        self.devices[address] = device
+
+    def fail_next(self, count=1, address=None):
+        # injects `count` failures on the next transactions (to `address` only if given)
+        self._pending_faults.extend([address]*count)
+
+    def try_lock(self):
+        return self._lock.acquire(False)
+
+    def unlock(self):
+        self._lock.release()
+
+    def scan(self):
+        return sorted(a for a in self.devices if a not in self.missing)
+
+    def _transaction(self, address):
+        self.transactions += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        fault = address in self.missing or address not in self.devices
+        if self._pending_faults and self._pending_faults[0] in (None, address):
+            self._pending_faults.pop(0)
+            fault = True
+        if self.fault_rate > 0 and self.rng.random() < self.fault_rate:
+            fault = True
+        if fault:
+            self.faults += 1
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        return self.devices[address]
+
+    def transfer(self, messages):
+        # combined transaction of (address, flags, buffer) messages, one latency and fault draw for the whole set
+        devices = [self._transaction(messages[0][0])] + [self.devices.get(address) for address, flags, buffer in messages[1:]]
+        if any(device is None or address in self.missing for device, (address, flags, buffer) in zip(devices, messages)):
+            self.faults += 1
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        now = time.monotonic()
+        for device, (address, flags, buffer) in zip(devices, messages):
+            if flags & I2C_M_RD:
+                buffer[:] = device.read(len(buffer), now)
+            else:
+                device.write(bytes(buffer), now)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        device = self._transaction(address)
+        device.write(bytes(buffer[start:end]), time.monotonic())
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        device = self._transaction(address)
+        end = len(buffer) if end is None else end
+        buffer[start:end] = device.read(end - start, time.monotonic())
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        device = self._transaction(address)
+        now = time.monotonic()
+        device.write(bytes(buffer_out[out_start:out_end]), now)
+        in_end = len(buffer_in) if in_end is None else in_end
+        buffer_in[in_start:in_end] = device.read(in_end - in_start, now)
+
+
+class SimRegisterDevice:
+    # register pointer device: the first byte written selects the register, following bytes are written to it
+
+    width = 1
+
+    def __init__(self):
+        self.pointer = 0
+
+    def write(self, data, t):
+        if not data:
+            return
+        self.pointer = data[0]
+        if len(data) > 1:
+            self.write_register(self.pointer, int.from_bytes(data[1:1 + self.width], 'big'), t)
+
+    def read(self, n, t):
+        value = self.read_register(self.pointer, t) & ((1 << 8*self.width) - 1)
+        data = value.to_bytes(self.width, 'big')
+        return (data*(n//self.width + 1))[:n]
+
+
+class SimPCA9536(SimRegisterDevice):
+    # registers: 0 input port, 1 output port, 2 polarity inversion, 3 configuration (1 = input)
+
+    def __init__(self, teg):
+        SimRegisterDevice.__init__(self)
+        self.teg = teg
+        self.registers = [0x00, 0xFF, 0x00, 0xFF]
+
+    def outputs(self):
+        return self.registers[1] & ~self.registers[3] & 0x0F
+
+    def write_register(self, register, value, t):
+        if register in (1, 2, 3):
+            self.registers[register] = value
+            self.teg.switch(self.outputs(), t)
+
+    def read_register(self, register, t):
+        if register == 0:
+            return self.outputs() ^ self.registers[2]
+        return self.registers[register & 0x03]
+
+
+class SimADS1015(SimRegisterDevice):
+    # registers: 0 conversion (12 bit result, left aligned), 1 config, 2 low threshold, 3 high threshold
+
+    width = 2
+    FULL_SCALE = (6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256) # by PGA setting
+    DATA_RATES = (128, 250, 490, 920, 1600, 2400, 3300, 3300) # by DR setting, samples per second
+
+    def __init__(self, teg, noise, rng):
+        SimRegisterDevice.__init__(self)
+        self.teg = teg
+        self.noise = noise
+        self.rng = rng
+        self.config = 0x0583 # power-on default without the OS bit (idle, single-shot)
+        self.lo_thresh = 0x8000
+        self.hi_thresh = 0x7FFF
+        self.conversion = 0
+        self.started = time.monotonic() # start of the current conversion (single-shot) or conversion train (continuous)
+        self.busy = False
+        self._last_index = -1
+
+    def period(self):
+        return 1.0/self.DATA_RATES[(self.config >> 5) & 0x07]
+
+    def continuous(self):
+        return not (self.config & 0x0100)
+
+    def convert(self, t):
+        # converts the input at time t into a left aligned 12 bit code
+        mux = (self.config >> 12) & 0x07
+        volts = self.teg.voltage(t) if mux in (0, 4) else 0.0 # only AIN0 is wired to the TEG
+        if self.noise > 0:
+            volts += self.rng.gauss(0.0, self.noise)
+        full_scale = self.FULL_SCALE[(self.config >> 9) & 0x07]
+        code = max(-2048, min(2047, int(round(volts/full_scale*2048))))
+        return (code << 4) & 0xFFFF
+
+    def update(self, t):
+        period = self.period()
+        if self.continuous():
+            index = int((t - self.started)/period)
+            if index > 0 and index != self._last_index:
+                self._last_index = index
+                self.conversion = self.convert(self.started + (index - 0.5)*period)
+        elif self.busy and t >= self.started + period:
+            self.busy = False
+            self.conversion = self.convert(self.started + 0.5*period)
+
+    def write_register(self, register, value, t):
+        self.update(t)
+        if register == 1:
+            self.config = value & 0x7FFF
+            self.started = t
+            self._last_index = 0
+            if not self.continuous() and value & 0x8000:
+                self.busy = True
+        elif register == 2:
+            self.lo_thresh = value
+        elif register == 3:
+            self.hi_thresh = value
+
+    def read_register(self, register, t):
+        self.update(t)
+        if register == 0:
+            return self.conversion
+        if register == 1:
+            return self.config | (0x0000 if self.busy else 0x8000)
+        if register == 2:
+            return self.lo_thresh
+        return self.hi_thresh
+
+
+class SimMCP9600(SimRegisterDevice):
+    # registers: 0 hot junction, 1 junction delta, 2 cold junction (0.0625 C/LSB, two's complement), 0x20 device ID
+
+    width = 2
+
+    def __init__(self, thermal, conversion_time, rng):
+        SimRegisterDevice.__init__(self)
+        self.thermal = thermal
+        self.conversion_time = conversion_time
+        self.rng = rng
+        self.updated = None
+        self.hot = self.cold = 0
+
+    def update(self, t):
+        if self.updated is None or t - self.updated >= self.conversion_time:
+            self.updated = t
+            self.hot = int(round((self.thermal.hot(t) + self.rng.gauss(0.0, 0.05))/0.0625))
+            self.cold = int(round((self.thermal.ambient(t) + self.rng.gauss(0.0, 0.05))/0.0625))
+
+    def write_register(self, register, value, t):
+        pass
+
+    def read_register(self, register, t):
+        self.update(t)
+        if register == 0x00:
+            return self.hot
+        if register == 0x01:
+            return self.hot - self.cold
+        if register == 0x02:
+            return self.cold
+        if register == 0x20:
+            return 0x4011
+        return 0
+
+
+###########
+# Simulated drivers (same interfaces as the Adafruit/Pimoroni drivers used by the scripts)
+
+class SimADS1015Driver:
+    # adafruit_ads1x15.ads1015.ADS1015
+
+    CONTINUOUS = 0x0000
+    SINGLE = 0x0100
+    GAINS = {2/3: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+    RATES = {128: 0, 250: 1, 490: 2, 920: 3, 1600: 4, 2400: 5, 3300: 6}
+
+    def __init__(self, i2c, address=ADS1015_ADDRESS):
+        self.i2c_device = I2CDevice(i2c, address)
+        self._gain = 1
+        self.data_rate = 1600
+        self.mode = self.SINGLE
+        self._last_pin_read = None
+        self._buf = bytearray(3)
+
+    @property
+    def gain(self):
+        return self._gain
+
+    @gain.setter
+    def gain(self, gain):
+        if gain not in self.GAINS:
+            raise ValueError("Gain must be one of: "+str(list(self.GAINS)))
+        self._gain = gain
+        self._last_pin_read = None
+
+    def read(self, pin):
+        # raw 12 bit conversion result of single ended input `pin`
+        if self.mode == self.CONTINUOUS and self._last_pin_read == pin:
+            return self._conversion_value()
+        self._last_pin_read = pin
+        config = 0x8000 | ((pin + 4) << 12) | (self.GAINS[self._gain] << 9) | self.mode | (self.RATES[self.data_rate] << 5) | 0x0003
+        self._buf[0] = 0x01
+        self._buf[1] = config >> 8
+        self._buf[2] = config & 0xFF
+        self.i2c_device.write(self._buf)
+        if self.mode == self.SINGLE:
+            while not self._conversion_complete():
+                pass
+        else:
+            time.sleep(2/self.data_rate) # first conversion of the new configuration
+        return self._conversion_value()
+
+    def _read_register(self, register):
+        self._buf[0] = register
+        self.i2c_device.write_then_readinto(self._buf, self._buf, out_end=1, in_end=2)
+        return self._buf[0] << 8 | self._buf[1]
+
+    def _conversion_complete(self):
+        return self._read_register(0x01) & 0x8000
+
+    def _conversion_value(self):
+        value = self._read_register(0x00) >> 4
+        return value - 0x1000 if value & 0x0800 else value
+
+
+class SimAnalogIn:
+    # adafruit_ads1x15.analog_in.AnalogIn
+
+    FULL_SCALE = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+    def __init__(self, ads, pin):
+        self._ads = ads
+        self._pin = pin
+
+    @property
+    def value(self):
+        return self._ads.read(self._pin) << 4
+
+    @property
+    def voltage(self):
+        return self._ads.read(self._pin)*self.FULL_SCALE[self._ads.gain]/2048
+
+
+class SimMCP9600Driver:
+    # Pimoroni mcp9600.MCP9600
+
+    def __init__(self, i2c, i2c_addr=MCP9600_ADDRESS):
+        self.i2c_device = I2CDevice(i2c, i2c_addr)
+        self._buf = bytearray(2)
+
+    def _read_temperature(self, register):
+        self.i2c_device.write_then_readinto(bytes([register]), self._buf)
+        value = self._buf[0] << 8 | self._buf[1]
+        if value & 0x8000:
+            value -= 0x10000
+        return value*0.0625
+
+    def get_hot_junction_temperature(self):
+        return self._read_temperature(0x00)
+
+    def get_cold_junction_temperature(self):
+        return self._read_temperature(0x02)
+
+    def get_temperature_delta(self):
+        return self._read_temperature(0x01)
+
+
+class SimButton:
+    # GPIO17 button, reads as pressed (False) once `duration` seconds have passed
+
+    def __init__(self, duration=None):
+        self.deadline = None if duration is None else time.monotonic() + duration
+
+    @property
+    def value(self):
+        return self.deadline is None or time.monotonic() < self.deadline
@@ -0,0 +1,160 @@
+################################################
+#
+# TEG profiler MQTT session
+#
+# University of Virginia
+#
+################################################
+
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+
+###########
+# Persistent MQTT session
+#
+# One long-lived client per process. paho's network thread (loop_start) keeps the connection up and
+# reconnects with exponential backoff (reconnect_delay_set), and a publisher thread drains an
+# in-process queue into the client whenever it is connected. publish() never blocks: messages wait
+# in the queue while the broker is unreachable and are dropped only when the queue is full.
+
+class MQTTSession:
+
+    def __init__(self, client_id, broker_address, port=1883, keepalive=60, queue_size=10000,
+                 min_delay=1, max_delay=120, publish_interval=0.0):
+        self.broker_address = broker_address
+        self.port = port
+        self.keepalive = keepalive
+        self.publish_interval = publish_interval # optional pause between messages, in seconds
+
+        self.client = mqtt.Client(client_id) # Creates a new MQTT client instance
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=min_delay, max_delay=max_delay)
+
+        self.connected = threading.Event()
+        self.queue = queue.Queue(queue_size)
+        self.connect_messages = [] # (topic, payload, qos, retain) published again on every connect
+        self._stopping = False
+        self._thread = threading.Thread(target=self._publisher, name='mqtt-publisher', daemon=True)
+
+        self.connects = 0
+        self.disconnects = 0
+        self.published = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self.last_reconnect_latency = None # seconds between losing the connection and getting it back
+        self.max_reconnect_latency = 0.0
+        self._disconnected_at = time.monotonic()
+
+    def start(self):
+        self.client.connect_async(self.broker_address, self.port, self.keepalive) # Connects to MQTT broker from the network thread
+        self.client.loop_start()
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        # waits up to `timeout` seconds for queued messages to go out, then disconnects
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stopping = True
+        self.queue.put(None)
+        self._thread.join(max(deadline - time.monotonic(), 0.1))
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    ###########
+    # Callbacks (network thread)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            now = time.monotonic()
+            if self.connects:
+                self.last_reconnect_latency = now - self._disconnected_at
+                self.max_reconnect_latency = max(self.max_reconnect_latency, self.last_reconnect_latency)
+                logging.info("[MQTT]: Reconnected after %.1f s at %s" % (self.last_reconnect_latency, datetime.utcnow().isoformat()))
+            else:
+                logging.info("[MQTT]: Successfully connected at "+str(datetime.utcnow().isoformat()))
+            self.connects += 1
+            self.connected.set()
+            for message in self.connect_messages:
+                self.publish(*message)
+            print("Successfully connected")
+        else:
+            print("Bad connection, returned code = ", rc)
+            logging.error("[MQTT]: Bad connection, returned code = "+str(rc)+" at "+str(datetime.utcnow().isoformat()))
+
+    def on_disconnect(self, client, userdata, rc=0):
+        if self.connected.is_set():
+            self._disconnected_at = time.monotonic()
+            self.disconnects += 1
+        self.connected.clear()
+        print("Disconnected, result code = ", str(rc))
+        logging.info("[MQTT]: Disconnected, result code = " +str(rc)+" at "+str(datetime.utcnow().isoformat()))
+
+    ###########
+    # Publishing
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        try:
+            self.queue.put_nowait((topic, payload, qos, retain))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return True
+
+    def publish_on_connect(self, topic, payload, qos=0, retain=True):
+        # retained metadata (binary schema): sent on every connect, so the broker has it even if the
+        # process stopped before the first connect or the broker lost its retained messages
+        self.connect_messages.append((topic, payload, qos, retain))
+        if self.connected.is_set():
+            self.publish(topic, payload, qos, retain)
+
+    def _publisher(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            while not self._stopping:
+                if not self.connected.wait(1.0):
+                    continue
+                info = self.client.publish(*item)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and item[2] > 0): # paho keeps QoS 1 messages and sends them after reconnecting
+                    self.published += 1
+                    break
+                time.sleep(0.1) # QoS 0 message and the connection dropped between the check and the publish, retry once it is back
+            self.queue.task_done()
+            if self.publish_interval:
+                time.sleep(self.publish_interval)
+
+    ###########
+    # Connection state and statistics
+
+    def stats(self):
+        return {
+            'connected': self.connected.is_set(),
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'published': self.published,
+            'dropped': self.dropped,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'last_reconnect_latency': self.last_reconnect_latency,
+            'max_reconnect_latency': self.max_reconnect_latency,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("%s, queue depth %d (max %d), %d published, %d dropped, %d disconnects, reconnect latency last %s max %.1f s" %
+                ('connected' if stats['connected'] else 'disconnected', stats['queue_depth'], stats['max_queue_depth'],
+                 stats['published'], stats['dropped'], stats['disconnects'],
+                 '-' if stats['last_reconnect_latency'] is None else '%.1f s' % stats['last_reconnect_latency'], stats['max_reconnect_latency']))
@@ -0,0 +1,386 @@
+################################################
+#
+# TEG profiler store-and-forward outbox
+#
+# University of Virginia
+#
+################################################
+#
+# Every message for the cloud is appended to an on-disk outbox before it is published, and is
+# removed only after the broker acknowledged it (QoS 1). The outbox is a directory of append-only
+# segment files plus a cursor file with the position of the oldest unacknowledged message, so
+# publishing resumes where it stopped after a broker outage, a restart or a power loss.
+#
+# Segment files (<number>.seg) hold records of
+#
+#   uint32 payload length, uint32 CRC32 of topic + payload, uint16 topic length, topic, payload
+#
+# A torn record at the end of the newest segment (power loss during a write) is truncated when the
+# outbox is opened. When the outbox grows beyond max_bytes the eviction policy either deletes the
+# oldest segment ('drop-oldest') or refuses new messages ('drop-newest').
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+
+RECORD_HEADER = struct.Struct('<IIH')
+
+
+class Outbox:
+
+    def __init__(self, directory, segment_bytes=1024*1024, max_bytes=256*1024*1024, eviction='drop-oldest', fsync=True):
+        if eviction not in ('drop-oldest', 'drop-newest'):
+            raise ValueError("unknown eviction policy: "+str(eviction))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.fsync = fsync
+        self.evicted = 0 # messages lost to the size cap
+        self._lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+        if not self.segments:
+            self.segments.append(1)
+        self._sizes = dict((segment, self._file_size(segment)) for segment in self.segments)
+        self._recover(self.segments[-1])
+        self.cursor = self._load_cursor()
+        self._file = open(self._path(self.segments[-1]), 'ab')
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%010d.seg' % segment)
+
+    def _file_size(self, segment):
+        try:
+            return os.path.getsize(self._path(segment))
+        except OSError:
+            return 0
+
+    ###########
+    # Startup recovery
+
+    def _recover(self, segment):
+        # truncates the newest segment after its last complete record
+        valid = 0
+        with open(self._path(segment), 'a+b') as file:
+            file.seek(0)
+            data = file.read()
+            while valid + RECORD_HEADER.size <= len(data):
+                length, crc, topic_length = RECORD_HEADER.unpack_from(data, valid)
+                end = valid + RECORD_HEADER.size + topic_length + length
+                if end > len(data) or zlib.crc32(data[valid + RECORD_HEADER.size:end]) != crc:
+                    break
+                valid = end
+            if valid < len(data):
+                logging.warning("[Outbox]: truncating %d bytes of torn record in segment %d" % (len(data) - valid, segment))
+                file.truncate(valid)
+        self._sizes[segment] = valid
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor')) as file:
+                cursor = json.load(file)
+            position = (cursor['segment'], cursor['offset'])
+        except (OSError, ValueError, KeyError):
+            position = (self.segments[0], 0)
+        if position[0] < self.segments[0]:
+            position = (self.segments[0], 0)
+        return position
+
+    def commit(self, position):
+        # persists the position of the oldest unacknowledged message and deletes consumed segments
+        with self._lock:
+            self.cursor = position
+            path = os.path.join(self.directory, 'cursor')
+            with open(path+'.tmp', 'w') as file:
+                json.dump({'segment': position[0], 'offset': position[1]}, file)
+                file.flush()
+                if self.fsync:
+                    os.fsync(file.fileno())
+            os.replace(path+'.tmp', path)
+            while len(self.segments) > 1 and self.segments[0] < position[0]:
+                self._delete_oldest()
+
+    def _delete_oldest(self):
+        segment = self.segments.pop(0)
+        self._sizes.pop(segment, None)
+        try:
+            os.remove(self._path(segment))
+        except OSError:
+            pass
+
+    ###########
+    # Appending
+
+    def size(self):
+        return sum(self._sizes.values())
+
+    def backlog(self):
+        # bytes not yet acknowledged
+        with self._lock:
+            return sum(size for segment, size in self._sizes.items() if segment >= self.cursor[0]) - self.cursor[1]
+
+    def append(self, topic, payload):
+        return self.append_many([(topic, payload)])
+
+    def append_many(self, messages):
+        # appends (topic, payload) messages with a single write and fsync, returns the number stored
+        records = []
+        for topic, payload in messages:
+            if isinstance(payload, str):
+                payload = payload.encode()
+            topic = topic.encode()
+            records.append(RECORD_HEADER.pack(len(payload), zlib.crc32(topic + payload), len(topic)) + topic + payload)
+        data = b''.join(records)
+
+        with self._lock:
+            while self.size() + len(data) > self.max_bytes:
+                if self.eviction == 'drop-newest' or len(self.segments) == 1:
+                    self.evicted += len(records)
+                    logging.warning("[Outbox]: outbox full, dropped %d new messages" % len(records))
+                    return 0
+                self._evict_oldest()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            segment = self.segments[-1]
+            self._sizes[segment] += len(data)
+            if self._sizes[segment] >= self.segment_bytes:
+                self._file.close()
+                self.segments.append(segment + 1)
+                self._sizes[segment + 1] = 0
+                self._file = open(self._path(segment + 1), 'ab')
+        return len(records)
+
+    def _evict_oldest(self):
+        segment = self.segments[0]
+        self.evicted += sum(1 for record in self._records(segment, 0))
+        logging.warning("[Outbox]: outbox full, evicted segment %d" % segment)
+        self._delete_oldest()
+        if self.cursor[0] <= segment:
+            self.cursor = (self.segments[0], 0)
+
+    ###########
+    # Reading
+
+    def _records(self, segment, offset, limit=None):
+        try:
+            file = open(self._path(segment), 'rb')
+        except OSError:
+            return
+        with file:
+            file.seek(offset)
+            count = 0
+            while limit is None or count < limit:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                length, crc, topic_length = RECORD_HEADER.unpack(header)
+                body = file.read(topic_length + length)
+                if len(body) < topic_length + length or zlib.crc32(body) != crc:
+                    return # record still being written
+                offset += RECORD_HEADER.size + topic_length + length
+                count += 1
+                yield (segment, offset), body[:topic_length].decode(), body[topic_length:]
+
+    def read(self, position, limit):
+        # up to `limit` messages after `position` as (position after the message, topic, payload)
+        messages = []
+        segment, offset = position
+        while len(messages) < limit:
+            with self._lock:
+                segments = [s for s in self.segments if s >= segment]
+            if not segments:
+                break
+            if segments[0] != segment:
+                segment, offset = segments[0], 0
+            records = list(self._records(segment, offset, limit - len(messages)))
+            messages.extend(records)
+            if records:
+                segment, offset = records[-1][0]
+            if len(messages) < limit:
+                if segment == segments[-1]:
+                    break
+                segment, offset = segment + 1, 0 # rest of this segment consumed, continue with the next one
+        return messages
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+###########
+# Outbox drainer
+#
+# Publishes the outbox with QoS 1 through the MQTT session, keeping up to `window` messages in
+# flight, and advances the cursor as the broker acknowledges them in order. Messages that were in
+# flight when the process stopped are published again after a restart (at-least-once delivery).
+#
+# The window is set on the paho client (max_inflight_messages_set), so it counts every QoS 1 message
+# of the client: QoS 1 messages published through the session itself take slots of the outbox. The
+# cloud scripts publish their other messages (binary schema, window summaries) with QoS 0.
+
+class OutboxDrainer:
+
+    def __init__(self, outbox, session, window=32, commit_interval=1.0):
+        self.outbox = outbox
+        self.session = session
+        self.window = window
+        self.commit_interval = commit_interval
+        self.drained = 0
+        self.rate = 0.0 # messages per second while draining the last backlog
+        self._acked = set() # acknowledged mids of messages in flight
+        self._inflight = deque() # (mid, position, message info) in publishing order
+        self._inflight_mids = set()
+        self._position = outbox.cursor # read position, ahead of the cursor by the messages in flight
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='outbox-drainer', daemon=True)
+        session.client.on_publish = self.on_publish
+        session.client.max_inflight_messages_set(window)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def on_publish(self, client, userdata, mid):
+        # the session publishes its own QoS 1 messages on the same client, their mids are not ours
+        if mid in self._inflight_mids:
+            self._acked.add(mid)
+
+    def _pop_acked(self):
+        # drops the acknowledged messages at the head of the window, returns the position after the
+        # last one (None if there is none) and their number
+        acked = None
+        count = 0
+        while self._inflight and self._head_acked():
+            mid, acked, info = self._inflight.popleft()
+            self._inflight_mids.discard(mid)
+            self._acked.discard(mid)
+            self.drained += 1
+            count += 1
+        return acked, count
+
+    def _head_acked(self):
+        mid, position, info = self._inflight[0]
+        return mid in self._acked or info.is_published() # PUBACK can arrive before the mid is in _inflight_mids
+
+    def _run(self):
+        last_commit = time.monotonic()
+        acked = None # position after the last message acknowledged in order, not committed yet
+        burst_start = None
+        burst_count = 0
+        while not self._stopping.is_set():
+            if not self.session.connected.wait(1.0):
+                continue
+
+            position, count = self._pop_acked()
+            if position is not None:
+                acked = position
+            burst_count += count
+
+            free = self.window - len(self._inflight)
+            messages = self.outbox.read(self._position, free) if free > 0 else []
+            for position, topic, payload in messages:
+                info = self.session.client.publish(topic, payload, qos=1)
+                if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN): # paho keeps QoS 1 messages and sends them after reconnecting
+                    break
+                self._inflight_mids.add(info.mid)
+                self._inflight.append((info.mid, position, info))
+                self._position = position
+
+            now = time.monotonic()
+            if acked is not None and (now - last_commit >= self.commit_interval or not self._inflight):
+                self.outbox.commit(acked)
+                acked = None
+                last_commit = now
+            if self._inflight or messages:
+                if burst_start is None:
+                    burst_start = now
+                    burst_count = 0
+                time.sleep(0.001 if messages else 0.005)
+            else:
+                if burst_start is not None and now > burst_start:
+                    self.rate = burst_count/(now - burst_start)
+                burst_start = None
+                time.sleep(0.2)
+
+        position, count = self._pop_acked()
+        if position is not None:
+            acked = position
+        if acked is not None:
+            self.outbox.commit(acked) # acknowledged messages are not published again by the next run
+
+    def stats(self):
+        return {
+            'backlog_bytes': self.outbox.backlog(),
+            'inflight': len(self._inflight),
+            'drained': self.drained,
+            'drain_rate': self.rate,
+            'evicted': self.outbox.evicted,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("outbox backlog %d bytes, %d in flight, %d drained (last drain %.1f msg/s), %d evicted" %
+                (stats['backlog_bytes'], stats['inflight'], stats['drained'], stats['drain_rate'], stats['evicted']))
+
+
+###########
+# Drain throughput after an outage (python3 TEG_outbox.py --broker host:port --hours 8)
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+
+    from TEG_mqtt import MQTTSession
+    from TEG_telemetry import encode_messages, message_topic, synthetic_batch
+
+    parser = argparse.ArgumentParser(description='TEG profiler outbox drain benchmark')
+    parser.add_argument('--broker', default='127.0.0.1:1883')
+    parser.add_argument('--hours', type=float, default=8.0, help='length of the simulated outage')
+    parser.add_argument('--mode', default='batch', help="publish mode of the queued messages ('sample', 'batch', 'binary')")
+    parser.add_argument('--window', type=int, default=32, help='messages in flight')
+    args = parser.parse_args()
+
+    host, port = args.broker.rsplit(':', 1)
+    directory = tempfile.mkdtemp()
+    try:
+        outbox = Outbox(directory)
+        batch = synthetic_batch(1800)
+        topic = message_topic('teg_outbox_bench', args.mode)
+        batches = int(args.hours*3600/900)
+        for i in range(batches):
+            outbox.append_many((topic, payload) for payload in encode_messages('teg_outbox_bench', batch, args.mode))
+        backlog = outbox.backlog()
+        total = sum(1 for message in outbox.read(outbox.cursor, 10**9))
+        print("%.1f h outage: %d messages, %d bytes queued" % (args.hours, total, backlog))
+
+        session = MQTTSession('teg_outbox_bench', host, int(port))
+        drainer = OutboxDrainer(outbox, session, window=args.window)
+        session.start()
+        session.connected.wait(10)
+        start = time.monotonic()
+        drainer.start()
+        while drainer.drained < total and time.monotonic() - start < 600:
+            time.sleep(0.05)
+        elapsed = time.monotonic() - start
+        print("drained %d messages in %.2f s: %.1f msg/s, %.1f kB/s (window %d)" % (drainer.drained, elapsed, drainer.drained/elapsed, backlog/elapsed/1024, args.window))
+        drainer.stop()
+        session.stop()
+    finally:
+        shutil.rmtree(directory)
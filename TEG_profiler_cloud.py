@@ -7,23 +7,24 @@
 #
 ################################################
 
-import board
-import digitalio
-
 import os
-import threading
-import csv
-
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-
-from adafruit_bus_device.i2c_device import I2CDevice
 
-import mcp9600
+from TEG_buffer import SampleBuffer, from_epoch_us
+from TEG_batchfile import EXTENSIONS, write_batch
+from TEG_engine import AcquisitionEngine
+from TEG_hardware import open_hardware
+from TEG_ring import SampleRing, realtime, run_ring_sink, start_sink_process, stop_sink_processes
+from TEG_scheduler import MultiRateScheduler
+from TEG_sweep import default_plan, fit_oversample, measure_read_time, read_temperatures
+from TEG_stream import StreamWriter
+from TEG_telemetry import change_messages, encode_messages, message_topic, schema_message, schema_topic, summary_message, summary_topic
+from TEG_analytics import IVModel, published_channels
+from TEG_aggregate import WindowAggregator, channel_policies, select_channels
+from TEG_deadband import Deadband
+from TEG_mqtt import MQTTSession
+from TEG_outbox import Outbox, OutboxDrainer
 
-import time
 from datetime import datetime
-import paho.mqtt.client as mqtt
 import json
 import logging
 #import math
@@ -42,136 +43,102 @@ import logging
 #     print("message topic = ", message.topic)
 #     print("message qos = ", message.qos)
 #     print("message retain flag = ", message.retain)
-    
-def on_connect(client, userdata, flags, rc):
-    if rc ==0:
-        print("Successfully connected")
-        logging.info("[MQTT]: Successfully connected at "+str(datetime.utcnow().isoformat()))
-    else:
-        print("Bad connection, returned code = ", rc)
-        logging.error("[MQTT]: Bad connection, returned code = "+str(rc)+" at "+str(datetime.utcnow().isoformat()))
 
-def on_disconnect(client, userdata, flags, rc=0):
-    print("Disconnected, result code = ", str(rc))
-    logging.info("[MQTT]: Disconnected, result code = " +str(rc)+" at "+str(datetime.utcnow().isoformat()))
+# # (assign them to session.client.on_log / session.client.on_message)
+
+
+###########
+# MQTT publishing function
+
+def start_cloud():
+    global session, outbox, drainer
+    print("Starting MQTT session...")
+    session = MQTTSession(APP_ID, BROKER_ADDRESS) # one connection for the lifetime of the script, reconnects with backoff
+    outbox = Outbox(OUTBOX_DIRECTORY, max_bytes=OUTBOX_MAX_BYTES, eviction=OUTBOX_EVICTION) # messages not yet acknowledged by the broker, kept across restarts
+    drainer = OutboxDrainer(outbox, session, window=OUTBOX_WINDOW)
+    if PUBLISH_MODE == 'binary':
+        session.publish_on_connect(schema_topic(APP_ID), schema_message(APP_ID, published), qos=0, retain=True) # channel names, display names and units of the binary messages, sent again on every connect
+    session.start()
+    drainer.start()
+
+
+def stop_cloud():
+    drainer.stop() # messages not acknowledged yet stay in the outbox for the next run
+    session.stop() # sends what is still queued and disconnects
+    logging.info("[MQTT]: "+session.summary())
+    logging.info("[Outbox]: "+drainer.summary())
+
+
+def cloud_upload(batch):
+    if not published:
+        return # every channel is published as window summaries only
+    topic = message_topic(APP_ID, PUBLISH_MODE) # linklab/teg_eh_profiler, linklab/teg_eh_profiler/<APP_ID>/bin for binary messages
+    if PUBLISH_FEATURES != 'raw':
+        batch = iv_model.feature_batch(batch, DERIVED_FEATURES, include_raw=PUBLISH_FEATURES == 'both') # I-V fit of every sample, the local files keep the raw channels
+    if batch.channels != published:
+        batch = select_channels(batch, published) # without the channels published as window summaries only
+    if PUBLISH_MODE == 'changes':
+        payloads = change_messages(APP_ID, batch, deadband.mask(batch), deadband.bands, deadband.heartbeat, SAMPLES_PER_MESSAGE) # values out of their deadband, heartbeats and the first sample of the batch
+    else:
+        payloads = encode_messages(APP_ID, batch, PUBLISH_MODE, SAMPLES_PER_MESSAGE, MESSAGE_WINDOW)
+    outbox.append_many((topic, payload) for payload in payloads) # stored on disk, published by the outbox drainer with QoS 1
 
 
+def publish_summaries(summaries):
+    for summary in summaries:
+        session.publish(summary_topic(APP_ID, summary['window']), summary_message(APP_ID, summary), qos=0) # QoS 0 through the session queue, not the outbox: the local files keep the samples to recompute them, and the QoS 1 window of the client stays with the outbox drainer
 
 
 ###########
-# MQTT publishing function
+# Batch file writing function (CSV or columnar binary, see TEG_batchfile.py)
+
+def batch_file_name(batch):
+    # named after the last sample of the batch
+    return from_epoch_us(batch.timestamp[batch.count - 1]).strftime('%Y%m%d_%H_%M')+EXTENSIONS[FILE_FORMAT]
 
-def cloud_upload(APP_ID,BROKER_ADDRESS, data_list):
-
-    print("... starting cloud upload thread")
-    # Standard message with fields expected by the MQTT broker
-    message = {
-       "app_id":APP_ID,
-       "counter": 0,
-       "payload_fields":{
-
-         "voltage_chan_OFF":{
-             "displayName":"High Impedance",
-             "unit":"V",
-             "value":-999.99
-          },
-
-         "voltage_chan_0":{
-             "displayName":"Channel 0",
-             "unit":"V",
-             "value":-999.99
-          },
-
-         "voltage_chan_1":{
-             "displayName":"Channel 1",
-             "unit":"V",
-             "value":-999.99
-          },
-
-         "voltage_chan_2":{
-             "displayName":"Channel 2",
-             "unit":"V",
-             "value":-999.99
-          },
-
-         "voltage_chan_3":{
-             "displayName":"Channel 3",
-             "unit":"V",
-             "value":-999.99
-          },
-
-          "temperature_amb":{
-             "displayName":"Ambient temperature",
-             "unit":"°C",
-             "value":-999.99
-          },
-
-          "temperature_hot":{
-             "displayName":"Hot side temperature",
-             "unit":"°C",
-             "value":-999.99
-          }
-
-       },
-       "metadata":{
-          "time":"2020-12-01T12:00:00.000000000Z"
-       }
-    }
-
-    client = mqtt.Client(APP_ID) # Creates a new MQTT client instance
-    # client.on_log = on_log
-    # client.on_message = on_message
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-
-    # client.reconnect_delay_set(min_delay=10, max_delay=120)
-
-    client.connect(BROKER_ADDRESS) # Connects to MQTT broker
-
-    client.loop_start()
-    time.sleep(4)
-
-    client.subscribe("linklab/teg_eh_profiler", qos=0) # Subscribes to linklab/teg_eh_profiler topic
-
-    for COUNTER in range(len(data_list)):
-
-        message['metadata']['time'] = data_list[COUNTER][0]
-        message['payload_fields']['voltage_chan_OFF']['value'] = data_list[COUNTER][1]
-        message['payload_fields']['voltage_chan_0']['value'] = data_list[COUNTER][2]
-        message['payload_fields']['voltage_chan_1']['value'] = data_list[COUNTER][3]
-        message['payload_fields']['voltage_chan_2']['value'] = data_list[COUNTER][4]
-        message['payload_fields']['voltage_chan_3']['value'] = data_list[COUNTER][5]   
-        message['payload_fields']['temperature_amb']['value'] = data_list[COUNTER][6]
-        message['payload_fields']['temperature_hot']['value'] = data_list[COUNTER][7]        
-        message['counter'] = COUNTER
-
-        client.publish("linklab/teg_eh_profiler",json.dumps(message),qos=0)
-        time.sleep(0.2)
-
-    client.loop_stop()
-    client.disconnect() # disconnect
-    print("cloud upload thread complete!")
-    return None
+
+def file_writer(batch):
+    write_batch(directory+'/'+batch_file_name(batch), header, batch, FILE_FORMAT, SAMPLING_PERIOD) # the engine releases the batch afterwards
 
 
 ###########
-# CSV writing function
+# Storage and upload processes of the processes deployment, read the sample ring (TEG_ring.py)
+
+def storage_process(reader):
+    if STORAGE_MODE == 'stream':
+        stream = StreamWriter(directory, header, FILE_FORMAT, SAMPLING_PERIOD, FSYNC_SAMPLES, FSYNC_INTERVAL)
+        run_ring_sink(reader, batch_size, lambda batch: stream.rotate(batch_file_name(batch)), stream.append)
+        stream.close()
+        logging.info("[Stream]: "+stream.summary())
+    else:
+        run_ring_sink(reader, batch_size, file_writer)
 
-def file_writer(file_name, directory, header, data_list):
-    print("... starting local storage thread")
-    with open(directory+'/'+file_name, 'w') as file:
-        csvwriter = csv.writer(file, delimiter = ',')
-        csvwriter.writerow(header)
-        for row in data_list:
-            csvwriter.writerow(row)
-    print("local storage thread complete!")
-    return None
+
+def cloud_process(reader):
+    def upload(batch):
+        cloud_upload(batch)
+        logging.info("[MQTT]: "+session.summary())
+        logging.info("[Outbox]: "+drainer.summary())
+        if PUBLISH_MODE == 'changes':
+            logging.info("[Deadband]: "+deadband.summary())
+
+    def aggregate(batch):
+        publish_summaries(aggregator.append(batch)) # window summaries as soon as a window is complete, not at rollover
+
+    start_cloud() # MQTT session and its threads live in this process only
+    try:
+        run_ring_sink(reader, batch_size, upload, aggregate if aggregator is not None else None)
+        if aggregator is not None:
+            publish_summaries(aggregator.flush()) # windows in progress at shutdown
+            logging.info("[Aggregate]: "+aggregator.summary())
+    finally:
+        stop_cloud()
 
 
 ###########
 # Logging file configurations
 
-logging.basicConfig(filename ='/home/pi/Desktop/shared/TEG_profiler.log', level=logging.INFO) # formating log file
+logging.basicConfig(filename = os.environ.get('TEG_LOG_FILE', '/home/pi/Desktop/shared/TEG_profiler.log'), level=logging.INFO) # formating log file
 logging.info('===================================================================')
 logging.info('[Events]: TEG profiler cloud script started at '+str(datetime.utcnow().isoformat()))
 
@@ -179,14 +146,12 @@ logging.info('[Events]: TEG profiler cloud script started at '+str(datetime.utcn
 ###########
 # Local data storage configurations
 
-directory = '/home/pi/Desktop/shared/data'
+directory = os.environ.get('TEG_DATA_DIR', '/home/pi/Desktop/shared/data')
 
 if not os.path.exists(directory):
     os.makedirs(directory)
 
 batch_size = 1800 # Equivalent of 15 minutes at sampling rate of 0.5 Hz
-header = ['Timestamp', 'voltage_chan_OFF', 'voltage_chan_0', 'voltage_chan_1', 'voltage_chan_2', 'voltage_chan_3', 'temperature_amb', 'temperature_hot']
-data_list = [[None]*8 for i in range(batch_size)] # creates a buffer for all variables with given batch size
 
 
 ###########
@@ -195,18 +160,48 @@ data_list = [[None]*8 for i in range(batch_size)] # creates a buffer for all var
 # Reads application info file with application ID and MQTT borker address
 try:
     print("Reading application info file...")
-    with open("/home/pi/Desktop/Application_info.txt") as json_appInfo:
+    with open(os.environ.get('TEG_APP_INFO', "/home/pi/Desktop/Application_info.txt")) as json_appInfo:
         APP_INFO = json.load(json_appInfo)
         
 except Exception as e:
     print("Application info file could not be loaded")
     logging.error("[FileIO]: Application info file could not be loaded")
-    logging.error("[FileIO]: "+e)
+    logging.error("[FileIO]: "+str(e))
     raise
 
 BROKER_ADDRESS = '34.230.161.172' # APP_INFO["BROKER_ADDRESS"] # IP address of the MQTT broker
 APP_ID = APP_INFO["APP_ID"] # how this application will be identified in the cloud database
 SAMPLING_PERIOD = 0.5 # in seconds (max 0.1)
+PUBLISH_MODE = 'batch' # 'batch': several samples per MQTT message as columnar arrays, 'binary': same with a compact binary layout, 'changes': only the values out of their DEADBAND (see TEG_deadband.py), 'sample': one message per sample (legacy format)
+SAMPLES_PER_MESSAGE = 60 # samples packed into one message in 'batch' mode (30 seconds at 2 Hz)
+MESSAGE_WINDOW = None # in seconds, optional limit on the time span of one message in 'batch' mode
+PUBLISH_FEATURES = 'raw' # 'raw': the acquired channels, 'derived': only DERIVED_FEATURES of the I-V fit of each sample, 'both': acquired channels and DERIVED_FEATURES (see TEG_analytics.py)
+DERIVED_FEATURES = ('voc', 'r_internal', 'p_max', 'power_factor') # among voc, r_internal, p_max, p_best, mpp_ratio, seebeck, power_factor, fit_rms
+CHANNEL_POLICY = {} # per acquired channel, e.g. {'temperature_age': 'aggregate'}: 'raw' publishes every sample, 'aggregate' only window summaries (the samples stay in the local files), 'both' (see TEG_aggregate.py)
+DEFAULT_CHANNEL_POLICY = 'raw' # policy of the channels not in CHANNEL_POLICY
+AGGREGATE_WINDOWS = (10, 60, 900) # in seconds, count, min, max, mean and std of the aggregated channels published for every window
+DEADBAND = {'voltage_': (0.001, 0.0), 'temperature_': (0.25, 0.0), 'temperature_age': (5.0, 0.0), 'voc': (0.001, 0.0), 'r_internal': (0.0, 0.02), 'p_': (0.0, 0.02), 'power_factor': (0.0, 0.02)} # 'changes' mode: (absolute, relative) deadband per channel name or name prefix, a value is published once |value - last published| > max(absolute, relative*|last published|), channels not listed on every change
+HEARTBEAT = 300.0 # 'changes' mode: in seconds, longest silence of a channel
+OUTBOX_DIRECTORY = os.environ.get('TEG_OUTBOX_DIR', '/home/pi/Desktop/shared/outbox') # messages waiting for the broker acknowledgement
+OUTBOX_MAX_BYTES = 256*1024*1024 # size cap of the outbox
+OUTBOX_EVICTION = 'drop-oldest' # when the outbox is full: 'drop-oldest' deletes the oldest messages, 'drop-newest' refuses new ones
+OUTBOX_WINDOW = 32 # messages in flight while draining the outbox
+HARDWARE_BACKEND = os.environ.get('TEG_HARDWARE', 'board') # 'board' on the Raspberry Pi, 'sim' for the simulated I2C devices
+FILE_FORMAT = os.environ.get('TEG_FILE_FORMAT', 'csv') # 'csv' or 'binary' (.teg columnar files, convert with TEG_batchfile.py)
+STORAGE_MODE = os.environ.get('TEG_STORAGE_MODE', 'stream') # 'stream': samples appended to the current file as they are acquired, 'batch': whole batch written at rollover
+FSYNC_SAMPLES = 20 # stream mode: samples are made durable at least every FSYNC_SAMPLES samples...
+FSYNC_INTERVAL = 10.0 # ... and every FSYNC_INTERVAL seconds, at most this much data is lost on a power cut
+SETTLE_TIMES = None # seconds between each load switch and its ADS1015 conversion (python3 TEG_sweep.py calibrate), None for the defaults in TEG_sweep.py
+SWEEP_PLAN = None # load states of the sweep, e.g. SweepPlan([(0x00, 0.004, 1), (0x01, 0.004, 1), (0x03, 0.004, 2), ...], adaptive=3) (TEG_sweep.py), None for open circuit and the four loads with SETTLE_TIMES
+OVERSAMPLE = 1 # ADS1015 conversions averaged per load state (python3 TEG_sweep.py oversample), above 1 the files also get <channel>_std, _min and _max columns
+TEMPERATURE_PERIOD = 5.0 # seconds between thermocouple reads, carried forward on the rows in between with their age (temperature_age column), None to read them on every row
+SINK_QUEUE_DEPTH = 2 # full batches waiting for the local storage and for the upload before SINK_POLICY applies
+SINK_POLICY = 'spill' # 'block' pauses the acquisition, 'drop-oldest'/'drop-newest' drop a batch, 'spill' writes it to SPILL_DIRECTORY until the sink caught up (see TEG_engine.py)
+SPILL_DIRECTORY = os.environ.get('TEG_SPILL_DIR', '/home/pi/Desktop/shared/spill') # batches spilled by the sinks, one subdirectory per sink
+DEPLOYMENT = os.environ.get('TEG_DEPLOYMENT', 'engine') # 'engine': one process (TEG_engine.py), 'processes': acquisition process writing a shared-memory ring read by storage and upload processes (TEG_ring.py)
+ACQUISITION_CPU = None # processes deployment: core the acquisition process is pinned to (e.g. 3, the storage and upload processes run on the others), None to leave it to the kernel
+ACQUISITION_PRIORITY = None # processes deployment: SCHED_FIFO priority of the acquisition process (1-99, needs root or CAP_SYS_NICE), None for the normal scheduler
+RING_SLOTS = 2*batch_size # processes deployment: samples kept in the ring for the storage and upload processes
 
 
 
@@ -215,6 +210,17 @@ SAMPLING_PERIOD = 0.5 # in seconds (max 0.1)
 ##########
 # Main code
 
+plan = SWEEP_PLAN or default_plan(SETTLE_TIMES)
+header = ['Timestamp'] + plan.columns(statistics=OVERSAMPLE > 1) # voltage of every load state, temperatures, with OVERSAMPLE > 1 the standard deviation, minimum and maximum of the conversions of each state
+if TEMPERATURE_PERIOD is not None:
+    header += ['temperature_age'] # seconds since the thermocouple read carried forward on the row
+iv_model = IVModel(header[1:]) # load states of the plan for the I-V fit of the published features
+raw_channels, aggregated_channels = channel_policies(header[1:], CHANNEL_POLICY, DEFAULT_CHANNEL_POLICY)
+published = published_channels(raw_channels, DERIVED_FEATURES, PUBLISH_FEATURES) # channels of the sample messages
+aggregator = WindowAggregator(header[1:], AGGREGATE_WINDOWS, aggregated_channels) if aggregated_channels else None # incremental window summaries, O(1) per sample
+deadband = Deadband(published, DEADBAND, heartbeat=HEARTBEAT) # reference values are kept per batch, each batch starts with all channels
+sample_buffer = SampleBuffer(batch_size, header[1:], sinks=1 if DEPLOYMENT == 'processes' else 2, scales=plan.compile(statistics=OVERSAMPLE > 1).raw_scales()) # double buffer of float64 columns, one per variable, with given batch size, and int16 raw ADS1015 codes of the voltage channels
+
 # # Uncoment to start script after pushing GPIO17 button
 # button = digitalio.DigitalInOut(board.D17)
 # button.direction = digitalio.Direction.INPUT
@@ -227,124 +233,152 @@ SAMPLING_PERIOD = 0.5 # in seconds (max 0.1)
 #
 
 
+ring = None
+sink_processes = []
+if DEPLOYMENT == 'processes':
+    ring = SampleRing(header[1:], RING_SLOTS) # committed samples, read by the storage and upload processes with their own cursors
+    sink_processes.append(start_sink_process('storage', storage_process, ring, 0, ACQUISITION_CPU)) # forked before the hardware is opened
+    sink_processes.append(start_sink_process('cloud', cloud_process, ring, 1, ACQUISITION_CPU))
+    realtime(ACQUISITION_CPU, ACQUISITION_PRIORITY)
+else:
+    start_cloud()
+
 print("Starting I2C devices...")
-try:
-    i2c = board.I2C()
-    logging.info("[I2C]: raspberry pi board I2C interface was sucesfully initialized")
-except Exception as e: 
-    logging.error("[I2C]: raspberry pi board I2C interface initialization error")
-    logging.error("[I2C]: "+e) 
-    
-    
-try: 
-    pca = I2CDevice(i2c, 0x41) # creates the PCA GPIO controller at address 0x41 
-    pca.write(bytes([0x03,0x00]))# configure GPIO as output
-    logging.info("[I2C]: PCA GPIO controller was sucesfully initialized and configured")
-except Exception as e: 
-    logging.error("[I2C]: PCA GPIO controller initialization error")
-    logging.error("[I2C]: "+e)    
-
-
-try: 
-    ads = ADS.ADS1015(i2c) # creates the ADS analog to digital converter at default address (0x48)
-    ads.gain = 8 # configures PGA gain to 8, resulting on range of +-0.512V (valid configurations: 2/3, 1, 2, 4, 8, 16) 
-    ads.mode = ADS.Mode.CONTINUOUS # converts at max speed, reads most recent conversion through I2C
-    chan = AnalogIn(ads, ADS.P0) # configures ADS to read analog values from channel 0
-    logging.info("[I2C]: ADS analog to digital converter was sucesfully initialized and configured")
-except Exception as e: 
-    logging.error("[I2C]: ADS analog to digital converter initialization error")
-    logging.error("[I2C]: "+e) 
+hw = open_hardware(HARDWARE_BACKEND) # PCA GPIO controller (0x41), ADS analog to digital converter (0x48), MCP thermocouple amplifier (0x60) and GPIO17 button
+pca = hw.pca
+adc = hw.adc # single-shot conversions, polled for conversion ready
+mcp = hw.mcp
+button = hw.button # hold for 1 SAMPLE_PERIOD to stop
 
+oversample = OVERSAMPLE
+if OVERSAMPLE > 1:
+    oversample = fit_oversample(OVERSAMPLE, SAMPLING_PERIOD, measure_read_time(adc), plan) # the sweep has to fit in the sampling period
+    logging.info("[Sweep]: "+str(oversample)+" conversions per load state (OVERSAMPLE = "+str(OVERSAMPLE)+")")
+sweep = plan.compile(oversample, OVERSAMPLE > 1) # write buffers, settle times and channels of every load state
 
-try:
-    mcp = mcp9600.MCP9600(i2c_addr=0x60) # creates the MCP thermocouple amplifier at address 0x60, default config for K-type thermocouple
-    logging.info("[I2C]: MCP thermocouple amplifier was sucesfully initialized and configured")
-except Exception as e:
-    logging.error("[I2C]: ADS analog to digital converter initialization error")
-    logging.error("[I2C]: "+e) 
+scheduler = MultiRateScheduler(SAMPLING_PERIOD) # wakes the loop up at start + k*SAMPLING_PERIOD on the monotonic clock
+if TEMPERATURE_PERIOD is not None:
+    scheduler.add_task('temperatures', TEMPERATURE_PERIOD) # due in the first slot after start + j*TEMPERATURE_PERIOD
 
+stream = None
+if STORAGE_MODE == 'stream' and ring is None:
+    stream = StreamWriter(directory, header, FILE_FORMAT, SAMPLING_PERIOD, FSYNC_SAMPLES, FSYNC_INTERVAL) # recovers the segment left by a crash or power cut
 
-# Configuring interruption button on GPIO 17 (hold for 1 SAMPLE_PERIOD to stop)
-button = digitalio.DigitalInOut(board.D17)
-button.direction = digitalio.Direction.INPUT
 
-COUNTER = 0
+###########
+# Acquisition stage, runs in the executor thread of the engine (TEG_engine.py)
 
-print("Starting acquisition...")
-while True:
+def acquire():
     
+    scheduler.wait() # sleeps until the next sampling deadline
     timestamp = datetime.utcnow()
     
     try: 
-        pca.write(bytes([0x01,0x00])) # set all transistor switches off
-        time.sleep(0.010)
-        data_list[COUNTER][1] = chan.voltage # read TEG open circuit voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x01])) # open only channel zero switch (0.1 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][2] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x02])) # open only channel one switch (0.47 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][3] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x04])) # open only channel two switch (1.5 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][4] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x08])) # open only channel three switch (4.7 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][5] = chan.voltage # read TEG output voltage
+        sweep.run(pca, adc, sample_buffer) # TEG open circuit voltage and output voltage of every load state
            
     except Exception as e:
-        logging.error("[I2C]: TEG I-V curve scan failed at COUNTER = "+str(COUNTER)+", timestamp = "+str(datetime.utcnow().isoformat()))
-        logging.error("[I2C]: "+e)  
+        logging.error("[I2C]: TEG I-V curve scan failed at COUNTER = "+str(sample_buffer.current.count)+", timestamp = "+str(datetime.utcnow().isoformat()))
+        logging.error("[I2C]: "+str(e))  
    
    
     try: 
-        data_list[COUNTER][6] = float(mcp.get_cold_junction_temperature()) # measure ambient temperature (cold junction)
-        
-        data_list[COUNTER][7] = float(mcp.get_hot_junction_temperature()) # measure probe temperature (hot junction)
+        if TEMPERATURE_PERIOD is None:
+            read_temperatures(mcp, sample_buffer, channels=sweep.temperature_channels) # ambient (cold junction) and probe (hot junction) temperatures
+        elif scheduler.is_due('temperatures'):
+            read_temperatures(mcp, sample_buffer, timestamp, header.index('temperature_age') - 1, sweep.temperature_channels) # held and carried forward until the next read
 
     except Exception as e:
-        logging.error("[I2C]: MCP thermocouple amplifier measurements have failed at COUNTER = "+str(COUNTER)+", timestamp = "+str(datetime.utcnow().isoformat()))
-        logging.error("[I2C]: "+e) 
+        logging.error("[I2C]: MCP thermocouple amplifier measurements have failed at COUNTER = "+str(sample_buffer.current.count)+", timestamp = "+str(datetime.utcnow().isoformat()))
+        logging.error("[I2C]: "+str(e)) 
 
 
-    data_list[COUNTER][0] = timestamp.isoformat()+'Z'
-    
-    COUNTER += 1
+    batch = sample_buffer.commit(timestamp) # returns the full batch at rollover, the loop continues on a free buffer
+    if stream is not None:
+        stream.append(sample_buffer.current if batch is None else batch) # last committed sample, written by the stream writer thread
+    if ring is not None:
+        ring.append(sample_buffer.current if batch is None else batch) # last committed sample, for the storage and upload processes
+    elif aggregator is not None:
+        publish_summaries(aggregator.append(sample_buffer.current if batch is None else batch)) # windows closed by the last committed sample
     
 
-    if COUNTER == batch_size:
-        file_name = timestamp.strftime('%Y%m%d_%H_%M')+'.csv'
-        file_write_thread = threading.Thread(target=file_writer, args = (file_name, directory, header, data_list))
-        file_write_thread.start()
+    if batch is not None:
+        if stream is not None:
+            stream.rotate(batch_file_name(batch)) # current segment is made durable and renamed, in order with the appends
+            batch.release() # the upload sink holds the other share
+        elif ring is not None:
+            batch.release() # the storage and upload processes rebuild the batch from the ring
+
+        print(str(batch_size)+" messages sucessfully acquired and queued for local store and upload")
+        logging.info("[Events]: "+str(batch_size)+" messages sucessfully acquired and queued for local store and upload at "+str(timestamp))
+        logging.info("[Scheduler]: "+scheduler.summary())
+        if stream is not None:
+            logging.info("[Stream]: "+stream.summary())
+        if engine is not None:
+            logging.info("[Engine]: "+engine.summary())
+            logging.info("[MQTT]: "+session.summary())
+            logging.info("[Outbox]: "+drainer.summary())
+            if aggregator is not None:
+                logging.info("[Aggregate]: "+aggregator.summary())
+            if PUBLISH_MODE == 'changes':
+                logging.info("[Deadband]: "+deadband.summary())
+        else:
+            logging.info("[Ring]: "+ring.summary(len(sink_processes)))
+        scheduler.reset_stats()
+    
+    return batch
 
-        cloud_upload_thread = threading.Thread(target=cloud_upload, args = (APP_ID,BROKER_ADDRESS, data_list))
-        cloud_upload_thread.start()
-        
-        COUNTER = 0
 
-        print(str(batch_size)+" messages sucessfully acquired and local store and upload threads started!")
-        logging.info("[Events]: "+str(batch_size)+" messages sucessfully acquired and local store and upload threads started at "+str(timestamp))
-        
-    
+def stop():
     # Hold button on GPIO17 to exit script
-    if button.value == False:
-        break
-       
-    delay = (datetime.utcnow() - timestamp).microseconds
-    # print(max(SAMPLING_PERIOD - delay*(10**-6),0.01))
-    time.sleep(max(SAMPLING_PERIOD - delay*(10**-6),0.01))
+    return button.value == False
+
+
+def flush():
+    # partial batch since the last rollover, handed to the sinks before the engine drains them
+    if aggregator is not None and ring is None:
+        publish_summaries(aggregator.flush()) # windows in progress, marked partial
+        logging.info("[Aggregate]: "+aggregator.summary())
+    if not sample_buffer.current.count:
+        return None
+    batch = sample_buffer.rollover()
+    if stream is not None:
+        stream.rotate(batch_file_name(batch))
+        batch.release()
+    elif ring is not None:
+        batch.release()
+    logging.info("[Events]: "+str(batch.count)+" data points of the partial batch stored and queued for upload")
+    return batch
+
+
+engine = None
+if ring is None:
+    engine = AcquisitionEngine(acquire, stop, flush)
+    if stream is None:
+        engine.add_sink('storage', file_writer, SINK_QUEUE_DEPTH, SINK_POLICY, os.path.join(SPILL_DIRECTORY, 'storage'))
+    engine.add_sink('cloud', cloud_upload, SINK_QUEUE_DEPTH, SINK_POLICY, os.path.join(SPILL_DIRECTORY, 'cloud'))
+
+print("Starting acquisition...")
+if engine is not None:
+    engine.run() # returns once the GPIO17 button was held and the local store and upload sinks are drained
+else:
+    while not stop():
+        acquire()
+    flush()
+    stop_sink_processes(ring, sink_processes) # the storage and upload processes read the ring to the end and handle the partial batch
+
 
 print("TEG profiler cloud script interrupted")    
 logging.info('[Events]: TEG profiler cloud script interrupted at '+str(datetime.utcnow().isoformat()))    
-print("Main data acquisition script complete, wait for local store and cloud upload threads to finish")
+if engine is not None:
+    logging.info("[Engine]: "+engine.summary())
+if ring is not None:
+    logging.info("[Ring]: "+ring.summary(len(sink_processes)))
+    ring.release()
+if stream is not None:
+    stream.close() # waits for the stream writer to make the last segment durable
+    logging.info("[Stream]: "+stream.summary())
+if engine is not None:
+    stop_cloud()
 
 
 
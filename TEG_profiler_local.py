@@ -7,41 +7,50 @@
 #
 ################################################
 
-import board
-import digitalio
-
 import os
-import threading
-import csv
-
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-
-from adafruit_bus_device.i2c_device import I2CDevice
 
-import mcp9600
+from TEG_buffer import SampleBuffer, from_epoch_us
+from TEG_batchfile import EXTENSIONS, write_batch
+from TEG_engine import AcquisitionEngine
+from TEG_hardware import open_hardware
+from TEG_ring import SampleRing, realtime, run_ring_sink, start_sink_process, stop_sink_processes
+from TEG_scheduler import MultiRateScheduler
+from TEG_sweep import default_plan, fit_oversample, measure_read_time, read_temperatures
+from TEG_stream import StreamWriter
 
-import time
 from datetime import datetime
-import json
 import logging
 
 
 ###########
-# CSV writing function
+# Batch file writing function (CSV or columnar binary, see TEG_batchfile.py)
+
+def batch_file_name(batch):
+    # named after the last sample of the batch
+    return from_epoch_us(batch.timestamp[batch.count - 1]).strftime('%Y%m%d_%H_%M')+EXTENSIONS[FILE_FORMAT]
+
+
+def file_writer(batch):
+    write_batch(directory+'/'+batch_file_name(batch), header, batch, FILE_FORMAT, SAMPLING_PERIOD) # the engine releases the batch afterwards
+
+
+###########
+# Storage process of the processes deployment, reads the sample ring (TEG_ring.py)
 
-def file_writer(file_name, directory, header, data_list):
-    with open(directory+'/'+file_name, 'w') as file:
-        csvwriter = csv.writer(file, delimiter = ',')
-        csvwriter.writerow(header)
-        for row in data_list:
-            csvwriter.writerow(row)
+def storage_process(reader):
+    if STORAGE_MODE == 'stream':
+        stream = StreamWriter(directory, header, FILE_FORMAT, SAMPLING_PERIOD, FSYNC_SAMPLES, FSYNC_INTERVAL)
+        run_ring_sink(reader, batch_size, lambda batch: stream.rotate(batch_file_name(batch)), stream.append)
+        stream.close()
+        logging.info("[Stream]: "+stream.summary())
+    else:
+        run_ring_sink(reader, batch_size, file_writer)
 
 
 ###########
 # Logging file configurations
 
-logging.basicConfig(filename ='/home/pi/Desktop/shared/TEG_profiler.log', level=logging.INFO) # formating log file
+logging.basicConfig(filename = os.environ.get('TEG_LOG_FILE', '/home/pi/Desktop/shared/TEG_profiler.log'), level=logging.INFO) # formating log file
 logging.info('===================================================================')
 logging.info('[Events]: TEG profiler local script started at '+str(datetime.utcnow().isoformat()))
 
@@ -49,14 +58,12 @@ logging.info('[Events]: TEG profiler local script started at '+str(datetime.utcn
 ###########
 # Local data storage configurations
 
-directory = '/home/pi/Desktop/data'
+directory = os.environ.get('TEG_DATA_DIR', '/home/pi/Desktop/data')
 
 if not os.path.exists(directory):
     os.makedirs(directory)
 
 batch_size = 7200 # Equivalent of 1 hour at sampling rate of 0.5 Hz
-header = ['Timestamp', 'voltage_chan_OFF', 'voltage_chan_0', 'voltage_chan_1', 'voltage_chan_2', 'voltage_chan_3', 'temperature_amb', 'temperature_hot']
-data_list = [[None]*8 for i in range(batch_size)] # creates a buffer for all variables with given batch size
 
 # ###########
 # # Profiler configuration settings
@@ -64,22 +71,44 @@ data_list = [[None]*8 for i in range(batch_size)] # creates a buffer for all var
 # # Reads application info file with application ID 
 # try:
 #     print("Reading application info file...")
-#     with open("/home/pi/Desktop/Application_info.txt") as json_appInfo:
+#     with open(os.environ.get('TEG_APP_INFO', "/home/pi/Desktop/Application_info.txt")) as json_appInfo:
 #         APP_INFO = json.load(json_appInfo)
         
 # except Exception as e:
 #     print("Application info file could not be loaded")
 #     logging.error("[FileIO]: Application info file could not be loaded")
-#     logging.error("[FileIO]: "+e)
+#     logging.error("[FileIO]: "+str(e))
 #     raise
 
 # APP_ID = APP_INFO["APP_ID"] # how this application will be identified in the database
 SAMPLING_PERIOD = 0.5 # in seconds (max 0.1)
+HARDWARE_BACKEND = os.environ.get('TEG_HARDWARE', 'board') # 'board' on the Raspberry Pi, 'sim' for the simulated I2C devices
+FILE_FORMAT = os.environ.get('TEG_FILE_FORMAT', 'csv') # 'csv' or 'binary' (.teg columnar files, convert with TEG_batchfile.py)
+STORAGE_MODE = os.environ.get('TEG_STORAGE_MODE', 'stream') # 'stream': samples appended to the current file as they are acquired, 'batch': whole batch written at rollover
+FSYNC_SAMPLES = 20 # stream mode: samples are made durable at least every FSYNC_SAMPLES samples...
+FSYNC_INTERVAL = 10.0 # ... and every FSYNC_INTERVAL seconds, at most this much data is lost on a power cut
+SETTLE_TIMES = None # seconds between each load switch and its ADS1015 conversion (python3 TEG_sweep.py calibrate), None for the defaults in TEG_sweep.py
+SWEEP_PLAN = None # load states of the sweep, e.g. SweepPlan([(0x00, 0.004, 1), (0x01, 0.004, 1), (0x03, 0.004, 2), ...], adaptive=3) (TEG_sweep.py), None for open circuit and the four loads with SETTLE_TIMES
+OVERSAMPLE = 1 # ADS1015 conversions averaged per load state (python3 TEG_sweep.py oversample), above 1 the files also get <channel>_std, _min and _max columns
+TEMPERATURE_PERIOD = 5.0 # seconds between thermocouple reads, carried forward on the rows in between with their age (temperature_age column), None to read them on every row
+SINK_QUEUE_DEPTH = 2 # full batches waiting for the local storage before SINK_POLICY applies (batch mode)
+SINK_POLICY = 'spill' # 'block' pauses the acquisition, 'drop-oldest'/'drop-newest' drop a batch, 'spill' writes it to SPILL_DIRECTORY until the sink caught up (see TEG_engine.py)
+SPILL_DIRECTORY = os.environ.get('TEG_SPILL_DIR', '/home/pi/Desktop/shared/spill') # batches spilled by the sinks, one subdirectory per sink
+DEPLOYMENT = os.environ.get('TEG_DEPLOYMENT', 'engine') # 'engine': one process (TEG_engine.py), 'processes': acquisition process writing a shared-memory ring read by a storage process (TEG_ring.py)
+ACQUISITION_CPU = None # processes deployment: core the acquisition process is pinned to (e.g. 3, the storage process runs on the others), None to leave it to the kernel
+ACQUISITION_PRIORITY = None # processes deployment: SCHED_FIFO priority of the acquisition process (1-99, needs root or CAP_SYS_NICE), None for the normal scheduler
+RING_SLOTS = 2*batch_size # processes deployment: samples kept in the ring for the storage process
 
 
 ##########
 # Main code
 
+plan = SWEEP_PLAN or default_plan(SETTLE_TIMES)
+header = ['Timestamp'] + plan.columns(statistics=OVERSAMPLE > 1) # voltage of every load state, temperatures, with OVERSAMPLE > 1 the standard deviation, minimum and maximum of the conversions of each state
+if TEMPERATURE_PERIOD is not None:
+    header += ['temperature_age'] # seconds since the thermocouple read carried forward on the row
+sample_buffer = SampleBuffer(batch_size, header[1:], sinks=1, scales=plan.compile(statistics=OVERSAMPLE > 1).raw_scales()) # double buffer of float64 columns, one per variable, with given batch size, and int16 raw ADS1015 codes of the voltage channels
+
 # # Uncoment to start script after pushing GPIO17 button
 # button = digitalio.DigitalInOut(board.D17)
 # button.direction = digitalio.Direction.INPUT
@@ -91,128 +120,131 @@ SAMPLING_PERIOD = 0.5 # in seconds (max 0.1)
 #         break
 #
 
-print("Starting I2C devices...")
-try:
-    i2c = board.I2C()
-    logging.info("[I2C]: raspberry pi board I2C interface was sucesfully initialized")
-except Exception as e: 
-    logging.error("[I2C]: raspberry pi board I2C interface initialization error")
-    logging.error("[I2C]: "+e) 
-    
-    
-try: 
-    pca = I2CDevice(i2c, 0x41) # creates the PCA GPIO controller at address 0x41 
-    pca.write(bytes([0x03,0x00]))# configure GPIO as output
-    logging.info("[I2C]: PCA GPIO controller was sucesfully initialized and configured")
-except Exception as e: 
-    logging.error("[I2C]: PCA GPIO controller initialization error")
-    logging.error("[I2C]: "+e)    
+ring = None
+sink_processes = []
+if DEPLOYMENT == 'processes':
+    ring = SampleRing(header[1:], RING_SLOTS) # committed samples, read by the storage process with its own cursor
+    sink_processes.append(start_sink_process('storage', storage_process, ring, 0, ACQUISITION_CPU)) # forked before the hardware is opened
+    realtime(ACQUISITION_CPU, ACQUISITION_PRIORITY)
 
+print("Starting I2C devices...")
+hw = open_hardware(HARDWARE_BACKEND) # PCA GPIO controller (0x41), ADS analog to digital converter (0x48), MCP thermocouple amplifier (0x60) and GPIO17 button
+pca = hw.pca
+adc = hw.adc # single-shot conversions, polled for conversion ready
+mcp = hw.mcp
+button = hw.button # hold for 1 SAMPLE_PERIOD to stop
 
-try: 
-    ads = ADS.ADS1015(i2c) # creates the ADS analog to digital converter at default address (0x48)
-    ads.gain = 8 # configures PGA gain to 8, resulting on range of +-0.512V (valid configurations: 2/3, 1, 2, 4, 8, 16) 
-    ads.mode = ADS.Mode.CONTINUOUS # converts at max speed, reads most recent conversion through I2C
-    chan = AnalogIn(ads, ADS.P0) # configures ADS to read analog values from channel 0
-    logging.info("[I2C]: ADS analog to digital converter was sucesfully initialized and configured")
-except Exception as e: 
-    logging.error("[I2C]: ADS analog to digital converter initialization error")
-    logging.error("[I2C]: "+e) 
-
+oversample = OVERSAMPLE
+if OVERSAMPLE > 1:
+    oversample = fit_oversample(OVERSAMPLE, SAMPLING_PERIOD, measure_read_time(adc), plan) # the sweep has to fit in the sampling period
+    logging.info("[Sweep]: "+str(oversample)+" conversions per load state (OVERSAMPLE = "+str(OVERSAMPLE)+")")
+sweep = plan.compile(oversample, OVERSAMPLE > 1) # write buffers, settle times and channels of every load state
 
-try:
-    mcp = mcp9600.MCP9600(i2c_addr=0x60) # creates the MCP thermocouple amplifier at address 0x60, default config for K-type thermocouple
-    logging.info("[I2C]: MCP thermocouple amplifier was sucesfully initialized and configured")
-except Exception as e:
-    logging.error("[I2C]: ADS analog to digital converter initialization error")
-    logging.error("[I2C]: "+e) 
+scheduler = MultiRateScheduler(SAMPLING_PERIOD) # wakes the loop up at start + k*SAMPLING_PERIOD on the monotonic clock
+if TEMPERATURE_PERIOD is not None:
+    scheduler.add_task('temperatures', TEMPERATURE_PERIOD) # due in the first slot after start + j*TEMPERATURE_PERIOD
 
+stream = None
+if STORAGE_MODE == 'stream' and ring is None:
+    stream = StreamWriter(directory, header, FILE_FORMAT, SAMPLING_PERIOD, FSYNC_SAMPLES, FSYNC_INTERVAL) # recovers the segment left by a crash or power cut
 
-# Configuring interruption button on GPIO 17 (hold for 1 SAMPLE_PERIOD to stop)
-button = digitalio.DigitalInOut(board.D17)
-button.direction = digitalio.Direction.INPUT
 
-COUNTER = 0
+###########
+# Acquisition stage, runs in the executor thread of the engine (TEG_engine.py)
 
-print("Starting acquisition...")
-while True:
+def acquire():
     
+    scheduler.wait() # sleeps until the next sampling deadline
     timestamp = datetime.utcnow()
     
     try: 
-        pca.write(bytes([0x01,0x00])) # set all transistor switches off
-        time.sleep(0.010)
-        data_list[COUNTER][1] = chan.voltage # read TEG open circuit voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x01])) # open only channel zero switch (0.1 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][2] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x02])) # open only channel one switch (0.47 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][3] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x04])) # open only channel two switch (1.5 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][4] = chan.voltage # read TEG output voltage
-        time.sleep(0.005)
-        
-        pca.write(bytes([0x01,0x08])) # open only channel three switch (4.7 ohm channel)
-        time.sleep(0.010)
-        data_list[COUNTER][5] = chan.voltage # read TEG output voltage
+        sweep.run(pca, adc, sample_buffer) # TEG open circuit voltage and output voltage of every load state
         
     except Exception as e:
-        logging.error("[I2C]: TEG I-V curve scan failed at COUNTER = "+str(COUNTER)+", timestamp = "+str(datetime.utcnow().isoformat()))
-        logging.error("[I2C]: "+e)  
+        logging.error("[I2C]: TEG I-V curve scan failed at COUNTER = "+str(sample_buffer.current.count)+", timestamp = "+str(datetime.utcnow().isoformat()))
+        logging.error("[I2C]: "+str(e))  
    
    
     try: 
-        data_list[COUNTER][6] = float(mcp.get_cold_junction_temperature()) # measure ambient temperature (cold junction)
-        
-        data_list[COUNTER][7] = float(mcp.get_hot_junction_temperature()) # measure probe temperature (hot junction)
+        if TEMPERATURE_PERIOD is None:
+            read_temperatures(mcp, sample_buffer, channels=sweep.temperature_channels) # ambient (cold junction) and probe (hot junction) temperatures
+        elif scheduler.is_due('temperatures'):
+            read_temperatures(mcp, sample_buffer, timestamp, header.index('temperature_age') - 1, sweep.temperature_channels) # held and carried forward until the next read
 
     except Exception as e:
-        logging.error("[I2C]: MCP thermocouple amplifier measurements have failed at COUNTER = "+str(COUNTER)+", timestamp = "+str(datetime.utcnow().isoformat()))
-        logging.error("[I2C]: "+e) 
-
-
-    data_list[COUNTER][0] = timestamp.isoformat()+'Z'
-
-    
-    COUNTER += 1
-
-    #print("Publishing profiling data to topic...")
-     
-
-    if COUNTER == batch_size:
-        file_name = timestamp.strftime('%Y%m%d_%H_%M')+'.csv'
-        file_write_thread = threading.Thread(target=file_writer, args = (file_name, directory, header, data_list))
-        file_write_thread.start()
-        COUNTER = 0
+        logging.error("[I2C]: MCP thermocouple amplifier measurements have failed at COUNTER = "+str(sample_buffer.current.count)+", timestamp = "+str(datetime.utcnow().isoformat()))
+        logging.error("[I2C]: "+str(e)) 
+
+
+    batch = sample_buffer.commit(timestamp) # returns the full batch at rollover, the loop continues on a free buffer
+    if stream is not None:
+        stream.append(sample_buffer.current if batch is None else batch) # last committed sample, written by the stream writer thread
+    if ring is not None:
+        ring.append(sample_buffer.current if batch is None else batch) # last committed sample, for the storage process
+
+    if batch is not None:
+        if stream is not None:
+            stream.rotate(batch_file_name(batch)) # current segment is made durable and renamed, in order with the appends
+            batch.release() # nothing left for the storage sink
+        elif ring is not None:
+            batch.release() # the storage process rebuilds the batch from the ring
         print(str(batch_size)+" data points sucessfully recorded")
         logging.info("[Events]: "+str(batch_size)+" data points sucessfully recorded at "+str(timestamp))
-        
+        logging.info("[Scheduler]: "+scheduler.summary())
+        if stream is not None:
+            logging.info("[Stream]: "+stream.summary())
+        if engine is not None:
+            logging.info("[Engine]: "+engine.summary())
+        else:
+            logging.info("[Ring]: "+ring.summary(len(sink_processes)))
+        scheduler.reset_stats()
     
-    # Hold button on GPIO17 to exit script
-    if button.value == False:
-        break
-       
-    delay = (datetime.utcnow() - timestamp).microseconds
-    # print(max(SAMPLING_PERIOD - delay*(10**-6),0.01))
-    time.sleep(max(SAMPLING_PERIOD - delay*(10**-6),0.01))
+    return batch
 
-print("TEG profiler local script interrupted")    
-logging.info('[Events]: TEG profiler local script interrupted at '+str(datetime.utcnow().isoformat()))    
-client.loop_stop()
-print("data acquisition complete")
 
+def stop():
+    # Hold button on GPIO17 to exit script
+    return button.value == False
 
 
+def flush():
+    # partial batch since the last rollover, handed to the sinks before the engine drains them
+    if not sample_buffer.current.count:
+        return None
+    batch = sample_buffer.rollover()
+    if stream is not None:
+        stream.rotate(batch_file_name(batch))
+        batch.release()
+    elif ring is not None:
+        batch.release()
+    logging.info("[Events]: "+str(batch.count)+" data points of the partial batch stored")
+    return batch
 
 
-    
+engine = None
+if ring is None:
+    engine = AcquisitionEngine(acquire, stop, flush)
+    if stream is None:
+        engine.add_sink('storage', file_writer, SINK_QUEUE_DEPTH, SINK_POLICY, os.path.join(SPILL_DIRECTORY, 'storage'))
+
+print("Starting acquisition...")
+if engine is not None:
+    engine.run() # returns once the GPIO17 button was held and the sinks are drained
+else:
+    while not stop():
+        acquire()
+    flush()
+    stop_sink_processes(ring, sink_processes) # the storage process reads the ring to the end and stores the partial batch
 
 
+print("TEG profiler local script interrupted")    
+logging.info('[Events]: TEG profiler local script interrupted at '+str(datetime.utcnow().isoformat()))    
+if engine is not None:
+    logging.info("[Engine]: "+engine.summary())
+if ring is not None:
+    logging.info("[Ring]: "+ring.summary(len(sink_processes)))
+    ring.release()
+if stream is not None:
+    stream.close() # waits for the stream writer to make the last segment durable
+    logging.info("[Stream]: "+stream.summary())
+print("data acquisition complete")
@@ -1,36 +1,82 @@
-from os import listdir
-from os.path import isfile, join
+from os.path import join
+import os
+import sys
 import requests
 import json
-import time
 import csv
 
-storage_path = '/home/pi/Desktop/shared/data'
+from TEG_upload import Manifest, UploadPool
 
-server_address = "???.???.??.?:??" # format is IP:port 
+# Uploads the batch files the server has not acknowledged yet (python3 TEG_profiler_upload.py [--full])
+# --full scans the data directory even if it has not changed since the last complete run
 
-with open("/home/pi/Desktop/Application_info.txt") as json_appInfo:
+storage_path = os.environ.get('TEG_DATA_DIR', '/home/pi/Desktop/shared/data')
+index_path = os.environ.get('TEG_UPLOAD_INDEX', '/home/pi/Desktop/shared/TEG_local_storage_list.txt') # files uploaded by this run
+manifest_path = os.environ.get('TEG_UPLOAD_MANIFEST', '/home/pi/Desktop/shared/TEG_upload_manifest.json') # files acknowledged by the server
+
+server_address = os.environ.get('TEG_UPLOAD_SERVER', "???.???.??.?:??") # format is IP:port 
+UPLOAD_WORKERS = 4 # files uploaded in parallel over keep-alive connections
+UPLOAD_TIMEOUT = (5, 60) # connect and read timeout of each request, in seconds
+UPLOAD_RETRIES = 4 # retries with exponential backoff after connection errors, timeouts, 429 and 5xx
+UPLOAD_PART_SIZE = None # bytes, e.g. 256*1024 for resumable chunked uploads (server support needed), None for one POST per file
+BUNDLE_THRESHOLD = None # e.g. 20: more pending files than this are sent as compressed tar bundles (server support needed)
+BUNDLE_FILES = 96 # files per bundle (one day of 15-minute files)
+BUNDLE_ENCODING = None # 'gzip' or 'zstd', None for zstd when the zstandard module is installed
+
+with open(os.environ.get('TEG_APP_INFO', "/home/pi/Desktop/Application_info.txt")) as json_appInfo:
 	APP_INFO = json.load(json_appInfo)
 
 APP_ID = APP_INFO["APP_ID"]
 
-filename_list = [f for f in listdir(storage_path) if isfile(join(storage_path, f))]
+manifest = Manifest(manifest_path)
+directory_mtime = os.stat(storage_path).st_mtime_ns
+
+if '--full' not in sys.argv and manifest.unchanged(storage_path):
+	print("No new files since the last upload")
+	sys.exit(0)
+
+pending = manifest.scan(storage_path) # new or changed files, sorted by name
 
-filename_list.sort()
+pool = UploadPool("http://"+server_address+"/upload", {'APP_ID':APP_ID}, workers=UPLOAD_WORKERS, timeout=UPLOAD_TIMEOUT, retries=UPLOAD_RETRIES, part_size=UPLOAD_PART_SIZE)
 
-with open('/home/pi/Desktop/shared/TEG_local_storage_list.txt', 'w') as file:
-	csvwriter = csv.writer(file)
-	for row in filename_list:
-		csvwriter.writerow([row])
+if pending:
+	with open(index_path, 'w') as file:
+		csvwriter = csv.writer(file)
+		for filename, entry in pending:
+			csvwriter.writerow([filename])
 
-with open('/home/pi/Desktop/shared/TEG_local_storage_list.txt') as txt_file:
-	r=requests.post("http://"+server_address+"/upload", files={'upload':txt_file}, headers={'APP_ID':APP_ID})
-	time.sleep(0.2)
+	try:
+		pool.upload(index_path) # the index goes first, the data files follow in any order
+	except (OSError, requests.RequestException) as e:
+		print("Upload of the index failed: "+str(e))
 
-for filename in filename_list:
-	with open(join(storage_path, filename)) as csv_file:
-		r=requests.post("http://"+server_address+"/upload", files={'upload':csv_file}, headers={'APP_ID':APP_ID})
-		time.sleep(0.2)
+failed = 0
+count = 0
+items = [(join(storage_path, filename), (filename, entry)) for filename, entry in pending]
+if BUNDLE_THRESHOLD is not None and len(pending) > BUNDLE_THRESHOLD:
+	results = pool.upload_bundles(items, BUNDLE_ENCODING, BUNDLE_FILES) # backfill
+else:
+	results = pool.upload_many(items)
 
+for (filename, entry), result in results:
+	if isinstance(result, Exception):
+		print("Upload of "+filename+" failed: "+str(result))
+		failed += 1
+	elif 200 <= result.status_code < 300:
+		manifest.acknowledge(filename, entry, result.status_code, result.text)
+		count += 1
+		if count % 20 == 0: # keeps the acknowledgements if the run is interrupted
+			manifest.save()
+	else:
+		print("Upload of "+filename+" refused, status code "+str(result.status_code))
+		failed += 1
+pool.close()
 
+if pending:
+	manifest.save()
+if not failed:
+	manifest.mark_clean(storage_path, directory_mtime) # next run ends right away unless the directory changes
 
+print(str(len(pending) - failed)+" files uploaded, "+str(failed)+" failed, "+str(len(manifest))+" files in the manifest")
+if pending:
+	print(pool.summary())
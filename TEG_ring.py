@@ -0,0 +1,369 @@
+################################################
+#
+# TEG profiler shared-memory sample ring
+#
+# University of Virginia
+#
+################################################
+#
+# Deployment with the acquisition in its own process: the acquisition process appends every
+# committed sample to a ring of fixed-size records in shared memory, and the storage and upload
+# processes read it with their own cursors. CSV formatting, message encoding, the MQTT network
+# loop and their logging then run under other interpreters and do not hold the GIL of the
+# sampling loop. The acquisition process can be pinned to a core and run with SCHED_FIFO.
+#
+# Shared memory layout (little endian):
+#
+#   int64     head, number of records appended since the ring was created
+#   int64     closed, 1 once the acquisition process stopped appending
+#   int64     [MAX_READERS] cursors, next record of each reader (written by the reader only)
+#   records   [slots] of int64 sequence, int64 timestamp (us), float64 [channels] values, uint32 CRC32
+#
+# The ring is lock-free with a single writer: the record of sequence number s goes to slot
+# s % slots and head is increased after the record is written. The writer never waits for the
+# readers; a reader that falls more than `slots` records behind loses the overwritten ones. The
+# CRC32 covers sequence, timestamp and values, so a reader never takes a record that is half
+# written or that is already from the next lap, whatever order the stores become visible in.
+#
+#   python3 TEG_ring.py bench [--period s] [--batch n] [--batches n]   rollover jitter, one process vs acquisition process
+
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from TEG_buffer import SampleBatch
+
+
+MAX_READERS = 8
+HEADER_BYTES = 8*(2 + MAX_READERS)
+
+
+def record_dtype(channels):
+    return np.dtype([('sequence', '<i8'), ('timestamp', '<i8'), ('values', '<f8', (channels,)), ('crc', '<u4')])
+
+
+###########
+# Ring
+
+class SampleRing:
+
+    def __init__(self, channels, slots, name=None):
+        # creates the ring, or attaches to the ring called name
+        self.channels = list(channels)
+        self.slots = slots
+        self.dtype = record_dtype(len(self.channels))
+        size = HEADER_BYTES + slots*self.dtype.itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.name = self.shm.name
+        self._state = np.ndarray(2 + MAX_READERS, dtype='<i8', buffer=self.shm.buf) # head, closed, cursors
+        self.records = np.ndarray(slots, dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_BYTES)
+        self._crc_bytes = self.dtype.fields['crc'][1] # CRC32 of the bytes before it
+        if self.owner:
+            self._state[:] = 0
+            self.records['sequence'] = -1
+        self._view = self.records.view(np.uint8).reshape(slots, self.dtype.itemsize)
+
+    @property
+    def head(self):
+        return int(self._state[0])
+
+    @property
+    def closed(self):
+        return bool(self._state[1])
+
+    def append(self, batch):
+        # appends the last committed row of batch (writer process only)
+        batch.finalize() # raw codes of the row to values
+        row = batch.count - 1
+        sequence = int(self._state[0])
+        slot = sequence % self.slots
+        record = self.records[slot]
+        record['sequence'] = sequence
+        record['timestamp'] = batch.timestamp[row]
+        record['values'] = batch.values[:, row]
+        record['crc'] = zlib.crc32(self._view[slot, :self._crc_bytes])
+        self._state[0] = sequence + 1
+
+    def close(self):
+        self._state[1] = 1
+
+    def reader(self, index):
+        if not 0 <= index < MAX_READERS:
+            raise ValueError("ring reader index out of range: "+str(index))
+        return RingReader(self, index)
+
+    def stats(self, readers):
+        head = self.head
+        lag = [head - int(self._state[2 + index]) for index in range(readers)]
+        return {'head': head, 'lag': lag, 'slots': self.slots}
+
+    def summary(self, readers):
+        stats = self.stats(readers)
+        return ("%d samples appended, reader lag %s of %d slots" %
+                (stats['head'], '/'.join(str(lag) for lag in stats['lag']), stats['slots']))
+
+    def release(self):
+        # detaches, and removes the shared memory in the process that created it
+        self._state = self.records = self._view = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingReader:
+
+    def __init__(self, ring, index):
+        self.ring = ring
+        self.index = index
+        self.cursor = int(ring._state[2 + index])
+        self.lost = 0 # records overwritten before they were read
+
+    def read(self, max_rows=None):
+        # valid records from the cursor on as (sequences, timestamps, values [rows][channels]) copies
+        ring = self.ring
+        head = ring.head
+        if head - self.cursor > ring.slots:
+            self.lost += head - self.cursor - ring.slots
+            self.cursor = head - ring.slots
+        end = head if max_rows is None else min(head, self.cursor + max_rows)
+        slots = np.arange(self.cursor, end) % ring.slots
+        records = ring.records[slots] # copy
+        view = records.view(np.uint8).reshape(len(records), ring.dtype.itemsize)
+        valid = 0
+        for i in range(len(records)):
+            if records['sequence'][i] != self.cursor + i or zlib.crc32(view[i, :ring._crc_bytes]) != records['crc'][i]:
+                break # not visible yet, or overwritten while copying
+            valid += 1
+        oldest = ring.head - ring.slots
+        if valid < len(records) and oldest > self.cursor + valid:
+            self.lost += oldest - self.cursor # lapped while copying, read again from the oldest record
+            self.cursor = oldest
+            return self.read(max_rows)
+        records = records[:valid]
+        self.cursor += valid
+        ring._state[2 + self.index] = self.cursor
+        return records['sequence'], records['timestamp'], records['values']
+
+    def caught_up(self):
+        return self.cursor >= self.ring.head
+
+
+###########
+# Sink processes
+
+def run_ring_sink(reader, batch_size, on_batch, on_row=None, poll_interval=0.1):
+    # rebuilds the batches of the acquisition process from the ring (batch k holds sequence numbers
+    # k*batch_size to (k+1)*batch_size - 1) and calls on_batch(batch) for each, on_row(batch) after
+    # every row if given. Returns after the partial batch once the ring is closed and read to the end.
+    batch = SampleBatch(batch_size, reader.ring.channels)
+    batch.reset(reader.cursor//batch_size)
+    while True:
+        closed = reader.ring.closed # before reading, so nothing appended before closing is missed
+        sequences, timestamps, values = reader.read()
+        for i in range(len(sequences)):
+            number = int(sequences[i])//batch_size
+            if number != batch.sequence:
+                if batch.count:
+                    on_batch(batch)
+                batch.reset(number)
+            batch.timestamp[batch.count] = timestamps[i]
+            batch.values[:, batch.count] = values[i]
+            batch.count += 1
+            batch.converted = batch.count
+            if on_row is not None:
+                on_row(batch)
+            if batch.count == batch_size:
+                on_batch(batch)
+                batch.reset(number + 1)
+        if closed and reader.caught_up():
+            if batch.count:
+                on_batch(batch)
+            return
+        if not len(sequences):
+            time.sleep(poll_interval)
+
+
+def _sink_main(ring_name, channels, slots, index, target, avoid_cpu):
+    if avoid_cpu is not None:
+        cpus = os.sched_getaffinity(0) - {avoid_cpu}
+        if cpus:
+            os.sched_setaffinity(0, cpus) # the acquisition core is left alone
+    ring = SampleRing(channels, slots, ring_name)
+    try:
+        target(ring.reader(index))
+    except Exception as e:
+        logging.error("[Ring]: sink process "+str(index)+" failed")
+        logging.error("[Ring]: "+str(e))
+        raise
+    finally:
+        ring.release()
+
+
+def start_sink_process(name, target, ring, index, avoid_cpu=None):
+    # target(reader) runs in a forked process with the globals of the script; fork before opening
+    # the hardware and before starting any thread or MQTT session in the acquisition process
+    process = multiprocessing.get_context('fork').Process(
+        target=_sink_main, name=name, args=(ring.name, ring.channels, ring.slots, index, target, avoid_cpu))
+    process.start()
+    return process
+
+
+def stop_sink_processes(ring, processes, timeout=120.0):
+    # closes the ring and waits until every sink process read it to the end
+    ring.close()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            logging.error("[Ring]: sink process "+process.name+" did not finish in "+str(timeout)+" s, terminated")
+            process.terminate()
+            process.join()
+        elif process.exitcode:
+            logging.error("[Ring]: sink process "+process.name+" exited with code "+str(process.exitcode))
+
+
+###########
+# Real-time acquisition process
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def realtime(cpu=None, priority=None, lock_memory=True):
+    # pins the calling process to cpu, switches it to SCHED_FIFO with priority and locks its memory
+    # (no page faults in the sampling loop); each step is skipped with a warning if not permitted
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+            logging.info("[Ring]: acquisition process pinned to CPU "+str(cpu))
+        except OSError as e:
+            logging.warning("[Ring]: acquisition process could not be pinned to CPU "+str(cpu)+": "+str(e))
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            logging.info("[Ring]: acquisition process running with SCHED_FIFO priority "+str(priority))
+            if lock_memory:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                    logging.warning("[Ring]: memory could not be locked: "+os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logging.warning("[Ring]: SCHED_FIFO priority "+str(priority)+" not set (needs root or CAP_SYS_NICE): "+str(e))
+
+
+###########
+# Rollover jitter, one process vs acquisition process (python3 TEG_ring.py bench)
+#
+# The simulated hardware is swept at the given period and every batch is written as CSV and encoded
+# into batch messages, either by the engine sinks in the same process or by two sink processes
+# reading the ring. The sinks repeat their work `repeat` times per batch, so short batches cost
+# what a full 1800 sample batch would at rollover. The scheduler lateness of the slots right after
+# each rollover shows the jitter.
+
+def jitter_benchmark(layout, period=0.05, batch_size=100, batches=6, repeat=18, window=25, cpu=None, priority=None):
+    import shutil
+    import tempfile
+    from datetime import datetime
+    from TEG_batchfile import write_batch_csv
+    from TEG_buffer import SampleBuffer
+    from TEG_engine import AcquisitionEngine
+    from TEG_hardware import open_hardware
+    from TEG_scheduler import DeadlineScheduler
+    from TEG_sweep import iv_sweep, raw_scales, read_temperatures
+    from TEG_telemetry import encode_messages
+
+    channels = ['voltage_chan_OFF', 'voltage_chan_0', 'voltage_chan_1', 'voltage_chan_2', 'voltage_chan_3', 'temperature_amb', 'temperature_hot']
+    directory = tempfile.mkdtemp()
+
+    def store(batch):
+        for i in range(repeat):
+            write_batch_csv(os.path.join(directory, '%d.csv' % batch.sequence), ['Timestamp'] + channels, batch)
+
+    def upload(batch):
+        for i in range(repeat):
+            for message in encode_messages('bench', batch, 'batch', 60):
+                pass
+
+    ring = processes = engine = None
+    if layout == 'processes':
+        ring = SampleRing(channels, 2*batch_size)
+        processes = [start_sink_process('storage', lambda reader: run_ring_sink(reader, batch_size, store, poll_interval=period), ring, 0, cpu),
+                     start_sink_process('cloud', lambda reader: run_ring_sink(reader, batch_size, upload, poll_interval=period), ring, 1, cpu)]
+        realtime(cpu, priority)
+
+    hw = open_hardware('sim', duration=3600)
+    sample_buffer = SampleBuffer(batch_size, channels, sinks=1 if layout == 'processes' else 2, scales=raw_scales())
+    scheduler = DeadlineScheduler(period)
+    lateness = []
+
+    def acquire():
+        scheduler.wait()
+        lateness.append(scheduler.lateness)
+        timestamp = datetime.utcnow()
+        iv_sweep(hw.pca, hw.adc, sample_buffer)
+        read_temperatures(hw.mcp, sample_buffer)
+        batch = sample_buffer.commit(timestamp)
+        if ring is not None:
+            ring.append(sample_buffer.current if batch is None else batch)
+            if batch is not None:
+                batch.release()
+                return None
+        return batch
+
+    try:
+        if layout == 'processes':
+            while len(lateness) < batch_size*batches:
+                acquire()
+            stop_sink_processes(ring, processes)
+        else:
+            engine = AcquisitionEngine(acquire, lambda: len(lateness) >= batch_size*batches)
+            engine.add_sink('storage', store, 2, 'block')
+            engine.add_sink('cloud', upload, 2, 'block')
+            engine.run()
+    finally:
+        if ring is not None:
+            ring.release()
+        shutil.rmtree(directory)
+
+    lateness = np.array(lateness)*1000
+    after = np.zeros(len(lateness), dtype=bool)
+    for start in range(batch_size, len(lateness), batch_size):
+        after[start:start + window] = True # slots after a rollover
+    return {
+        'rollover_mean': lateness[after].mean(),
+        'rollover_std': lateness[after].std(),
+        'rollover_max': lateness[after].max(),
+        'steady_mean': lateness[~after].mean(),
+        'steady_std': lateness[~after].std(),
+        'steady_max': lateness[~after].max(),
+        'skipped': scheduler.skipped,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="shared-memory sample ring")
+    parser.add_argument('command', nargs='?', default='bench', choices=['bench'])
+    parser.add_argument('--period', type=float, default=0.05, help="sampling period in seconds (the simulated sweep takes about 30 ms)")
+    parser.add_argument('--batch', type=int, default=100, help="samples per batch")
+    parser.add_argument('--batches', type=int, default=6, help="batches acquired per layout")
+    parser.add_argument('--repeat', type=int, default=18, help="sink work per batch, in batches")
+    parser.add_argument('--cpu', type=int, default=None, help="processes layout: core of the acquisition process")
+    parser.add_argument('--priority', type=int, default=None, help="processes layout: SCHED_FIFO priority of the acquisition process")
+    args = parser.parse_args()
+
+    print("sim sweep every %.0f ms, %d batches of %d samples, sinks working %dx per batch, lateness in ms (rollover: %d slots after each rollover)" %
+          (args.period*1000, args.batches, args.batch, args.repeat, 25))
+    print("%-10s %15s %15s %15s %15s %8s" % ('layout', 'rollover mean', 'rollover max', 'steady mean', 'steady max', 'skipped'))
+    for layout in ('engine', 'processes'):
+        result = jitter_benchmark(layout, args.period, args.batch, args.batches, args.repeat, cpu=args.cpu, priority=args.priority)
+        print("%-10s %8.3f ±%5.3f %15.3f %8.3f ±%5.3f %15.3f %8d" %
+              (layout, result['rollover_mean'], result['rollover_std'], result['rollover_max'],
+               result['steady_mean'], result['steady_std'], result['steady_max'], result['skipped']))
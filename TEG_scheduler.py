@@ -0,0 +1,146 @@
+################################################
+#
+# TEG profiler sampling scheduler
+#
+# University of Virginia
+#
+################################################
+
+import time
+
+
+###########
+# Absolute deadline scheduler
+#
+# Sampling slot k starts at start + k*period on the monotonic clock, so the sampling rate does not
+# drift with the loop run time and wall-clock (NTP) steps do not affect it. wait() sleeps once per
+# slot until its deadline. If the loop overran the deadline the slot starts late, and slots that
+# were missed entirely are skipped instead of being run back to back.
+
+class DeadlineScheduler:
+
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        self.slot = 0 # index of the current slot
+        self.deadline = None # start time of the current slot
+        self.lateness = 0.0 # seconds between the deadline and the wake up of the current slot
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0 # slots that started late because the previous iteration overran
+        self.skipped = 0 # slots that were missed entirely
+        self.max_lateness = 0.0
+        self._lateness_sum = 0.0
+
+    def wait(self):
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+            self.slot = 0
+            self.deadline = now
+        else:
+            self.slot += 1
+            self.deadline = self.start + self.slot*self.period
+            if now < self.deadline:
+                self.sleep(self.deadline - now)
+                now = self.clock()
+            else:
+                self.overruns += 1
+                missed = int((now - self.deadline)/self.period)
+                if missed:
+                    self.skipped += missed
+                    self.slot += missed
+                    self.deadline += missed*self.period
+        self.lateness = now - self.deadline
+        self.ticks += 1
+        self._lateness_sum += self.lateness
+        if self.lateness > self.max_lateness:
+            self.max_lateness = self.lateness
+        return self.slot
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'mean_lateness': self._lateness_sum/self.ticks if self.ticks else 0.0,
+            'max_lateness': self.max_lateness,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("%d ticks, %d overruns, %d skipped slots, lateness mean %.3f ms max %.3f ms" %
+                (stats['ticks'], stats['overruns'], stats['skipped'], stats['mean_lateness']*1000, stats['max_lateness']*1000))
+
+
+###########
+# Multi-rate scheduler
+#
+# Base slots at the period of the fastest task (the I-V sweep), as above. Slower tasks (thermocouple
+# reads, housekeeping) have their own period: a task is due in the first slot that starts at or
+# after its deadline start + phase + j*task_period. Missed task deadlines are skipped like slots,
+# so a slow task runs at most once per slot.
+
+class MultiRateScheduler(DeadlineScheduler):
+
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.tasks = {} # name: [period, offset of the next deadline from start]
+        self.runs = {}
+        DeadlineScheduler.__init__(self, period, clock, sleep)
+        self.due = set() # tasks due in the current slot
+
+    def add_task(self, name, period, phase=0.0):
+        self.tasks[name] = [period, phase]
+        self.runs[name] = 0
+
+    def reset_stats(self):
+        DeadlineScheduler.reset_stats(self)
+        for name in self.runs:
+            self.runs[name] = 0
+
+    def wait(self):
+        slot = DeadlineScheduler.wait(self)
+        offset = self.deadline - self.start + 1e-9 # slot start, rounding margin for the float multiples
+        self.due = set()
+        for name, task in self.tasks.items():
+            period, deadline = task
+            if offset >= deadline:
+                self.due.add(name)
+                self.runs[name] += 1
+                task[1] = deadline + (int((offset - deadline)/period) + 1)*period
+        return slot
+
+    def is_due(self, name):
+        return name in self.due
+
+    def stats(self):
+        stats = DeadlineScheduler.stats(self)
+        stats['task_runs'] = dict(self.runs)
+        return stats
+
+    def summary(self):
+        summary = DeadlineScheduler.summary(self)
+        if self.runs:
+            summary += ", "+", ".join("%s %d runs" % (name, runs) for name, runs in sorted(self.runs.items()))
+        return summary
+
+
+if __name__ == '__main__':
+    import random
+    import sys
+
+    # python TEG_scheduler.py [period] [ticks]: runs a loop with a random 0-60% work load per period
+    # and a task every 10 periods
+    period = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    scheduler = MultiRateScheduler(period)
+    scheduler.add_task('slow', 10*period)
+    for i in range(ticks):
+        scheduler.wait()
+        time.sleep(random.uniform(0, 0.6*period))
+    print(scheduler.summary())
+    print("slot %d started %.3f ms after start + %d*period" % (scheduler.slot, scheduler.lateness*1000, scheduler.slot))
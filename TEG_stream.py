@@ -0,0 +1,423 @@
+################################################
+#
+# TEG profiler streaming writer
+#
+# University of Virginia
+#
+################################################
+#
+# Appends every sample to the current segment file as it is acquired, instead of writing the whole
+# batch at rollover. Samples are kept in memory and written with one write + fsync when
+# `fsync_samples` samples are pending or the oldest pending sample is `fsync_interval` seconds old,
+# so a crash or power cut loses at most that window instead of the whole batch.
+#
+# The current segment is <time of first sample>.csv.part (or .teg.part). At rollover the segment is
+# fsynced, closed and atomically renamed to the batch file name, so readers (and the upload script)
+# only ever see complete files. On startup left-over .part segments are recovered: torn records at
+# the end are truncated and the segment is renamed after the time of its last sample.
+#
+# CSV segments have the same layout as the batch CSV files. Binary segments are .teg files with
+# "layout": "rows" (see TEG_batchfile.py): one fixed-size record with a CRC32 per sample.
+#
+#   python3 TEG_stream.py bench [--dir DIR] [--rows 7200] [--format csv]
+#       compares bytes written, fsyncs, estimated SD card writes and lost-sample window of the fsync
+#       policies against the end-of-batch dump
+#   python3 TEG_stream.py recover DIR
+#       recovers the .part segments in DIR
+
+import io
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from TEG_batchfile import EXTENSIONS, binary_header, read_binary_header, row_record_dtype
+from TEG_buffer import EPOCH, from_epoch_us, iso_timestamps
+
+
+PART = '.part'
+PAGE_SIZE = 4096 # page cache / SD card write unit used for the write estimate
+
+
+###########
+# Record encoding
+
+def csv_record(timestamp, values):
+    # same text as csv.writer writes in the batch CSV files
+    return (str(iso_timestamps(np.array([timestamp], dtype=np.int64))[0]) + ',' + ','.join([repr(v) for v in values.tolist()]) + '\r\n').encode()
+
+
+def binary_record(record, timestamp, values):
+    body = record.pack(timestamp, *values.tolist())
+    return body + struct.pack('<I', zlib.crc32(body))
+
+
+def segment_name(timestamp, file_format):
+    # final name of a segment, same as the batch file names of the profiler scripts
+    return from_epoch_us(timestamp).strftime('%Y%m%d_%H_%M') + EXTENSIONS[file_format]
+
+
+###########
+# Startup recovery
+
+def _valid_csv(data):
+    # length of the complete, well-formed CSV lines at the start of data, number of samples and last timestamp
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].split(b'\n')[:-1]
+    if not lines:
+        return 0, 0, None
+    fields = lines[0].count(b',')
+    while len(lines) > 1 and (b'\x00' in lines[-1] or lines[-1].count(b',') != fields):
+        end -= len(lines.pop()) + 1
+    if len(lines) < 2:
+        return end, 0, None
+    last = np.array([lines[-1].split(b',', 1)[0].decode().rstrip('Z')], dtype='datetime64[us]')
+    return end, len(lines) - 1, int((last - np.datetime64(EPOCH, 'us')).astype(np.int64)[0])
+
+
+def _valid_binary(data):
+    try:
+        header, offset = read_binary_header(io.BytesIO(data))
+    except ValueError:
+        return 0, 0, None
+    size = row_record_dtype(len(header['channels'])).itemsize
+    end = offset
+    last = None
+    while end + size <= len(data):
+        body = data[end:end + size - 4]
+        if zlib.crc32(body) != struct.unpack_from('<I', data, end + size - 4)[0]:
+            break
+        last = struct.unpack_from('<q', body)[0]
+        end += size
+    return end, (end - offset)//size, last
+
+
+def recover_segment(path):
+    # truncates torn records and renames the segment, returns (final path or None, samples, truncated bytes)
+    file_format = 'binary' if path.endswith(EXTENSIONS['binary'] + PART) else 'csv'
+    with open(path, 'r+b') as file:
+        data = file.read()
+        end, rows, last = (_valid_binary if file_format == 'binary' else _valid_csv)(data)
+        if rows:
+            file.truncate(end)
+            file.flush()
+            os.fsync(file.fileno())
+    if not rows:
+        os.remove(path)
+        return None, 0, len(data)
+
+    directory = os.path.dirname(path)
+    name = segment_name(last, file_format)
+    final = os.path.join(directory, name)
+    number = 1
+    while os.path.exists(final): # never overwrite a complete batch file
+        final = os.path.join(directory, name.replace('.', '_%d.' % number, 1))
+        number += 1
+    os.replace(path, final)
+    fsync_directory(directory)
+    return final, rows, len(data) - end
+
+
+def recover_segments(directory):
+    recovered = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(PART):
+            final, rows, truncated = recover_segment(os.path.join(directory, name))
+            logging.warning("[Stream]: recovered %d samples from %s as %s, %d bytes truncated" % (rows, name, final, truncated))
+            recovered.append((final, rows, truncated))
+    return recovered
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+###########
+# Streaming writer
+#
+# append() is called by the acquisition loop after every commit and only encodes the sample and
+# queues it; writes, fsyncs and renames happen on the writer thread (threaded=False does them
+# inline, used by the benchmark with a simulated clock).
+
+class StreamWriter:
+
+    def __init__(self, directory, header, file_format='csv', sample_period=None, fsync_samples=20, fsync_interval=10.0,
+                 threaded=True, clock=time.monotonic):
+        if file_format not in EXTENSIONS:
+            raise ValueError("unknown file format: "+str(file_format))
+        self.directory = directory
+        self.header = list(header)
+        self.file_format = file_format
+        self.sample_period = sample_period
+        self.fsync_samples = fsync_samples # None: no limit on the number of pending samples
+        self.fsync_interval = fsync_interval # None: no limit on the age of pending samples
+        self.clock = clock
+        self._record = struct.Struct('<q%dd' % (len(self.header) - 1))
+
+        self.recovered = recover_segments(directory)
+        self._fd = None
+        self._part = None
+        self._offset = 0
+        self._pending = []
+        self._unsynced = 0 # samples appended but not durable yet
+        self._oldest = None # clock() when the oldest of them was appended
+
+        self.samples = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.pages = 0 # PAGE_SIZE pages dirtied between fsyncs, estimate of the SD card writes
+        self.segments = 0
+        self.max_unsynced = 0
+        self.max_unsynced_time = 0.0
+
+        self._queue = None
+        if threaded:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='stream-writer', daemon=True)
+            self._thread.start()
+
+    ###########
+    # Acquisition loop side
+
+    def append(self, batch):
+        # appends the last committed row of batch
+        batch.finalize() # raw codes of the row to values
+        row = batch.count - 1
+        timestamp = int(batch.timestamp[row])
+        values = batch.values[:, row]
+        if self.file_format == 'binary':
+            record = binary_record(self._record, timestamp, values)
+        else:
+            record = csv_record(timestamp, values)
+        self._submit(('row', timestamp, record))
+
+    def rotate(self, file_name):
+        # makes the current segment durable and renames it to file_name
+        self._submit(('rotate', file_name))
+
+    def flush(self):
+        self._submit(('flush',))
+
+    def close(self, file_name=None, timeout=30.0):
+        # flushes the partial segment (renamed to file_name if given) and stops the writer thread
+        if file_name is not None:
+            self.rotate(file_name)
+        else:
+            self.flush()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _submit(self, item):
+        if self._queue is not None:
+            self._queue.put(item)
+        else:
+            self._process(item)
+
+    ###########
+    # Writer thread
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval or 1.0)
+            except queue.Empty:
+                item = ('tick',)
+            if item is None:
+                return
+            try:
+                self._process(item)
+            except Exception as e:
+                logging.error("[Stream]: "+str(e))
+
+    def _process(self, item):
+        kind = item[0]
+        if kind == 'row':
+            if self._fd is None:
+                self._open(item[1])
+            self._pending.append(item[2])
+            self.samples += 1
+            self._unsynced += 1
+            if self._oldest is None:
+                self._oldest = self.clock()
+        elif kind == 'rotate':
+            self._rotate(item[1])
+            return
+        elif kind == 'flush':
+            self._sync()
+            return
+
+        if self._unsynced:
+            age = self.clock() - self._oldest
+            if (self.fsync_samples and self._unsynced >= self.fsync_samples) or (self.fsync_interval is not None and age >= self.fsync_interval):
+                self._sync()
+
+    def _open(self, timestamp):
+        name = from_epoch_us(timestamp).strftime('%Y%m%d_%H_%M_%S') + EXTENSIONS[self.file_format] + PART
+        self._part = os.path.join(self.directory, name)
+        self._fd = os.open(self._part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._offset = 0
+        if self.file_format == 'binary':
+            self._pending.append(binary_header(self.header[1:], None, self.sample_period, layout='rows'))
+        else:
+            self._pending.append((','.join(self.header) + '\r\n').encode())
+
+    def _sync(self):
+        if self._fd is None or not self._pending:
+            return
+        if self._unsynced:
+            self.max_unsynced = max(self.max_unsynced, self._unsynced)
+            self.max_unsynced_time = max(self.max_unsynced_time, self.clock() - self._oldest)
+        data = b''.join(self._pending)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+        os.fsync(self._fd)
+        start = self._offset
+        self._offset += len(data)
+        self.pages += (self._offset + PAGE_SIZE - 1)//PAGE_SIZE - start//PAGE_SIZE
+        self.bytes_written += len(data)
+        self.writes += 1
+        self.fsyncs += 1
+        self._pending = []
+        self._unsynced = 0
+        self._oldest = None
+
+    def _rotate(self, file_name):
+        if self._fd is None:
+            return
+        self._sync()
+        os.close(self._fd)
+        os.replace(self._part, os.path.join(self.directory, file_name))
+        fsync_directory(self.directory)
+        self.fsyncs += 1
+        self.segments += 1
+        self._fd = None
+        self._part = None
+
+    ###########
+    # Statistics
+
+    def stats(self):
+        return {
+            'samples': self.samples,
+            'bytes_written': self.bytes_written,
+            'writes': self.writes,
+            'fsyncs': self.fsyncs,
+            'pages': self.pages,
+            'segments': self.segments,
+            'max_unsynced_samples': self.max_unsynced,
+            'max_unsynced_time': self.max_unsynced_time,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("%d samples, %d bytes in %d writes, %d fsyncs, %d segments, lost-sample window max %d samples / %.1f s" %
+                (stats['samples'], stats['bytes_written'], stats['writes'], stats['fsyncs'], stats['segments'],
+                 stats['max_unsynced_samples'], stats['max_unsynced_time']))
+
+
+###########
+# Write amplification and lost-sample window (python3 TEG_stream.py bench)
+#
+# SD card writes are estimated as the PAGE_SIZE pages dirtied between fsyncs plus one metadata page
+# per fsync (inode/journal update). On a real disk the block-layer bytes from /proc/self/io are
+# printed as well.
+
+POLICIES = [
+    ('every sample', 1, None),
+    ('every 10 samples', 10, None),
+    ('every 20 samples / 10 s', 20, 10.0),
+    ('every 120 samples', 120, None),
+    ('every 60 s', None, 60.0),
+    ('every 300 s', None, 300.0),
+]
+
+
+def block_writes():
+    try:
+        with open('/proc/self/io') as file:
+            for line in file:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def benchmark(directory, rows=7200, period=0.5, file_format='csv'):
+    from TEG_batchfile import write_batch
+    from TEG_telemetry import synthetic_batch
+
+    source = synthetic_batch(rows, period)
+    header = ['Timestamp'] + source.channels
+    results = []
+
+    # current behaviour: the whole batch is written at rollover, nothing is durable before that
+    path = os.path.join(directory, 'bench_batch'+EXTENSIONS[file_format])
+    before = block_writes()
+    write_batch(path, header, source, file_format, period)
+    fd = os.open(path, os.O_RDONLY)
+    os.fsync(fd)
+    os.close(fd)
+    size = os.path.getsize(path)
+    blocks = None if before is None else block_writes() - before
+    os.remove(path)
+    results.append(('end-of-batch dump', size, 1, 1, (size + PAGE_SIZE - 1)//PAGE_SIZE + 1, blocks, rows, rows*period))
+
+    for label, fsync_samples, fsync_interval in POLICIES:
+        now = [0.0]
+        writer = StreamWriter(directory, header, file_format, period, fsync_samples, fsync_interval, threaded=False, clock=lambda: now[0])
+        view = synthetic_batch(rows, period)
+        before = block_writes()
+        for i in range(rows):
+            view.count = i + 1
+            view.timestamp[i] = source.timestamp[i]
+            view.values[:, i] = source.values[:, i]
+            writer.append(view)
+            now[0] += period
+        writer.close('bench_stream'+EXTENSIONS[file_format])
+        blocks = None if before is None else block_writes() - before
+        os.remove(os.path.join(directory, 'bench_stream'+EXTENSIONS[file_format]))
+        stats = writer.stats()
+        results.append((label, stats['bytes_written'], stats['writes'], stats['fsyncs'], stats['pages'] + stats['fsyncs'], blocks,
+                        stats['max_unsynced_samples'], stats['max_unsynced_samples']*period))
+    return size, results
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='TEG profiler streaming writer')
+    parser.add_argument('command', choices=['bench', 'recover'])
+    parser.add_argument('directory', nargs='?')
+    parser.add_argument('--dir', help='directory for the benchmark files (use the SD card data directory on the Raspberry Pi)')
+    parser.add_argument('--rows', type=int, default=7200)
+    parser.add_argument('--period', type=float, default=0.5)
+    parser.add_argument('--format', default='csv', choices=sorted(EXTENSIONS))
+    args = parser.parse_args()
+
+    if args.command == 'recover':
+        for final, rows, truncated in recover_segments(args.directory):
+            print("%s: %d samples, %d bytes truncated" % (final, rows, truncated))
+    else:
+        directory = args.dir or tempfile.mkdtemp()
+        size, results = benchmark(directory, args.rows, args.period, args.format)
+        print("%d samples every %.1f s, %s, %d bytes of data" % (args.rows, args.period, args.format, size))
+        print("%-24s %10s %7s %7s %12s %6s %12s %16s" % ('policy', 'bytes', 'writes', 'fsyncs', 'est. SD kB', 'WA', 'block kB', 'lost window'))
+        for label, written, writes, fsyncs, pages, blocks, lost, lost_time in results:
+            print("%-24s %10d %7d %7d %12.1f %6.1f %12s %7d / %6.0f s" % (label, written, writes, fsyncs, pages*PAGE_SIZE/1024.0, pages*PAGE_SIZE/float(size),
+                                                                        '-' if not blocks else '%.1f' % (blocks/1024.0), lost, lost_time))
+        if not args.dir:
+            os.rmdir(directory)
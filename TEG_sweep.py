@@ -0,0 +1,546 @@
+################################################
+#
+# TEG profiler I-V sweep
+#
+# University of Virginia
+#
+################################################
+#
+# The sweep switches the loads with the PCA9536 and reads the TEG voltage with single-shot ADS1015
+# conversions (hw.adc): after each switch it waits the settle time of that load, then starts one
+# conversion and polls for its end. The raw 12 bit codes go into the int16 columns of the sample
+# buffer (SampleBuffer(..., scales=raw_scales())) and are converted to volts for the whole batch at
+# once. The settle times are measured on the device with
+#
+#   python3 TEG_sweep.py calibrate [--backend sim] [--repeats 10]
+#
+# which switches to each load the way the sweep does, converts back to back for 20 ms and reports
+# the time after which the readings stay within the noise of the final value. Paste the result in
+# SETTLE_TIMES of the acquisition scripts.
+#
+#   python3 TEG_sweep.py bench [--backend sim] [-n 50]
+#
+# compares the sweep time of the fixed-sleep sweep (continuous mode, 10 ms before and 5 ms after
+# each read) and the settle-time sweep.
+#
+# Oversampling: with oversample = K the sweep takes K conversions per load state and stores their
+# mean, and with statistics their standard deviation, minimum and maximum (<channel>_std, _min and
+# _max columns), computed for all loads at once at the end of the sweep. K is capped so that the
+# sweep fits in the sampling period (fit_oversample). Averaging K conversions divides the noise by
+# up to sqrt(K), half a bit per doubling of K;
+#
+#   python3 TEG_sweep.py oversample [--backend sim] [--period 0.1]
+#
+# measures the noise of the mean and the sweep time for K = 1, 2, 4, 8, 16 and reports the
+# effective resolution (bits) gained per millisecond of sweep time.
+#
+# Sweep plans: the load states are described by a SweepPlan, a list of (mask, settle time,
+# conversions) steps. Each bit of the PCA9536 mask connects one of the 0.1, 0.47, 1.5 and 4.7 ohm
+# loads, so masks with several bits measure the loads in parallel (16 states including open
+# circuit). An adaptive plan adds load states chosen on every sweep among the parallel
+# combinations closest to the maximum power point. The plan is compiled once (PCA9536 write
+# buffers, settle times, conversion counts and channel numbers) and gives the column names of the
+# sample buffer. The default plan is the five states of SWITCH_MASKS.
+#
+#   python3 TEG_sweep.py plan [--backend sim] [--adaptive 3]
+#
+# runs one sweep of the default or adaptive plan and compares the best measured power with the
+# maximum power of the TEG.
+#
+#   python3 TEG_sweep.py check
+#
+# runs every command above on the sim backend with a few iterations and fails if one of them does.
+
+import argparse
+import functools
+import json
+import math
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from TEG_hardware import ADC_LSB, LOAD_RESISTANCES, open_hardware
+
+
+SWITCH_MASKS = (0x00, 0x01, 0x02, 0x04, 0x08) # open circuit, then only the 0.1, 0.47, 1.5 and 4.7 ohm channel switch open
+SETTLE_TIMES = (0.004, 0.004, 0.004, 0.004, 0.004) # seconds between the switch and the conversion, per load (defaults, calibrate on the device)
+ADAPTIVE_SETTLE = 0.004 # settle time of the load states added by adaptive plans (calibrate --masks)
+STATISTICS = ('std', 'min', 'max') # oversampling statistics per load state, in this order after the two temperature channels
+TEMPERATURE_COLUMNS = ('temperature_amb', 'temperature_hot') # after the voltage of every load state
+SWEEP_BUDGET = 0.8 # share of the sampling period the sweep may take, the rest is left for the temperatures and the sinks
+
+
+###########
+# Sweep plans
+
+def load_resistance(mask):
+    # ohms of the loads of mask in parallel, None for open circuit
+    conductance = sum(1.0/resistance for i, resistance in enumerate(LOAD_RESISTANCES) if mask & (1 << i))
+    return 1.0/conductance if conductance else None
+
+
+def mask_column(mask):
+    # voltage_chan_OFF, voltage_chan_<load>, or voltage_chan_<load>_<load>... for loads in parallel
+    if mask == 0:
+        return 'voltage_chan_OFF'
+    return 'voltage_chan_'+'_'.join(str(i) for i in range(len(LOAD_RESISTANCES)) if mask & (1 << i))
+
+
+def column_mask(name):
+    # switch mask of a load state voltage column (inverse of mask_column), None for other columns
+    if name == 'voltage_chan_OFF':
+        return 0
+    if not name.startswith('voltage_chan_'):
+        return None
+    loads = name[len('voltage_chan_'):].split('_')
+    if not all(load.isdigit() and int(load) < len(LOAD_RESISTANCES) for load in loads):
+        return None # statistics column
+    return sum(1 << int(load) for load in loads)
+
+
+def statistics_columns(channels):
+    # names of the statistics columns of the sweep voltage channels
+    return [channel+'_'+statistic for channel in channels for statistic in STATISTICS]
+
+
+class SweepPlan:
+    # steps: (mask, settle time in seconds, conversions) per load state, measured in this order;
+    # adaptive: load states added after the steps, picked on every sweep among the remaining
+    # parallel combinations closest to the internal resistance of the TEG (maximum power point)
+
+    def __init__(self, steps, adaptive=0, adaptive_settle=ADAPTIVE_SETTLE, adaptive_conversions=1):
+        self.steps = [(int(mask), float(settle), int(conversions)) for mask, settle, conversions in steps]
+        masks = [mask for mask, settle, conversions in self.steps]
+        combinations = 1 << len(LOAD_RESISTANCES)
+        if any(not 0 <= mask < combinations for mask in masks):
+            raise ValueError("switch masks have to be between 0x00 and 0x%02x" % (combinations - 1))
+        if len(set(masks)) < len(masks):
+            raise ValueError("a switch mask appears twice in the sweep plan")
+        if any(conversions < 1 for mask, settle, conversions in self.steps) or adaptive_conversions < 1:
+            raise ValueError("every load state needs at least one conversion")
+        if adaptive:
+            if 0 not in masks or len(masks) < 2:
+                raise ValueError("adaptive plans need the open circuit state and at least one load")
+            if adaptive > combinations - len(masks):
+                raise ValueError("only "+str(combinations - len(masks))+" load combinations left for the adaptive states")
+        self.adaptive = adaptive
+        self.adaptive_settle = adaptive_settle
+        self.adaptive_conversions = adaptive_conversions
+
+    def voltage_columns(self):
+        return [mask_column(mask) for mask, settle, conversions in self.steps] + ['voltage_mpp_%d' % i for i in range(self.adaptive)]
+
+    def columns(self, statistics=False):
+        # sample buffer channels in channel order: voltage of every load state, temperatures,
+        # statistics of every load state, then the load resistance of every adaptive state
+        columns = self.voltage_columns() + list(TEMPERATURE_COLUMNS)
+        if statistics:
+            columns += statistics_columns(self.voltage_columns())
+        return columns + ['load_mpp_%d' % i for i in range(self.adaptive)]
+
+    def duration(self, read_time, oversample=1):
+        # sweep time estimate
+        settle = sum(settle for mask, settle, conversions in self.steps) + self.adaptive*self.adaptive_settle
+        conversions = sum(conversions for mask, settle, conversions in self.steps) + self.adaptive*self.adaptive_conversions
+        return settle + conversions*oversample*read_time
+
+    def compile(self, oversample=1, statistics=False):
+        return CompiledSweep(self, oversample, statistics)
+
+
+def default_plan(settle_times=None):
+    return SweepPlan(zip(SWITCH_MASKS, settle_times or SETTLE_TIMES, [1]*len(SWITCH_MASKS)))
+
+
+class CompiledSweep:
+    # execution schedule of a plan: PCA9536 write buffer, settle time and conversions of every load
+    # state, and the channel numbers of the columns of plan.columns(statistics)
+
+    def __init__(self, plan, oversample=1, statistics=False):
+        self.plan = plan
+        self.statistics = statistics
+        self.columns = plan.columns(statistics)
+        self.fixed = len(plan.steps) # states of the plan steps, the adaptive states follow
+        self.states = self.fixed + plan.adaptive
+        self.masks = [mask for mask, settle, conversions in plan.steps] + [None]*plan.adaptive # adaptive masks are set by every sweep
+        self.commands = [bytes([0x01, mask]) for mask in self.masks[:self.fixed]] + [None]*plan.adaptive
+        self.settle_times = [settle for mask, settle, conversions in plan.steps] + [plan.adaptive_settle]*plan.adaptive
+        self.conversions = [conversions*oversample for mask, settle, conversions in plan.steps] + [plan.adaptive_conversions*oversample]*plan.adaptive
+        self.single = not statistics and all(conversions == 1 for conversions in self.conversions)
+        self.temperature_channels = (self.states, self.states + 1)
+        self.load_channels = [self.columns.index('load_mpp_%d' % i) for i in range(plan.adaptive)]
+        self.r_internal = None # last estimate of the internal resistance, adaptive plans
+        if plan.adaptive:
+            self._open = self.masks.index(0)
+            self._loaded = [(state, load_resistance(mask)) for state, mask in enumerate(self.masks[:self.fixed]) if mask]
+            self._candidates = [(load_resistance(mask), mask, bytes([0x01, mask])) for mask in range(1, 1 << len(LOAD_RESISTANCES)) if mask not in self.masks]
+        self._codes = np.empty((self.states, max(self.conversions)), dtype=np.int32)
+
+    def statistic_channel(self, state, statistic):
+        return self.states + 2 + len(STATISTICS)*state + STATISTICS.index(statistic)
+
+    def raw_scales(self, lsb=ADC_LSB):
+        # volts per code of the channels stored as raw ADS1015 codes: the voltage of every load state
+        # (one conversion per state) and the minimum and maximum columns of the statistics
+        scales = dict((state, lsb) for state in range(self.states))
+        if self.statistics:
+            for state in range(self.states):
+                scales[self.statistic_channel(state, 'min')] = lsb
+                scales[self.statistic_channel(state, 'max')] = lsb
+        return scales
+
+    def run(self, pca, adc, sample_buffer):
+        # adc: single-shot reader (hw.adc), every conversion starts after the settle time
+        if self.single:
+            codes = self._codes[:, 0]
+            for state in range(self.fixed):
+                pca.write(self.commands[state]) # connect the loads of this state (none for open circuit)
+                time.sleep(self.settle_times[state])
+                codes[state] = adc.read()
+                sample_buffer.put_raw(state, int(codes[state])) # TEG output voltage (raw code)
+            if self.fixed < self.states:
+                self._adapt(codes, sample_buffer)
+                for state in range(self.fixed, self.states):
+                    pca.write(self.commands[state])
+                    time.sleep(self.settle_times[state])
+                    sample_buffer.put_raw(state, adc.read())
+            return
+
+        for state in range(self.states):
+            if state == self.fixed:
+                self._adapt([self._codes[i, :self.conversions[i]].mean() for i in range(self.fixed)], sample_buffer)
+            pca.write(self.commands[state])
+            time.sleep(self.settle_times[state])
+            for k in range(self.conversions[state]):
+                self._codes[state, k] = adc.read() # back to back conversions at the ADS1015 data rate
+        self._put_statistics(sample_buffer, adc.lsb)
+
+    def _put_statistics(self, sample_buffer, lsb):
+        if len(set(self.conversions)) == 1: # all states at once
+            groups = [(range(self.states), self._codes[:, :self.conversions[0]])]
+        else:
+            groups = [([state], self._codes[state:state + 1, :self.conversions[state]]) for state in range(self.states)]
+        for states, codes in groups:
+            means = (codes.mean(axis=1)*lsb).tolist()
+            for state, mean in zip(states, means):
+                sample_buffer.put(state, mean)
+            if self.statistics:
+                stds = (codes.std(axis=1)*lsb).tolist()
+                mins = codes.min(axis=1).tolist()
+                maxs = codes.max(axis=1).tolist()
+                for i, state in enumerate(states):
+                    sample_buffer.put(self.statistic_channel(state, 'std'), stds[i])
+                    sample_buffer.put_raw(self.statistic_channel(state, 'min'), mins[i])
+                    sample_buffer.put_raw(self.statistic_channel(state, 'max'), maxs[i])
+
+    def _adapt(self, codes, sample_buffer):
+        # internal resistance from the open circuit and loaded states of this sweep (V = Voc*R/(R + R_int)),
+        # then the adaptive states go to the combinations closest to it on a log scale
+        voc = float(codes[self._open])
+        estimates = sorted(resistance*(voc - float(codes[state]))/float(codes[state]) for state, resistance in self._loaded if 0 < codes[state] < voc)
+        if estimates:
+            self.r_internal = estimates[len(estimates)//2]
+        target = self.r_internal or math.sqrt(self._candidates[0][0]*self._candidates[-1][0]) # no estimate yet: middle of the range
+        chosen = sorted(sorted(self._candidates, key=lambda candidate: abs(math.log(candidate[0]/target)))[:self.plan.adaptive])
+        for i, (resistance, mask, command) in enumerate(chosen):
+            self.masks[self.fixed + i] = mask
+            self.commands[self.fixed + i] = command
+            sample_buffer.put(self.load_channels[i], resistance)
+
+
+###########
+# TEG I-V curve scan with the default plan (open circuit voltage and output voltage on each of the four load resistors)
+
+@functools.lru_cache(maxsize=8)
+def default_sweep(settle_times=None, oversample=1, statistics=False):
+    return default_plan(settle_times).compile(oversample, statistics)
+
+
+def raw_scales(lsb=ADC_LSB, statistics=False):
+    return default_sweep(statistics=statistics).raw_scales(lsb)
+
+
+def iv_sweep(pca, adc, sample_buffer, settle_times=None, oversample=1, statistics=False):
+    # adc: single-shot reader (hw.adc); the scripts compile their own plan once and call run()
+    default_sweep(tuple(settle_times) if settle_times else None, oversample, statistics).run(pca, adc, sample_buffer)
+
+
+def measure_read_time(adc, reads=20):
+    # median duration of one single-shot read
+    durations = []
+    for i in range(reads):
+        start = time.perf_counter()
+        adc.read()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations))
+
+
+def fit_oversample(oversample, period, read_time, plan=None):
+    # largest K <= oversample with which the sweep takes at most SWEEP_BUDGET of the sampling period
+    plan = plan or default_plan()
+    budget = SWEEP_BUDGET*period - plan.duration(0.0)
+    return max(1, min(oversample, int(budget/(plan.duration(read_time) - plan.duration(0.0)))))
+
+
+def iv_sweep_fixed(pca, chan, sample_buffer):
+    # previous sweep with fixed sleeps, ADS1015 in continuous mode (hw.chan), kept for comparison
+    for channel, mask in enumerate(SWITCH_MASKS):
+        pca.write(bytes([0x01, mask]))
+        time.sleep(0.010)
+        sample_buffer.put(channel, chan.voltage)
+        if channel < len(SWITCH_MASKS) - 1:
+            time.sleep(0.005)
+
+
+###########
+# Thermocouple temperatures
+
+def read_temperatures(mcp, sample_buffer, timestamp=None, age_channel=None, channels=(5, 6)):
+    # channels: ambient and hot side channel, temperature_channels of the compiled sweep plan. With a
+    # timestamp (slower temperature task) the temperatures are held by the sample buffer: carried
+    # forward on the following rows, age_channel counting the seconds since this read
+    if hasattr(mcp, 'read_junctions'): # both registers in one I2C transaction ('i2cdev' backend)
+        cold, hot = mcp.read_junctions()
+    else:
+        cold = float(mcp.get_cold_junction_temperature()) # measure ambient temperature (cold junction)
+        hot = float(mcp.get_hot_junction_temperature()) # measure probe temperature (hot junction)
+
+    if timestamp is None:
+        sample_buffer.put(channels[0], cold)
+        sample_buffer.put(channels[1], hot)
+    else:
+        sample_buffer.hold({channels[0]: cold, channels[1]: hot}, timestamp, age_channel)
+
+
+###########
+# Settle time calibration
+
+def settle_trace(pca, adc, previous, mask, window):
+    # switches from `previous` to `mask` and converts back to back for `window` seconds,
+    # returns the conversion start times after the switch and the codes
+    pca.write(bytes([0x01, previous]))
+    time.sleep(window)
+    pca.write(bytes([0x01, mask]))
+    switched = time.perf_counter()
+    times = []
+    codes = []
+    while True:
+        t = time.perf_counter() - switched
+        if t > window:
+            break
+        times.append(t)
+        codes.append(adc.read())
+    return np.array(times), np.array(codes)
+
+
+def settle_time(times, codes, tolerance):
+    # start time of the first of two consecutive conversions within `tolerance` codes of the final
+    # value (the TEG output settles monotonically, single late outliers are noise)
+    final = np.median(codes[len(codes)//2:])
+    inside = np.abs(codes - final) <= tolerance
+    for i in range(len(codes) - 1):
+        if inside[i] and inside[i + 1]:
+            return float(times[i])
+    return float(times[-1]) # did not settle within the window
+
+
+def calibrate_settle(pca, adc, repeats=10, window=0.020, tolerance=3, masks=SWITCH_MASKS):
+    # worst settle time per load state over `repeats` switches, plus one conversion time of margin. The
+    # tolerance is at least 4 standard deviations of the noise of the settled readings of that state.
+    settle_times = []
+    for channel, mask in enumerate(masks):
+        previous = masks[channel - 1] # the open circuit read follows the last load of the previous sweep
+        traces = [settle_trace(pca, adc, previous, mask, window) for i in range(repeats)]
+        noise = np.std(np.concatenate([codes[len(codes)//2:] - np.median(codes[len(codes)//2:]) for times, codes in traces]))
+        worst = max(settle_time(times, codes, max(tolerance, 4*noise)) for times, codes in traces)
+        settle_times.append(round(worst + adc.conversion_time, 4))
+    return tuple(settle_times)
+
+
+###########
+# Sweep time comparison
+
+class NullBuffer:
+
+    def put(self, channel, value):
+        pass
+
+    def put_raw(self, channel, code):
+        pass
+
+
+def benchmark(hw, iterations=50, settle_times=None):
+    results = {}
+    for name, sweep, adc in (('fixed sleeps, continuous', iv_sweep_fixed, hw.chan), ('settle times, single-shot', iv_sweep, hw.adc)):
+        durations = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            if sweep is iv_sweep:
+                sweep(hw.pca, adc, NullBuffer(), settle_times)
+            else:
+                sweep(hw.pca, adc, NullBuffer())
+            durations.append(time.perf_counter() - start)
+        results[name] = np.array(durations)*1000
+    return results
+
+
+class CaptureBuffer:
+
+    def __init__(self):
+        self.values = {}
+
+    def put(self, channel, value):
+        self.values[channel] = value
+
+    def put_raw(self, channel, code):
+        self.values[channel] = code*ADC_LSB
+
+
+def oversample_benchmark(hw, sweeps=50, factors=(1, 2, 4, 8, 16), settle_times=None):
+    # noise of the per-load means over `sweeps` sweeps (steady TEG) and sweep time for every K
+    results = []
+    for oversample in factors:
+        means = []
+        durations = []
+        for i in range(sweeps):
+            sample_buffer = CaptureBuffer()
+            start = time.perf_counter()
+            iv_sweep(hw.pca, hw.adc, sample_buffer, settle_times, oversample)
+            durations.append(time.perf_counter() - start)
+            means.append([sample_buffer.values[channel] for channel in range(len(SWITCH_MASKS))])
+        noise = float(np.mean(np.std(np.array(means), axis=0))) # volts, averaged over the loads
+        results.append((oversample, float(np.median(durations)), noise))
+    return results
+
+
+def plan_benchmark(hw, plans, sweeps=20):
+    # best measured power of every plan against the best of all 16 load states, power = V^2/R of
+    # the nominal load resistance; the TEG is steady, so more load states can only find more power
+    exhaustive = SweepPlan([(mask, ADAPTIVE_SETTLE, 1) for mask in range(1 << len(LOAD_RESISTANCES))])
+    results = []
+    for name, plan in [('all 16 states', exhaustive)] + list(plans):
+        sweep = plan.compile()
+        powers = []
+        durations = []
+        for i in range(sweeps):
+            sample_buffer = CaptureBuffer()
+            start = time.perf_counter()
+            sweep.run(hw.pca, hw.adc, sample_buffer)
+            durations.append(time.perf_counter() - start)
+            powers.append(max(sample_buffer.values[state]**2/load_resistance(mask) for state, mask in enumerate(sweep.masks) if mask))
+        results.append((name, sweep.states, float(np.median(durations)), float(np.mean(powers)), sweep.r_internal))
+    return results
+
+
+def read_cpu_time(hw, iterations=20000):
+    # CPU time per stored ADS1015 reading on top of the I2C transaction, both paths reading the
+    # conversion register once: float volts through AnalogIn.voltage and put(), raw codes through
+    # hw.adc.read_raw() and put_raw(), plus the share of finalize() per reading
+    from TEG_buffer import SampleBuffer
+
+    sample_buffer = SampleBuffer(iterations, ['voltage'], scales={0: ADC_LSB})
+    buf = bytearray(2)
+    paths = (
+        ('I2C transaction', lambda: hw.i2c.writeto_then_readfrom(hw.adc.address, b'\x00', buf)),
+        ('AnalogIn.voltage + put', lambda: sample_buffer.put(0, hw.chan.voltage)),
+        ('read_raw + put_raw', lambda: sample_buffer.put_raw(0, hw.adc.read_raw())),
+    )
+    hw.chan.voltage # configures the channel
+    results = {}
+    for name, read in paths:
+        start = time.process_time()
+        for i in range(iterations):
+            read()
+        results[name] = (time.process_time() - start)/iterations*1e6
+    sample_buffer.current.count = iterations
+    start = time.process_time()
+    sample_buffer.current.finalize()
+    results['finalize'] = (time.process_time() - start)/iterations*1e6
+    return results
+
+
+###########
+# Command check (python3 TEG_sweep.py check)
+
+CHECKS = (
+    ['calibrate', '--repeats', '2'],
+    ['calibrate', '--repeats', '2', '--masks', '0x3,0x6'],
+    ['bench', '-n', '3'],
+    ['bench', '-n', '3', '--settle', '0.004,0.004,0.004,0.004,0.004'],
+    ['oversample', '-n', '3'],
+    ['oversample', '-n', '5', '--settle', '0.004,0.004,0.004,0.004,0.004'],
+    ['plan', '-n', '3', '--adaptive', '2'],
+)
+
+
+def check_commands():
+    # number of commands that failed on the sim backend
+    failed = 0
+    for command in CHECKS:
+        arguments = [sys.executable, __file__] + command + ['--backend', 'sim']
+        result = subprocess.run(arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        print("%-4s %s" % ('ok' if result.returncode == 0 else 'FAIL', ' '.join(command)))
+        if result.returncode != 0:
+            failed += 1
+            print(result.stderr.decode().rstrip())
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TEG profiler I-V sweep settle time calibration and benchmark')
+    parser.add_argument('command', choices=['calibrate', 'bench', 'oversample', 'plan', 'check'])
+    parser.add_argument('--backend', default='board', help="hardware backend, 'board' or 'sim'")
+    parser.add_argument('--sim-options', default='{}', help='JSON object with simulator options')
+    parser.add_argument('--repeats', type=int, default=10, help='switches per load for calibrate')
+    parser.add_argument('--settle', help='comma separated settle times in seconds for bench and oversample, default SETTLE_TIMES')
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('--period', type=float, default=0.1, help='sampling period for oversample, to show the K that fits')
+    parser.add_argument('--masks', help='comma separated switch masks for calibrate (e.g. 0x3,0x6 for loads in parallel), default SWITCH_MASKS')
+    parser.add_argument('--adaptive', type=int, default=3, help='adaptive load states for plan')
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        sys.exit(check_commands())
+
+    options = json.loads(args.sim_options) if args.backend == 'sim' else {}
+    hw = open_hardware(args.backend, **options)
+    if args.command == 'calibrate':
+        masks = tuple(int(mask, 0) for mask in args.masks.split(',')) if args.masks else SWITCH_MASKS
+        settle_times = calibrate_settle(hw.pca, hw.adc, args.repeats, masks=masks)
+        for mask, settle in zip(masks, settle_times):
+            print("switch mask 0x%02x: %.2f ms" % (mask, settle*1000))
+        if masks == SWITCH_MASKS:
+            print("SETTLE_TIMES = "+repr(settle_times))
+        else:
+            print("steps = ["+", ".join("(0x%02x, %r, 1)" % (mask, settle) for mask, settle in zip(masks, settle_times))+"]")
+    elif args.command == 'plan':
+        settle_times = tuple(float(t) for t in args.settle.split(',')) if args.settle else None
+        plans = [('default', default_plan(settle_times)), ('default + %d adaptive' % args.adaptive, SweepPlan(default_plan(settle_times).steps, args.adaptive))]
+        results = plan_benchmark(hw, plans, args.iterations)
+        best = results[0][3]
+        print("%-22s %7s %10s %12s %10s %10s" % ('plan', 'states', 'sweep ms', 'P max mW', 'of best', 'R_int ohm'))
+        for name, states, duration, power, r_internal in results:
+            print("%-22s %7d %10.2f %12.3f %9.1f%% %10s" % (name, states, duration*1000, power*1000, 100*power/best,
+                                                            '%.3f' % r_internal if r_internal else '-'))
+    elif args.command == 'oversample':
+        settle_times = tuple(float(t) for t in args.settle.split(',')) if args.settle else None
+        results = oversample_benchmark(hw, args.iterations, settle_times=settle_times)
+        oversample, base_time, base_noise = results[0]
+        print("%3s %10s %11s %11s %12s" % ('K', 'sweep ms', 'noise uV', 'bits gained', 'bits per ms'))
+        for oversample, duration, noise in results:
+            gained = np.log2(base_noise/noise) if noise > 0 else float('inf')
+            per_ms = gained/((duration - base_time)*1000) if duration > base_time else 0.0
+            print("%3d %10.2f %11.1f %11.2f %12.3f" % (oversample, duration*1000, noise*1e6, gained, per_ms))
+        print("ADS1015 LSB %.0f uV; largest K for a %.3f s period: %d" % (ADC_LSB*1e6, args.period, fit_oversample(max(r[0] for r in results), args.period, measure_read_time(hw.adc), default_plan(settle_times))))
+    else:
+        settle_times = tuple(float(t) for t in args.settle.split(',')) if args.settle else None
+        results = benchmark(hw, args.iterations, settle_times)
+        for name, durations in results.items():
+            print("%-26s p50 %6.2f ms, p99 %6.2f ms" % (name, np.percentile(durations, 50), np.percentile(durations, 99)))
+        cpu = read_cpu_time(hw)
+        bus = cpu.pop('I2C transaction')
+        print("CPU per reading on top of the I2C transaction (%.2f us):" % bus)
+        for name, seconds in cpu.items():
+            print("  %-24s %6.2f us" % (name, seconds if name == 'finalize' else seconds - bus))
@@ -0,0 +1,315 @@
+################################################
+#
+# TEG profiler telemetry encoding
+#
+# University of Virginia
+#
+################################################
+#
+# Message formats published on linklab/teg_eh_profiler (see README.md for the schemas):
+#
+#   'sample'  one JSON message per sample with displayName/unit/value for every field (legacy)
+#   'batch'   one JSON message per group of samples with columnar arrays, "schema_version": 1
+#   'binary'  one fixed-layout binary message per group of samples (float32 values) on
+#             linklab/teg_eh_profiler/<APP_ID>/bin, described by a retained schema message on
+#             linklab/teg_eh_profiler/<APP_ID>/schema
+#   'changes' report by exception (TEG_deadband.py): one JSON message per group of samples with the
+#             values that moved out of their deadband, on linklab/teg_eh_profiler/<APP_ID>/changes
+#
+# and the window summaries of TEG_aggregate.py, one JSON message per window on
+# linklab/teg_eh_profiler/<APP_ID>/summary/<window>s, "schema": "teg_profiler/summary"
+
+import json
+import math
+import struct
+
+import numpy as np
+
+from TEG_buffer import iso_timestamps
+
+
+TOPIC = 'linklab/teg_eh_profiler'
+
+BATCH_SCHEMA = 'teg_profiler/batch'
+BATCH_SCHEMA_VERSION = 1
+BINARY_SCHEMA = 'teg_profiler/binary'
+BINARY_SCHEMA_VERSION = 1
+CHANGES_SCHEMA = 'teg_profiler/changes'
+CHANGES_SCHEMA_VERSION = 1
+SUMMARY_SCHEMA = 'teg_profiler/summary'
+SUMMARY_SCHEMA_VERSION = 1
+VALUE_DECIMALS = 6 # batched values are rounded to 1 uV / 1e-6 C, well below the ADS1015 and MCP9600 resolution
+
+# displayName and unit of every field published to the cloud
+FIELDS = {
+    'voltage_chan_OFF': ('High Impedance', 'V'),
+    'voltage_chan_0': ('Channel 0', 'V'),
+    'voltage_chan_1': ('Channel 1', 'V'),
+    'voltage_chan_2': ('Channel 2', 'V'),
+    'voltage_chan_3': ('Channel 3', 'V'),
+    'temperature_amb': ('Ambient temperature', '°C'),
+    'temperature_hot': ('Hot side temperature', '°C'),
+    'temperature_age': ('Temperature age', 's'),
+    'voc': ('Open circuit voltage (fit)', 'V'), # I-V fit features (TEG_analytics.py)
+    'r_internal': ('Internal resistance', 'Ω'),
+    'p_max': ('Maximum power', 'W'),
+    'p_best': ('Best measured power', 'W'),
+    'mpp_ratio': ('Best load share of maximum power', ''),
+    'seebeck': ('Seebeck coefficient', 'V/K'),
+    'power_factor': ('Maximum power per squared temperature difference', 'W/K²'),
+    'fit_rms': ('I-V fit residual', 'V'),
+}
+
+
+NUMBERED_FIELDS = {
+    'voltage_mpp': ('Near MPP', 'V'), # adaptive load states of the sweep plan (TEG_sweep.py)
+    'load_mpp': ('Near MPP load', 'Ω'),
+}
+
+
+def field(name):
+    # displayName and unit of a field: oversampling statistics (<channel>_std, _min, _max) take them from their channel,
+    # loads in parallel (voltage_chan_<load>_<load>...) and adaptive load states (voltage_mpp_<i>, load_mpp_<i>) are numbered
+    if name in FIELDS:
+        return FIELDS[name]
+    base, suffix = name.rsplit('_', 1)
+    if base in NUMBERED_FIELDS:
+        return (NUMBERED_FIELDS[base][0]+' '+suffix, NUMBERED_FIELDS[base][1])
+    if suffix.isdigit() and name.startswith('voltage_chan_'):
+        return ('Channels '+' + '.join(name[len('voltage_chan_'):].split('_')), 'V')
+    display_name, unit = field(base)
+    return (display_name+' '+suffix, unit)
+
+
+def json_value(value):
+    # failed reads are NaN in the sample buffer, published as null
+    return None if math.isnan(value) else value
+
+
+###########
+# Legacy format: one message per sample
+
+def sample_messages(APP_ID, batch):
+    # Standard message with fields expected by the MQTT broker
+    message = {
+       "app_id":APP_ID,
+       "counter": 0,
+       "payload_fields": dict((name, {"displayName": field(name)[0], "unit": field(name)[1], "value": -999.99}) for name in batch.channels),
+       "metadata":{
+          "time":"2020-12-01T12:00:00.000000000Z"
+       }
+    }
+    fields = [message['payload_fields'][name] for name in batch.channels]
+
+    for COUNTER, row in enumerate(batch.rows()):
+        message['metadata']['time'] = row[0]
+        for entry, value in zip(fields, row[1:]):
+            entry['value'] = json_value(value)
+        message['counter'] = COUNTER
+        yield json.dumps(message)
+
+
+###########
+# Batched format: columnar arrays of up to `samples_per_message` samples, and if `window` is
+# given (seconds) never spanning more than `window` seconds of samples
+
+def message_slices(timestamps, samples_per_message, window=None):
+    start = 0
+    count = len(timestamps)
+    while start < count:
+        end = min(start + samples_per_message, count)
+        if window:
+            end = start + int(np.searchsorted(timestamps[start:end], timestamps[start] + int(window*1000000)))
+        yield start, end
+        start = end
+
+
+def batch_messages(APP_ID, batch, samples_per_message=60, window=None):
+    timestamps = batch.timestamp[:batch.count]
+    iso = iso_timestamps(timestamps)
+    values = np.round(batch.values[:, :batch.count], VALUE_DECIMALS)
+    units = dict((name, field(name)[1]) for name in batch.channels)
+
+    for start, end in message_slices(timestamps, samples_per_message, window):
+        message = {
+            "schema": BATCH_SCHEMA,
+            "schema_version": BATCH_SCHEMA_VERSION,
+            "app_id": APP_ID,
+            "counter": start,
+            "t0": str(iso[start]),
+            "dt_us": (timestamps[start:end] - timestamps[start]).tolist(),
+            "fields": dict((name, [json_value(v) for v in values[i, start:end].tolist()]) for i, name in enumerate(batch.channels)),
+            "units": units,
+        }
+        yield json.dumps(message, ensure_ascii=False)
+
+
+###########
+# Binary format, little endian:
+#
+#   uint8    schema version (1)
+#   uint8    number of channels C
+#   uint16   number of samples N
+#   uint32   counter, index of the first sample in the batch
+#   int64    t0, time of the first sample in microseconds since the epoch (UTC)
+#   uint32   [N] time of each sample relative to t0, in microseconds
+#   float32  [C][N] values, channel by channel in the order of the schema message, NaN for failed reads
+
+BINARY_HEADER = struct.Struct('<BBHIq')
+
+
+def binary_messages(batch, samples_per_message=60, window=None):
+    timestamps = batch.timestamp[:batch.count]
+
+    for start, end in message_slices(timestamps, samples_per_message, window):
+        header = BINARY_HEADER.pack(BINARY_SCHEMA_VERSION, len(batch.channels), end - start, start, int(timestamps[start]))
+        offsets = (timestamps[start:end] - timestamps[start]).astype('<u4')
+        values = batch.values[:, start:end].astype('<f4')
+        yield header + offsets.tobytes() + values.tobytes()
+
+
+def decode_binary_message(payload):
+    # reference decoder for consumers: returns counter, timestamps (us since the epoch) and a (C, N) float32 array
+    version, channels, samples, counter, t0 = BINARY_HEADER.unpack_from(payload)
+    if version != BINARY_SCHEMA_VERSION:
+        raise ValueError("unsupported binary schema version: "+str(version))
+    offsets = np.frombuffer(payload, dtype='<u4', count=samples, offset=BINARY_HEADER.size)
+    values = np.frombuffer(payload, dtype='<f4', count=channels*samples, offset=BINARY_HEADER.size + 4*samples).reshape(channels, samples)
+    return counter, t0 + offsets.astype(np.int64), values
+
+
+def schema_message(APP_ID, channels):
+    # static channel metadata, published once as a retained message
+    return json.dumps({
+        "schema": BINARY_SCHEMA,
+        "schema_version": BINARY_SCHEMA_VERSION,
+        "app_id": APP_ID,
+        "channels": [{"name": name, "displayName": field(name)[0], "unit": field(name)[1]} for name in channels],
+    }, ensure_ascii=False)
+
+
+def schema_topic(APP_ID):
+    return TOPIC+'/'+APP_ID+'/schema'
+
+
+def message_topic(APP_ID, mode):
+    if mode == 'binary':
+        return TOPIC+'/'+APP_ID+'/bin'
+    if mode == 'changes':
+        return TOPIC+'/'+APP_ID+'/changes'
+    return TOPIC
+
+
+###########
+# Change-driven format (TEG_deadband.py): mask holds the values of batch to publish, the messages
+# cover every row of the batch, with up to `samples_per_message` rows with changes each
+
+def change_messages(APP_ID, batch, mask, bands, heartbeat, samples_per_message=60):
+    timestamps = batch.timestamp[:batch.count]
+    iso = iso_timestamps(timestamps)
+    values = np.round(batch.values[:, :batch.count], VALUE_DECIMALS)
+    units = dict((name, field(name)[1]) for name in batch.channels)
+    deadband = dict((name, list(band)) for name, band in zip(batch.channels, bands))
+    events = np.flatnonzero(mask.any(axis=0))
+
+    for first in range(0, len(events), samples_per_message):
+        rows = events[first:first + samples_per_message]
+        start = int(rows[0])
+        end = int(events[first + samples_per_message]) if first + samples_per_message < len(events) else batch.count
+        fields = {}
+        for i, name in enumerate(batch.channels):
+            changed = np.flatnonzero(mask[i, rows])
+            if len(changed):
+                fields[name] = [[int(j), json_value(v)] for j, v in zip(changed.tolist(), values[i, rows[changed]].tolist())]
+        message = {
+            "schema": CHANGES_SCHEMA,
+            "schema_version": CHANGES_SCHEMA_VERSION,
+            "app_id": APP_ID,
+            "counter": start,
+            "t0": str(iso[start]),
+            "dt_us": (timestamps[rows] - timestamps[start]).tolist(),
+            "dt_end_us": int(timestamps[end - 1] - timestamps[start]), # last sample covered by the message
+            "samples": end - start,
+            "fields": fields, # [index in dt_us, value] of the values published, held until the next one
+            "deadband": deadband,
+            "heartbeat_s": heartbeat,
+            "units": units,
+        }
+        yield json.dumps(message, ensure_ascii=False)
+
+
+###########
+# Window summaries (TEG_aggregate.py): per channel [count, min, max, mean, std] of one window
+
+def summary_message(APP_ID, summary):
+    values = np.round(np.array([summary['min'], summary['max'], summary['mean'], summary['std']]), VALUE_DECIMALS)
+    return json.dumps({
+        "schema": SUMMARY_SCHEMA,
+        "schema_version": SUMMARY_SCHEMA_VERSION,
+        "app_id": APP_ID,
+        "window_s": summary['window'],
+        "t0": str(iso_timestamps(np.array([summary['start']]))[0]),
+        "partial": summary['partial'],
+        "stats": ["count", "min", "max", "mean", "std"],
+        "fields": dict((name, [int(summary['count'][i])] + [json_value(v) for v in values[:, i].tolist()]) for i, name in enumerate(summary['channels'])),
+        "units": dict((name, field(name)[1]) for name in summary['channels']),
+    }, ensure_ascii=False)
+
+
+def summary_topic(APP_ID, window):
+    return TOPIC+'/'+APP_ID+'/summary/%gs' % window
+
+
+def encode_messages(APP_ID, batch, mode='batch', samples_per_message=60, window=None):
+    if mode == 'sample':
+        return sample_messages(APP_ID, batch)
+    if mode == 'batch':
+        return batch_messages(APP_ID, batch, samples_per_message, window)
+    if mode == 'binary':
+        return binary_messages(batch, samples_per_message, window)
+    raise ValueError("unknown publish mode: "+str(mode))
+
+
+###########
+# Message count and size comparison (python3 TEG_telemetry.py [batch_size] [samples_per_message])
+
+def synthetic_batch(batch_size=1800, period=0.5, seed=0):
+    from datetime import datetime
+    from TEG_buffer import SampleBatch, to_epoch_us
+
+    batch = SampleBatch(batch_size, list(FIELDS)[:8]) # acquired channels, not the I-V fit features
+    batch.reset(0)
+    rng = np.random.default_rng(seed)
+    batch.timestamp[:] = to_epoch_us(datetime.utcnow()) + (np.arange(batch_size)*period*1000000).astype(np.int64)
+    levels = [0.40, 0.03, 0.098, 0.20, 0.30]
+    for i, level in enumerate(levels):
+        batch.values[i] = np.round((level + rng.normal(0, 0.0005, batch_size))/0.00025)*0.00025 # ADS1015 gain 8 LSB
+    batch.values[5] = np.round((25 + rng.normal(0, 0.05, batch_size))/0.0625)*0.0625 # MCP9600 LSB
+    batch.values[6] = np.round((45 + rng.normal(0, 0.05, batch_size))/0.0625)*0.0625
+    batch.count = batch_size
+    return batch
+
+
+def mqtt_packet_size(topic, payload, qos=0):
+    # PUBLISH fixed header (1 byte + remaining length) + topic length and name + packet id (QoS > 0) + payload
+    remaining = 2 + len(topic.encode()) + (2 if qos else 0) + len(payload)
+    length_bytes = 1 if remaining < 128 else 2 if remaining < 16384 else 3 if remaining < 2097152 else 4
+    return 1 + length_bytes + remaining
+
+
+if __name__ == '__main__':
+    import sys
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1800
+    samples_per_message = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    batch = synthetic_batch(batch_size)
+    APP_ID = 'teg_profiler_00'
+    results = {}
+    for mode in ('sample', 'batch', 'binary'):
+        payloads = [p if isinstance(p, bytes) else p.encode() for p in encode_messages(APP_ID, batch, mode, samples_per_message)]
+        wire = sum(mqtt_packet_size(message_topic(APP_ID, mode), p) for p in payloads)
+        results[mode] = (len(payloads), wire)
+        print("%-6s %5d messages, %9d bytes on the wire, %6.1f bytes/sample" % (mode, len(payloads), wire, wire/float(batch_size)))
+    for mode in ('batch', 'binary'):
+        print("%-6s message reduction x%.0f, byte reduction x%.1f" % (mode, results['sample'][0]/float(results[mode][0]), results['sample'][1]/float(results[mode][1])))
+    print("binary schema message (retained, sent once): %d bytes" % mqtt_packet_size(schema_topic(APP_ID), schema_message(APP_ID, batch.channels).encode(), qos=1))
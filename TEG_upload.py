@@ -0,0 +1,510 @@
+################################################
+#
+# TEG profiler data upload
+#
+# University of Virginia
+#
+################################################
+#
+# Used by TEG_profiler_upload.py. The manifest records every file the server acknowledged (name,
+# size, mtime, SHA-256 and the server response), so each run uploads only new or changed files.
+# When the data directory has not changed since a run that left nothing pending (same directory
+# mtime), the run ends after reading a small stamp file, whatever the number of files.
+#
+# The upload pool sends files over a few keep-alive connections in parallel, with timeouts and
+# retries. TEG_upload_server.py is a local stand-in for the server:
+#
+#   python3 TEG_upload_server.py --port 8080 --root /tmp/uploads
+#   python3 TEG_upload.py bench --server 127.0.0.1:8080 --files 200
+#       compares the old one-connection-per-file upload with the pool
+#
+# With part_size set, files are sent in resumable chunked mode instead of one multipart POST: the
+# client asks the server how much of the file it already has, then PUTs the rest in parts of
+# part_size bytes read from disk one at a time, each with its SHA-256 (protocol described in
+# TEG_upload_server.py). An interrupted upload continues from the server offset on the next try.
+#
+# For backfills after days offline, upload_bundles() packs many files into tar archives compressed
+# on the fly (zstd when the zstandard module is installed, gzip otherwise) and sends each archive
+# as one chunked request; the server unpacks it as it arrives.
+#
+#   python3 TEG_upload.py backfill --server 127.0.0.1:8080 --days 7
+#       compares time and bytes on the wire of a week of 15-minute files sent per file and bundled
+
+import hashlib
+import json
+import logging
+import os
+import random
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # bundles fall back to gzip
+
+
+SKIPPED_SUFFIXES = ('.part', '.tmp') # segments still being written (see TEG_stream.py)
+
+
+def file_hash(path, chunk_size=1024*1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_json(path, data):
+    # atomic replace, a power cut leaves either the old or the new file
+    with open(path+'.tmp', 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path+'.tmp', path)
+
+
+###########
+# Uploaded-files manifest
+
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp_path = path+'.stamp'
+        self.files = None # loaded on demand, the fast path never reads the manifest itself
+
+    def _load(self):
+        if self.files is None:
+            try:
+                with open(self.path) as file:
+                    self.files = json.load(file)['files']
+            except (OSError, ValueError, KeyError):
+                self.files = {}
+        return self.files
+
+    def save(self):
+        write_json(self.path, {'version': 1, 'files': self._load()})
+
+    ###########
+    # Directory scan
+
+    def unchanged(self, directory):
+        # fast path: nothing was created, removed or renamed in directory since the last clean run
+        try:
+            with open(self.stamp_path) as file:
+                stamp = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return stamp.get('directory') == os.path.abspath(directory) and stamp.get('mtime_ns') == os.stat(directory).st_mtime_ns
+
+    def mark_clean(self, directory, mtime_ns):
+        # mtime_ns is the directory mtime read before the scan, so files added during the run are seen next time
+        write_json(self.stamp_path, {'directory': os.path.abspath(directory), 'mtime_ns': mtime_ns})
+
+    def scan(self, directory):
+        # returns the files to upload as a sorted list of (name, entry), entry being the manifest
+        # record to store once the server acknowledged the upload. Files whose size and mtime match
+        # the manifest are not read; files that were touched but hash the same are not uploaded again.
+        files = self._load()
+        pending = []
+        touched = False
+        for item in os.scandir(directory):
+            if not item.is_file() or item.name.endswith(SKIPPED_SUFFIXES):
+                continue
+            stat = item.stat()
+            known = files.get(item.name)
+            if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                continue
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(item.path)}
+            if known is not None and known['sha256'] == entry['sha256'] and known['size'] == entry['size']:
+                known['mtime_ns'] = entry['mtime_ns'] # touched, same content
+                touched = True
+                continue
+            pending.append((item.name, entry))
+        if touched:
+            self.save()
+        pending.sort()
+        return pending
+
+    def acknowledge(self, name, entry, status, response=''):
+        entry = dict(entry)
+        entry['ack'] = {'status': status, 'time': datetime.utcnow().isoformat()+'Z', 'response': response[:200]}
+        self._load()[name] = entry
+
+    def __len__(self):
+        return len(self._load())
+
+
+###########
+# Upload pool
+#
+# One requests.Session shared by `workers` threads, its connection pool holding one keep-alive
+# connection per worker. Connection errors, timeouts, 429 and 5xx responses are retried up to
+# `retries` times with exponential backoff and jitter; other responses are returned as they are.
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class UploadPool:
+
+    def __init__(self, url, headers=None, workers=4, timeout=(5, 60), retries=4, backoff=0.5, max_backoff=30.0, part_size=None):
+        self.url = url
+        self.part_size = part_size # bytes per part in chunked mode, None for one multipart POST per file
+        self.headers = headers or {}
+        self.workers = workers
+        self.timeout = timeout # (connect, read) in seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.wire_bytes = 0 # request bodies sent, compressed size for bundles
+        self.retried = 0
+        self.resumed = 0 # chunked uploads that continued from a server offset
+        self.elapsed = 0.0
+
+    def _delay(self, attempt):
+        delay = min(self.backoff*2**attempt, self.max_backoff)
+        return delay*(0.5 + random.random()/2)
+
+    def request(self, method, url, **kwargs):
+        # one request with retries, returns the last response or raises the last exception
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(self.headers)
+        headers.update(kwargs.pop('headers', {}))
+        rewind = kwargs.pop('rewind', None) # called before every retry, e.g. to seek a file back
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self._delay(attempt - 1))
+                if rewind is not None:
+                    rewind()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning("[Upload]: "+url+": "+str(e)+", retrying")
+                continue
+            if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                return response
+            logging.warning("[Upload]: "+url+": status "+str(response.status_code)+", retrying")
+
+    def upload(self, path, name=None):
+        # multipart POST of one file, same form as the original uploader ('upload' field)
+        name = name or os.path.basename(path)
+        if self.part_size and os.path.getsize(path):
+            return self.upload_chunked(path, name)
+        with open(path, 'rb') as file:
+            response = self.request('POST', self.url, files={'upload': (name, file)}, rewind=lambda: file.seek(0))
+        if 200 <= response.status_code < 300:
+            with self._lock:
+                self.files += 1
+                self.bytes += os.path.getsize(path)
+                self.wire_bytes += len(response.request.body)
+        return response
+
+    def upload_chunked(self, path, name=None):
+        # resumable upload in parts of part_size bytes, returns the response to the last request
+        name = name or os.path.basename(path)
+        url = self.url.rstrip('/')+'/chunked/'+quote(name)
+        size = os.path.getsize(path)
+        headers = {'X-Upload-Length': str(size), 'X-File-Sha256': file_hash(path)}
+        response = self.request('GET', url, headers=headers)
+        if response.status_code != 200:
+            return response
+        status = response.json()
+        if status.get('complete'): # already stored, nothing to send
+            with self._lock:
+                self.files += 1
+            return response
+        offset = status['offset']
+        if offset:
+            with self._lock:
+                self.resumed += 1
+
+        conflicts = 0
+        with open(path, 'rb') as file:
+            while True:
+                file.seek(offset)
+                part = file.read(self.part_size)
+                part_headers = dict(headers)
+                part_headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, offset + len(part) - 1, size)
+                part_headers['X-Chunk-Sha256'] = hashlib.sha256(part).hexdigest()
+                response = self.request('PUT', url, data=part, headers=part_headers)
+                with self._lock:
+                    self.wire_bytes += len(part)
+                if response.status_code == 201:
+                    break
+                if response.status_code == 409: # the server expects another offset, or the part arrived corrupted
+                    conflicts += 1
+                    if conflicts > self.retries:
+                        return response
+                elif response.status_code != 200:
+                    return response
+                else:
+                    conflicts = 0
+                offset = response.json()['offset']
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        return response
+
+    def upload_many(self, items):
+        # items: (path, key) pairs, yields (key, response or exception) as uploads complete
+        start = time.monotonic()
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = dict((executor.submit(self.upload, path), key) for path, key in items)
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                    if not 200 <= result.status_code < 300:
+                        with self._lock:
+                            self.failed += 1
+                except Exception as e:
+                    result = e
+                    with self._lock:
+                        self.failed += 1
+                yield futures[future], result
+        self.elapsed += time.monotonic() - start
+
+    def upload_bundles(self, items, encoding=None, bundle_files=96, level=None):
+        # items: (path, key) pairs, sent as compressed tar archives of up to bundle_files files.
+        # Yields (key, response or exception) per file as the bundles complete, like upload_many;
+        # a file counts as uploaded only if the server receipt lists it with the right size.
+        encoding = encoding or ('zstd' if zstandard is not None else 'gzip')
+        items = list(items)
+        bundles = [items[i:i + bundle_files] for i in range(0, len(items), bundle_files)]
+        url = self.url.rstrip('/')+'/bundle'
+        start = time.monotonic()
+
+        def send(bundle):
+            body = BundleBody([path for path, key in bundle], encoding, level)
+            response = self.request('POST', url, data=body, headers={'Content-Type': 'application/x-tar', 'Content-Encoding': encoding})
+            if response.status_code == 200:
+                with self._lock:
+                    self.wire_bytes += body.sent
+            return response
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = dict((executor.submit(send, bundle), bundle) for bundle in bundles)
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                    receipts = dict((receipt['name'], receipt) for receipt in result.json()['files']) if result.status_code == 200 else None
+                except Exception as e:
+                    result = e
+                    receipts = None
+                for path, key in futures[future]:
+                    size = os.path.getsize(path)
+                    if receipts is not None and receipts.get(os.path.basename(path), {}).get('size') == size:
+                        with self._lock:
+                            self.files += 1
+                            self.bytes += size
+                        yield key, result
+                        continue
+                    with self._lock:
+                        self.failed += 1
+                    if receipts is not None:
+                        yield key, ValueError(os.path.basename(path)+" missing from the bundle receipt")
+                    else:
+                        yield key, result
+        self.elapsed += time.monotonic() - start
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'failed': self.failed,
+            'wire_bytes': self.wire_bytes,
+            'retried': self.retried,
+            'resumed': self.resumed,
+            'elapsed': self.elapsed,
+            'files_per_s': self.files/self.elapsed if self.elapsed else 0.0,
+            'mb_per_s': self.bytes/1e6/self.elapsed if self.elapsed else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("%d files, %.2f MB in %.2f s: %.1f files/s, %.2f MB/s, %d retries, %d failed (%d workers)" %
+                (stats['files'], stats['bytes']/1e6, stats['elapsed'], stats['files_per_s'], stats['mb_per_s'], stats['retried'], stats['failed'], self.workers))
+
+
+###########
+# Bundles
+
+class BundleSink:
+    # file object for tarfile that compresses what it receives and keeps the output until taken
+
+    def __init__(self, encoding, level=None):
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd bundles need the zstandard module")
+            self.compressor = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        else:
+            raise ValueError("unknown bundle encoding: "+str(encoding))
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(self.compressor.compress(data))
+        return len(data)
+
+    def finish(self):
+        self.chunks.append(self.compressor.flush())
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class BundleBody:
+    # request body iterating over the compressed archive of `paths`, built file by file while it is
+    # sent; iterating again starts over, so retries send the whole bundle again
+
+    def __init__(self, paths, encoding='gzip', level=None):
+        self.paths = paths
+        self.encoding = encoding
+        self.level = level
+        self.size = sum(os.path.getsize(path) for path in paths)
+        self.sent = 0
+
+    def __iter__(self):
+        sink = BundleSink(self.encoding, self.level)
+        archive = tarfile.open(fileobj=sink, mode='w|', format=tarfile.PAX_FORMAT)
+        self.sent = 0
+        for path in self.paths:
+            archive.add(path, arcname=os.path.basename(path), recursive=False)
+            data = sink.take()
+            if data:
+                self.sent += len(data)
+                yield data
+        archive.close()
+        sink.finish()
+        data = sink.take()
+        self.sent += len(data)
+        yield data
+
+
+###########
+# Upload benchmark against a server (python3 TEG_upload.py bench --server host:port)
+
+def synthetic_files(directory, count, rows=1800):
+    # `count` 15-minute CSV batch files
+    from TEG_batchfile import write_batch_csv
+    from TEG_telemetry import synthetic_batch
+
+    paths = []
+    for i in range(count):
+        batch = synthetic_batch(rows, seed=i) # different noise in every file
+        path = os.path.join(directory, (datetime(2026, 1, 1) + timedelta(minutes=15*i)).strftime('%Y%m%d_%H_%M')+'.csv')
+        write_batch_csv(path, ['Timestamp'] + batch.channels, batch)
+        paths.append(path)
+    return paths
+
+
+def upload_one_by_one(url, headers, paths, pause=0.2):
+    # the original TEG_profiler_upload.py loop: a new connection per file and a pause after each,
+    # returns the time and the bytes of the request bodies
+    start = time.monotonic()
+    wire = 0
+    for path in paths:
+        with open(path, 'rb') as file:
+            wire += len(requests.post(url, files={'upload': file}, headers=headers).request.body)
+        time.sleep(pause)
+    return time.monotonic() - start, wire
+
+
+def bench(url, headers, paths, workers=(1, 4, 8), part_size=None):
+    total = sum(os.path.getsize(path) for path in paths)
+    elapsed, wire = upload_one_by_one(url, headers, paths)
+    print("one by one: %d files, %.2f MB in %.2f s: %.1f files/s, %.2f MB/s" % (len(paths), total/1e6, elapsed, len(paths)/elapsed, total/1e6/elapsed))
+    for count in workers:
+        pool = UploadPool(url, headers, workers=count)
+        for key, result in pool.upload_many((path, path) for path in paths):
+            pass
+        pool.close()
+        print("pool:       "+pool.summary())
+        if part_size:
+            pool = UploadPool(url, {'APP_ID': headers['APP_ID']+'_chunked_%d' % count}, workers=count, part_size=part_size)
+            for key, result in pool.upload_many((path, path) for path in paths):
+                pass
+            pool.close()
+            print("chunked:    "+pool.summary())
+
+
+def backfill(url, paths, one_by_one=True, workers=4):
+    # yields (label, seconds, bytes on the wire) of each upload path, every path to its own APP_ID
+    runs = [('one by one', None, None)] if one_by_one else []
+    runs += [('per file, %d workers' % workers, 'files', None), ('bundles, gzip', 'bundle', 'gzip')]
+    if zstandard is not None:
+        runs.append(('bundles, zstd', 'bundle', 'zstd'))
+    for number, (label, mode, encoding) in enumerate(runs):
+        headers = {'APP_ID': 'teg_backfill_%d' % number}
+        if mode is None:
+            elapsed, wire = upload_one_by_one(url, headers, paths)
+            yield label, elapsed, wire
+            continue
+        pool = UploadPool(url, headers, workers=workers)
+        if mode == 'files':
+            results = pool.upload_many((path, path) for path in paths)
+        else:
+            results = pool.upload_bundles(((path, path) for path in paths), encoding)
+        for key, result in results:
+            pass
+        pool.close()
+        if pool.failed:
+            print(label+": %d files failed" % pool.failed)
+        yield label, pool.elapsed, pool.wire_bytes
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='TEG profiler upload benchmark')
+    parser.add_argument('command', choices=['bench', 'backfill'])
+    parser.add_argument('--server', default='127.0.0.1:8080')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--workers', default='1,4,8', help='comma separated pool sizes')
+    parser.add_argument('--part-size', type=int, help='also run the pool in chunked mode with parts of this many bytes')
+    parser.add_argument('--days', type=float, default=7, help='backfill: days of 15-minute files')
+    parser.add_argument('--skip-one-by-one', action='store_true', help='backfill: skip the old upload loop')
+    args = parser.parse_args()
+
+    url = 'http://'+args.server+'/upload'
+    directory = tempfile.mkdtemp()
+    try:
+        if args.command == 'backfill':
+            paths = synthetic_files(directory, int(args.days*96))
+            print("%d files, %.2f MB" % (len(paths), sum(os.path.getsize(path) for path in paths)/1e6))
+            print("%-22s %9s %10s %9s" % ('path', 'time s', 'wire MB', 'files/s'))
+            for label, elapsed, wire in backfill(url, paths, not args.skip_one_by_one):
+                print("%-22s %9.2f %10.2f %9.1f" % (label, elapsed, wire/1e6, len(paths)/elapsed))
+        else:
+            bench(url, {'APP_ID': 'teg_upload_bench'}, synthetic_files(directory, args.files), [int(w) for w in args.workers.split(',')], args.part_size)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,343 @@
+################################################
+#
+# TEG profiler upload server (local stand-in)
+#
+# University of Virginia
+#
+################################################
+#
+# Minimal implementation of the upload endpoint used by TEG_profiler_upload.py, for testing the
+# uploader without the real server:
+#
+#   POST /upload   multipart/form-data with the file in the 'upload' field and the APP_ID header,
+#                  stored as <root>/<APP_ID>/<file name>; answers 200 with a JSON receipt
+#                  {"name", "size", "sha256"}
+#
+# Resumable chunked uploads (UploadPool with part_size, see TEG_upload.py):
+#
+#   GET /upload/chunked/<name>   headers X-Upload-Length (file size) and X-File-Sha256
+#                  answers {"offset": bytes already received, "complete": false}, or the receipt
+#                  with "complete": true if that file is already stored. A different size or hash
+#                  than the partial upload on the server starts over from offset 0.
+#   PUT /upload/chunked/<name>   one part, headers Content-Range: bytes <first>-<last>/<size>,
+#                  X-Chunk-Sha256 (hash of the part) and X-File-Sha256
+#                  answers 200 {"offset": next offset}, 409 {"offset": ...} if the part does not
+#                  start at the server offset or its hash does not match, and 201 with the receipt
+#                  once the last part is stored and the hash of the whole file matches.
+#
+# Partial uploads are kept in <root>/<APP_ID>/.partial/ and survive server restarts.
+#
+# Bundles (UploadPool.upload_bundles, see TEG_upload.py):
+#
+#   POST /upload/bundle   body is a tar archive compressed as given by Content-Encoding (gzip or
+#                  zstd), usually sent with Transfer-Encoding: chunked as it is compressed. The
+#                  archive is unpacked while it is received, every regular file is stored like a
+#                  /upload file, and the answer is {"files": [receipt, ...]}.
+#
+#   python3 TEG_upload_server.py [--port 8080] [--root uploads] [--delay 0.05] [--fail-rate 0.1] [--rate 125000]
+#
+# --delay adds a processing time per request (to emulate a remote server), --fail-rate answers a
+# random fraction of the requests with 503 (to exercise the retries) and --rate limits the bytes
+# per second received over all connections (to emulate the device uplink).
+
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tarfile
+import threading
+import time
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CHUNKED_PATH = '/upload/chunked/'
+BUNDLE_PATH = '/upload/bundle'
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # zstd bundles refused, gzip always works
+
+
+def safe_name(name):
+    # file and app names come from the client, keep them inside the upload root
+    name = os.path.basename(name or '')
+    if name in ('', '.', '..'):
+        raise ValueError("invalid name: "+repr(name))
+    return name
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_multipart(content_type, body):
+    # returns {field name: (file name, bytes)}
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(b'Content-Type: '+content_type.encode()+b'\r\n\r\n'+body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        fields[name] = (part.get_filename(), part.get_payload(decode=True))
+    return fields
+
+
+class BodyReader(io.RawIOBase):
+    # request body as a stream: Content-Length or chunked transfer encoding, throttled to the server rate
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.chunked = handler.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        self.remaining = 0 if self.chunked else int(handler.headers.get('Content-Length', 0))
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        rfile = self.handler.rfile
+        if self.chunked and self.remaining == 0 and not self.done:
+            size = int(rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                while rfile.readline() not in (b'\r\n', b'\n', b''): # trailers
+                    pass
+                self.done = True
+            self.remaining = size
+        if self.remaining == 0:
+            return 0
+        data = rfile.read(min(len(buffer), self.remaining, 65536))
+        if not data:
+            raise ValueError("connection closed in the middle of the request body")
+        self.remaining -= len(data)
+        if self.chunked and self.remaining == 0:
+            rfile.readline() # CRLF after the chunk
+        buffer[:len(data)] = data
+        self.handler.server.throttle(len(data))
+        return len(data)
+
+    def drain(self):
+        while self.read(65536):
+            pass
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def app_directory(self):
+        directory = os.path.join(self.server.root, safe_name(self.headers.get('APP_ID')))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def read_body(self):
+        return BodyReader(self).read()
+
+    def handle_request(self, method):
+        if method == 'POST' and self.path == BUNDLE_PATH:
+            return self.handle_bundle()
+        body = self.read_body() # always consumed so the connection can be reused
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.fail_rate and random.random() < self.server.fail_rate:
+            return self.reply(503, {'error': 'try again'})
+        try:
+            if method == 'POST' and self.path == '/upload':
+                return self.upload(body)
+            if self.path.startswith(CHUNKED_PATH):
+                name = safe_name(unquote(self.path[len(CHUNKED_PATH):]))
+                with self.server.file_lock(name):
+                    if method == 'GET':
+                        return self.chunked_status(name)
+                    if method == 'PUT':
+                        return self.chunked_part(name, body)
+            self.reply(404, {'error': 'unknown path '+self.path})
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def store(self, name, data):
+        path = os.path.join(self.app_directory(), safe_name(name))
+        with open(path+'.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path+'.tmp', path)
+        return {'name': os.path.basename(path), 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+
+    def upload(self, body):
+        fields = parse_multipart(self.headers.get('Content-Type', ''), body)
+        if 'upload' not in fields:
+            raise ValueError("missing 'upload' field")
+        name, data = fields['upload']
+        self.reply(200, self.store(name, data))
+
+    ###########
+    # Bundles
+
+    def handle_bundle(self):
+        body = BodyReader(self)
+        try:
+            if self.server.fail_rate and random.random() < self.server.fail_rate:
+                body.drain()
+                return self.reply(503, {'error': 'try again'})
+            encoding = self.headers.get('Content-Encoding', 'gzip')
+            if encoding == 'gzip':
+                archive = tarfile.open(fileobj=body, mode='r|gz')
+            elif encoding == 'zstd' and zstandard is not None:
+                archive = tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(body), mode='r|')
+            else:
+                body.drain()
+                return self.reply(415, {'error': 'unsupported Content-Encoding '+encoding})
+            receipts = []
+            with archive:
+                for member in archive: # in order, as the stream arrives
+                    if member.isfile():
+                        receipts.append(self.store(member.name, archive.extractfile(member).read()))
+            body.drain()
+        except (tarfile.TarError, OSError, EOFError, ValueError) as e:
+            self.close_connection = True # the rest of the body may still be in the socket
+            return self.reply(400, {'error': 'invalid bundle: '+str(e)})
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.reply(200, {'files': receipts})
+
+    ###########
+    # Chunked uploads
+
+    def partial_paths(self, name):
+        directory = os.path.join(self.app_directory(), '.partial')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name), os.path.join(directory, name+'.json')
+
+    def upload_state(self, name, size, sha256):
+        # {"size", "sha256", "offset"} of the partial upload of that file
+        data_path, state_path = self.partial_paths(name)
+        try:
+            with open(state_path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = None
+        if state is None or state['size'] != size or state['sha256'] != sha256:
+            state = {'size': size, 'sha256': sha256}
+            open(data_path, 'wb').close()
+            with open(state_path, 'w') as file:
+                json.dump(state, file)
+        state['offset'] = os.path.getsize(data_path) # the data file is the source of truth for the offset
+        return state
+
+    def chunked_status(self, name):
+        path = os.path.join(self.app_directory(), name)
+        if os.path.exists(path) and self.headers.get('X-File-Sha256') == file_sha256(path):
+            return self.reply(200, {'name': name, 'size': os.path.getsize(path), 'sha256': self.headers.get('X-File-Sha256'), 'complete': True})
+        state = self.upload_state(name, int(self.headers.get('X-Upload-Length', -1)), self.headers.get('X-File-Sha256', ''))
+        self.reply(200, {'offset': state['offset'], 'complete': False})
+
+    def chunked_part(self, name, body):
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)$', self.headers.get('Content-Range', ''))
+        if not match:
+            raise ValueError("missing or invalid Content-Range")
+        first, last, size = [int(v) for v in match.groups()]
+        state = self.upload_state(name, size, self.headers.get('X-File-Sha256', ''))
+        if first != state['offset'] or last - first + 1 != len(body) or hashlib.sha256(body).hexdigest() != self.headers.get('X-Chunk-Sha256'):
+            return self.reply(409, {'offset': state['offset'], 'complete': False})
+
+        data_path, state_path = self.partial_paths(name)
+        with open(data_path, 'ab') as file:
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        if last + 1 < size:
+            return self.reply(200, {'offset': last + 1, 'complete': False})
+
+        sha256 = file_sha256(data_path)
+        if sha256 != state['sha256']:
+            os.remove(data_path)
+            os.remove(state_path)
+            return self.reply(409, {'offset': 0, 'complete': False, 'error': 'file hash mismatch'})
+        path = os.path.join(self.app_directory(), name)
+        os.replace(data_path, path)
+        os.remove(state_path)
+        self.reply(201, {'name': name, 'size': size, 'sha256': sha256, 'complete': True})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class UploadServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, delay=0.0, fail_rate=0.0, verbose=False, rate=None):
+        ThreadingHTTPServer.__init__(self, address, UploadHandler)
+        self.root = root
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        self.rate = rate # bytes per second over all connections, None for no limit
+        self.received = 0
+        self._link_free = time.monotonic()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def throttle(self, nbytes):
+        # emulates a shared link of `rate` bytes per second
+        with self._lock:
+            self.received += nbytes
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self._link_free = max(self._link_free, now) + nbytes/float(self.rate)
+            wait = self._link_free - now
+        time.sleep(wait)
+
+    def file_lock(self, name):
+        # chunked uploads: one request at a time per file
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+
+def make_server(port=8080, root='uploads', delay=0.0, fail_rate=0.0, verbose=False, host='127.0.0.1', rate=None):
+    server = UploadServer((host, port), root, delay, fail_rate, verbose, rate)
+    os.makedirs(root, exist_ok=True)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TEG profiler upload server (local stand-in)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--root', default='uploads')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds of processing time per request')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--rate', type=float, help='bytes per second received over all connections (uplink emulation)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.root, args.delay, args.fail_rate, args.verbose, args.host, args.rate)
+    print("TEG upload server on %s:%d, storing in %s" % (args.host, args.port, os.path.abspath(args.root)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass